@@ -1,8 +1,15 @@
 from django.contrib import admin
 from django import forms
+from django.db import models
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from .filmography import refresh_movie_filmography
+from .images import get_variant_url
 from .models import *
+from .search import search_movies
+from .service import EstimatedCountPaginator, apply_rating_change
+from .utils import bump_catalog_version, bump_movie_list_version
 from ckeditor_uploader.widgets import CKEditorUploadingWidget
 
 
@@ -19,6 +26,12 @@ class MovieAdminForm(forms.ModelForm):
 
 
 
+class LargeTableAdmin(admin.ModelAdmin):
+    """Список большой таблицы: оценочное число записей и без второго COUNT(*) по всей таблице"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     """Категории"""
@@ -42,8 +55,13 @@ class ReviewInLine(admin.TabularInline):
     model = Review
     # Указывает количество дополнительных полей
     extra = 1
-    # указываем поля которые будут только для чтения
-    readonly_fields = ("name", "email")
+    # указываем поля которые будут только для чтения. Родитель тоже: поле выбора
+    # грузило бы все отзывы, а поле для id - запрос на каждую строку
+    readonly_fields = ("name", "email", "parent")
+
+    def get_queryset(self, request):
+        # в названии отзыва и его родителя выводится фильм
+        return super().get_queryset(request).select_related("movie", "parent__movie")
 
 
 # Выводим те данные которые привязаны к данной модели MovieShots
@@ -53,15 +71,17 @@ class MovieShotsInLine(admin.TabularInline):
     readonly_fields = ("get_image", )
     def get_image(self, obj):
         if obj.image:
-            return mark_safe(f'<img src={obj.image.url} width="100" height="110" ')
+            return mark_safe(f'<img src={get_variant_url(obj, "image", "thumb")} width="100" height="110" ')
 
     get_image.short_description = "Изображение"
 
 
 @admin.register(Movie)
-class MovieAdmin(admin.ModelAdmin):
+class MovieAdmin(LargeTableAdmin):
     """Фильмы"""
     list_display = ("title", "category", "url", "draft")
+    # категория забирается join'ом, а не запросом на каждую строку
+    list_select_related = ("category",)
     list_filter = ("category", "year")
     search_fields = ("title", "category__name")
     # Интерфейс администратора позволяет редактировать связанные объекты на одной
@@ -78,6 +98,8 @@ class MovieAdmin(admin.ModelAdmin):
     actions = ["publish", "unpublish"]
     form = MovieAdminForm
     readonly_fields = ("get_image", )
+    # поиск актёров по мере ввода вместо списка со всеми актёрами
+    autocomplete_fields = ("actors", "directors")
     # объединяем данные поля в один. В кортеже указываем кортеж полей, которые должны
     # быть в одной строке
     # fields = (("actors", "directors", "genres"), )
@@ -111,14 +133,31 @@ class MovieAdmin(admin.ModelAdmin):
     )
 
     def get_image(self, obj):
-        return mark_safe(f'<img src={obj.poster.url} width="100" height="110" ')
+        return mark_safe(f'<img src={get_variant_url(obj, "poster", "thumb")} width="100" height="110" ')
+
+    def get_search_results(self, request, queryset, search_term):
+        """Поиск по полнотекстовому индексу вместо LIKE '%...%' по search_fields"""
+        if not search_term.strip():
+            return queryset, False
+        # категорий немного, поэтому их по-прежнему ищем по подстроке названия
+        categories = Category.objects.filter(name__icontains=search_term)
+        found = search_movies(Movie.objects.all(), search_term, ranked=False).values("pk")
+        return queryset.filter(models.Q(pk__in=found) | models.Q(category__in=categories)), False
 
     # QuerySet, по сути, — список объектов заданной модели. QuerySet
     # позволяет читать данные из базы данных, фильтровать и изменять их порядок.
     def unpublish(self, request, queryset):
         """Снять с публикации"""
         # тут мы снимаем с публикации выбранные элементы
-        row_update = queryset.update(draft=True)
+        ids = list(queryset.values_list("pk", flat=True))
+        row_update = queryset.update(draft=True, version=models.F("version") + 1, updated=timezone.now())
+        # update не шлёт post_save, поэтому журнал изменений и кэш списка фильмов
+        # обновляем сами
+        Change.record(Movie, ids, Change.UPDATED)
+        bump_movie_list_version()
+        bump_catalog_version()
+        # и фильмографии актёров: в них только опубликованные фильмы
+        refresh_movie_filmography(ids)
         # Далее проверяем сколько записей было обновлено
         if row_update == 1:
             message_bit = "1 запись была обновлена"
@@ -129,7 +168,12 @@ class MovieAdmin(admin.ModelAdmin):
 
     def publish(self, request, queryset):
         """Опубликовать"""
-        row_update = queryset.update(draft=False)
+        ids = list(queryset.values_list("pk", flat=True))
+        row_update = queryset.update(draft=False, version=models.F("version") + 1, updated=timezone.now())
+        Change.record(Movie, ids, Change.UPDATED)
+        bump_movie_list_version()
+        bump_catalog_version()
+        refresh_movie_filmography(ids)
         if row_update == 1:
             message_bit = "1 запись была обновлена"
         else:
@@ -146,11 +190,15 @@ class MovieAdmin(admin.ModelAdmin):
 
 
 @admin.register(Review)
-class ReviewAdmin(admin.ModelAdmin):
+class ReviewAdmin(LargeTableAdmin):
     """Отзывы"""
     list_display = ("name", "email", "parent", "movie", "id")
+    # в названии родителя выводится его фильм
+    list_select_related = ("movie", "parent__movie")
     # поля только для чтения(то есть нельзя редактировать)
     readonly_fields = ("name", "email")
+    autocomplete_fields = ("movie",)
+    raw_id_fields = ("parent",)
 
 
 @admin.register(Genre)
@@ -165,31 +213,52 @@ class ActorAdmin(admin.ModelAdmin):
     """Актёры"""
     list_display = ("name", "age", "get_image")
     readonly_fields = ("get_image", )
+    # для autocomplete_fields фильмов
+    search_fields = ("name",)
 
     # принимает модель объекта актёров
     def get_image(self, obj):
         # mark_safe - выведет html не как строку, а как тег
         if obj.image:
-            return mark_safe(f'<img src={obj.image.url} width="50" height="60" ')
+            return mark_safe(f'<img src={get_variant_url(obj, "image", "thumb")} width="50" height="60" ')
 
     get_image.short_description = "Изображение"
 
 
 @admin.register(Rating)
-class RatingAdmin(admin.ModelAdmin):
+class RatingAdmin(LargeTableAdmin):
     """Рейтинг"""
     list_display = ("star", "movie", "ip")
+    list_select_related = ("star", "movie")
+    autocomplete_fields = ("movie",)
+
+    def save_model(self, request, obj, form, change):
+        """Новая или изменённая оценка меняет агрегаты рейтинга фильма, как upsert_ratings"""
+        old = Rating.objects.filter(pk=obj.pk).values_list("movie_id", "star__value").first() if change else None
+        super().save_model(request, obj, form, change)
+        if old == (obj.movie_id, obj.star.value):
+            return
+        old_value = None
+        if old is not None:
+            if old[0] == obj.movie_id:
+                old_value = old[1]
+            else:
+                # оценку перенесли на другой фильм
+                apply_rating_change(old[0], old[1], None)
+        apply_rating_change(obj.movie_id, old_value, obj.star.value)
 
 
 @admin.register(MovieShots)
-class MovieShotsAdmin(admin.ModelAdmin):
+class MovieShotsAdmin(LargeTableAdmin):
     """Кадры из фильма"""
     list_display = ("title", "movie", "get_image")
+    list_select_related = ("movie",)
+    autocomplete_fields = ("movie",)
     readonly_fields = ("get_image",)
 
     def get_image(self, obj):
         if obj.image:
-            return mark_safe(f'<img src={obj.image.url} width="50" height="60" ')
+            return mark_safe(f'<img src={get_variant_url(obj, "image", "thumb")} width="50" height="60" ')
 
     get_image.short_description = "Изображение"
 
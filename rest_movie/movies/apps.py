@@ -5,3 +5,11 @@ class MoviesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'movies'
     verbose_name = "Фильмы"
+
+    def ready(self):
+        # регистрируем проверку общего кэша для manage.py check --deploy
+        from . import utils  # noqa: F401
+        # подключаем обработчики сигналов моделей
+        from . import signals  # noqa: F401
+        # и обёртку соединений с бд, которая считает запросы для метрик
+        from . import metrics  # noqa: F401
@@ -0,0 +1,10 @@
+from django.urls import path
+from . import async_views
+
+# Асинхронные версии эндпоинтов чтения из urls.py, тот же JSON (см. async_views)
+urlpatterns = [
+    path("movie/", async_views.AsyncMovieListView.as_view()),
+    path("movie/<int:pk>/", async_views.AsyncMovieDetailView.as_view()),
+    path("actors/", async_views.AsyncActorsListView.as_view()),
+    path("actors/<int:pk>/", async_views.AsyncActorsDetailView.as_view()),
+]
@@ -0,0 +1,150 @@
+"""Асинхронные версии эндпоинтов чтения для ASGI
+
+Отдают тот же JSON, что и views.py, и берут оттуда же запросы, фильтры и
+пагинацию, но ждут бд через асинхронный ORM Django и не занимают поток воркера
+на время запроса. Подключены в rest_movie/urls.py под api/async/v1/ и
+обслуживаются rest_movie/asgi.py.
+
+В Django 4.2 async for не поддерживает prefetch_related, поэтому фильм со
+связями берётся через aget(), который выполняет prefetch целиком.
+
+Права и ограничения частоты проверяются теми же permission_classes и
+throttle_classes синхронного представления. Их проверка (аутентификация читает
+сессию из бд) и сериализаторы идут через sync_to_async, не в цикле событий.
+Кэш (версии списка, страницы, отметка чтения своих записей в ReplicaMiddleware)
+читается через асинхронный API кэша.
+"""
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views import View
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+
+from .replicas import read_from_replica, reads_own_writes
+from .service import ConditionalGetMixin, get_client_ip, get_page_ratings, overlay_page_ratings
+from .utils import aget_movie_list_cache_key, get_movie_list_cache_timeout
+from .views import ActorsDetailView, ActorsListView, MovieDetailView, MovieListView
+
+
+class AsyncAPIView(View):
+    """Асинхронный эндпоинт поверх настроек синхронного DRF-представления view_class"""
+    view_class = None
+    renderer = JSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            # обработчики получают запрос DRF, как у синхронного представления
+            self.view = self.get_view(request)
+            request = self.view.request
+            await sync_to_async(self.check_access)(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except (APIException, Http404) as exc:
+            # тот же ответ об ошибке, что даёт DRF: 403 вместо 401 без заголовка аутентификации и т.п.
+            response = self.view.handle_exception(exc)
+            rendered = self.render(response.data, status=response.status_code)
+            for header, value in response.items():
+                if header != "Content-Type":
+                    rendered[header] = value
+            return rendered
+
+    def get_view(self, request):
+        view = self.view_class(args=self.args, kwargs=self.kwargs, format_kwarg=None)
+        # с аутентификаторами и парсерами представления, как в APIView.dispatch
+        view.request = view.initialize_request(request)
+        return view
+
+    def check_access(self, request):
+        """Права и ограничения частоты, как APIView.initial"""
+        self.view.check_permissions(request)
+        self.view.check_throttles(request)
+
+    def render(self, data, status=200):
+        return HttpResponse(self.renderer.render(data), content_type="application/json", status=status)
+
+
+class AsyncListView(AsyncAPIView):
+    """Список из строк .values() (см. views.ValuesListMixin) с асинхронным чтением страницы"""
+
+    async def get_page_data(self, request):
+        view = self.view
+        serializer = view.values_serializer_class(context=view.get_serializer_context())
+        # фильтр может сходить в бд синхронно: индекс каталога строится при первом обращении
+        queryset = await sync_to_async(view.filter_queryset)(view.get_queryset())
+        paginator = view.paginator
+        page_queryset = paginator.get_page_queryset(queryset.values(*serializer.columns), request)
+        page = paginator.take_page([row async for row in page_queryset])
+        results = await sync_to_async(serializer.to_representation)(page)
+        return paginator.get_paginated_response(results).data
+
+    async def get(self, request, *args, **kwargs):
+        return self.render(await self.get_page_data(request))
+
+
+class AsyncMovieListView(AsyncListView):
+    """Вывод списка фильмов, как MovieListView"""
+    view_class = MovieListView
+
+    async def get(self, request, *args, **kwargs):
+        key = await aget_movie_list_cache_key(request)
+        data = None if reads_own_writes() else await cache.aget(key)
+        if data is None:
+            data = await self.get_page_data(request)
+            data = {**data, "results": [dict(row) for row in data["results"]]}
+            if not read_from_replica():
+                await cache.aset(key, data, get_movie_list_cache_timeout())
+        results = data["results"]
+        if results:
+            ratings = get_page_ratings([row["id"] for row in results], get_client_ip(request))
+            results = overlay_page_ratings(results, [row async for row in ratings])
+        return self.render({**data, "results": results})
+
+
+class AsyncActorsListView(AsyncListView):
+    """Вывод списка актёров, как ActorsListView"""
+    view_class = ActorsListView
+
+
+class AsyncDetailView(AsyncAPIView):
+    """Объект по pk с ответом 304, как ConditionalGetMixin"""
+
+    async def get_object(self, view):
+        try:
+            return await view.get_queryset().aget(pk=self.kwargs["pk"])
+        except ObjectDoesNotExist:
+            raise Http404
+
+    async def get(self, request, *args, **kwargs):
+        view = self.view
+        queryset = view.get_queryset()
+        row = await queryset.filter(pk=kwargs["pk"]).values_list("pk", "version", "updated").afirst()
+        if row is None:
+            raise Http404
+        etag, last_modified = ConditionalGetMixin.get_validators(queryset.model, *row)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            instance = await self.get_object(view)
+            data = await sync_to_async(lambda: view.get_serializer(instance).data)()
+            response = self.render(data)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
+
+
+class AsyncMovieDetailView(AsyncDetailView):
+    """Вывод фильма, как MovieDetailView"""
+    view_class = MovieDetailView
+
+    async def get_object(self, view):
+        movie = await super().get_object(view)
+        # отзывы нужны сериализатору, собираем их заранее асинхронно
+        await movie.aget_review_tree()
+        return movie
+
+
+class AsyncActorsDetailView(AsyncDetailView):
+    """Вывод актёра или режиссёра, как ActorsDetailView"""
+    view_class = ActorsDetailView
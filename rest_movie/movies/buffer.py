@@ -0,0 +1,217 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.exceptions import APIException
+
+from .models import Rating
+from .service import upsert_ratings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": False,
+    # сколько разных пар (ip, фильм) может ждать записи
+    "MAX_SIZE": 10_000,
+    # запись пачкой, как только столько пар накопилось
+    "FLUSH_SIZE": 500,
+    # и не реже чем раз в столько секунд
+    "FLUSH_INTERVAL": 1.0,
+    # сколько секунд запрос ждёт места в заполненном буфере до отказа
+    "BLOCK_TIMEOUT": 0.5,
+    # куда сбрасываются оценки, если при остановке бд недоступна (см. drain_ratings)
+    "SPOOL_DIR": None,
+}
+
+
+class RatingBufferFull(APIException):
+    """Буфер оценок заполнен: запись отклоняется с 503 и Retry-After"""
+    status_code = 503
+    default_detail = "Сервис перегружен оценками, повторите запрос позже."
+    default_code = "rating_buffer_full"
+
+    def __init__(self, wait):
+        super().__init__()
+        # exception_handler DRF выставляет по wait заголовок Retry-After
+        self.wait = wait
+
+
+class RatingBuffer:
+    """Отложенная запись оценок (write-behind)
+
+    Оценки копятся в памяти процесса, повторная оценка того же фильма с того же
+    ip заменяет предыдущую. Пачка пишется одним upsert_ratings, когда набралось
+    FLUSH_SIZE пар или прошло FLUSH_INTERVAL секунд. При остановке процесса
+    остаток записывается в бд, а если бд недоступна - в SPOOL_DIR.
+    """
+
+    def __init__(self, max_size, flush_size, flush_interval, block_timeout, spool_dir=None, autostart=True):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.spool_dir = Path(spool_dir) if spool_dir else None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # одна запись в бд за раз: пачки одного процесса не обгоняют друг друга
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.thread = None
+        if autostart:
+            self.thread = threading.Thread(target=self.run, name="rating-buffer", daemon=True)
+            self.thread.start()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def add(self, ip, movie_id, star):
+        """Принять оценку в буфер, при заполненном буфере - подождать или отказать"""
+        key = (ip, movie_id)
+        deadline = time.monotonic() + self.block_timeout
+        while True:
+            with self.changed:
+                if self.closed:
+                    raise RatingBufferFull(wait=max(1, round(self.flush_interval)))
+                # замена уже ждущей оценки места не занимает
+                if key in self.pending or len(self.pending) < self.max_size:
+                    self.pending[key] = star
+                    batch_ready = len(self.pending) >= self.flush_size
+                    if batch_ready:
+                        self.changed.notify_all()
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RatingBufferFull(wait=max(1, round(self.flush_interval)))
+                if self.thread is not None:
+                    self.changed.notify_all()
+                    self.changed.wait(remaining)
+                    continue
+            # без фонового потока место освобождает сам запрос
+            self.flush()
+        if self.thread is None and batch_ready:
+            self.flush()
+
+    def take(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.changed.notify_all()
+        return batch
+
+    def restore(self, batch):
+        """Вернуть незаписанную пачку, не затирая более новые оценки"""
+        with self.lock:
+            self.pending = {**batch, **self.pending}
+
+    def flush(self):
+        """Записать всё накопленное в бд, вернуть число записанных пар"""
+        with self.flush_lock:
+            batch = self.take()
+            if not batch:
+                return 0
+            try:
+                upsert_ratings(batch)
+            except Exception:
+                self.restore(batch)
+                raise
+            return len(batch)
+
+    def run(self):
+        while True:
+            with self.changed:
+                if not self.closed and len(self.pending) < self.flush_size:
+                    self.changed.wait(self.flush_interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось записать пачку оценок, повтор через %s с", self.flush_interval)
+                time.sleep(self.flush_interval)
+            finally:
+                close_old_connections()
+            if closed:
+                return
+
+    def close(self):
+        """Остановить приём оценок и записать остаток, при ошибке бд - в SPOOL_DIR"""
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.flush_interval + 5)
+        try:
+            return self.flush()
+        except Exception:
+            logger.exception("Не удалось записать оценки при остановке")
+            if self.spool_dir is None:
+                raise
+            return self.spool()
+
+    def spool(self):
+        batch = self.take()
+        if not batch:
+            return 0
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spool_dir / f"ratings-{os.getpid()}-{time.time_ns()}.jsonl"
+        with open(path.with_suffix(".tmp"), "w", encoding="utf-8") as file:
+            for (ip, movie_id), star in batch.items():
+                file.write(json.dumps({"ip": ip, "movie": movie_id, "star": star.pk}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        # переименование атомарно: drain_ratings не увидит недописанный файл
+        path.with_suffix(".tmp").rename(path)
+        logger.warning("%s оценок сохранено в %s", len(batch), path)
+        return len(batch)
+
+
+def get_rating_buffer_config():
+    return {**DEFAULTS, **getattr(settings, "RATING_WRITE_BEHIND", {})}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_rating_buffer():
+    """Буфер оценок процесса или None, если отложенная запись выключена"""
+    global _buffer
+    config = get_rating_buffer_config()
+    if not config["ENABLED"]:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = RatingBuffer(
+                max_size=config["MAX_SIZE"],
+                flush_size=config["FLUSH_SIZE"],
+                flush_interval=config["FLUSH_INTERVAL"],
+                block_timeout=config["BLOCK_TIMEOUT"],
+                spool_dir=config["SPOOL_DIR"],
+            )
+            atexit.register(close_rating_buffer)
+        return _buffer
+
+
+def buffer_ratings(buffer, ip, stars):
+    """Поставить оценки {movie_id: RatingStar} в буфер, вернуть несохранённые Rating"""
+    ratings = []
+    for movie_id, star in stars.items():
+        buffer.add(ip, movie_id, star)
+        ratings.append(Rating(ip=ip, movie_id=movie_id, star=star))
+    return ratings
+
+
+def close_rating_buffer():
+    """Штатная остановка: дописать буфер процесса"""
+    global _buffer
+    with _buffer_lock:
+        buffer, _buffer = _buffer, None
+    if buffer is not None:
+        return buffer.close()
+    return 0
@@ -0,0 +1,248 @@
+"""Индекс фильтров каталога в памяти процесса
+
+Для опубликованных фильмов хранит отсортированный список лет и битовые
+множества по году, жанру, стране и категории. Множество - это int Python,
+бит номер N которого означает фильм в слоте N. Фильтр MovieFilter по жанрам и
+году сводится к нескольким AND/OR над такими числами вместо JOIN по m2m
+с DISTINCT. Пока индекс не построен или устарел, фильтры работают через SQL.
+
+Актуальность сверяется с версией каталога в общем кэше (utils.get_catalog_version):
+изменения через сигналы этот процесс применяет к индексу после коммита, а любое
+другое изменение версии приводит к перестройке индекса целиком.
+"""
+import bisect
+import heapq
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections
+
+from .models import Movie
+from .utils import get_catalog_version
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    # строить индекс в фоновом потоке, а до тех пор отвечать через SQL;
+    # False - строить в запросе, которому индекс понадобился
+    "BACKGROUND_BUILD": True,
+    # больше id в IN (...) не подставляем: такой фильтр отдаётся SQL
+    "MAX_IDS": 5000,
+}
+
+# номера установленных битов каждого значения байта
+BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+class CatalogIndex:
+    """Битовые множества опубликованных фильмов по году, жанру, стране и категории"""
+
+    def __init__(self, background_build=True):
+        self.background_build = background_build
+        self.lock = threading.RLock()
+        # версия каталога, с которой совпадает содержимое индекса
+        self.version = None
+        self.building = False
+        self.clear()
+
+    def clear(self):
+        self.slots = {}
+        self.ids = []
+        # освобождённые слоты, куча: занимаем сначала младшие, чтобы числа не росли
+        self.free = []
+        self.rows = {}
+        self.live = 0
+        self.years = []
+        self.by_year = {}
+        self.by_genre = {}
+        self.by_country = {}
+        self.by_category = {}
+
+    @staticmethod
+    def load(movie_ids=None):
+        """Строки (id, год, страна, категория, жанры) опубликованных фильмов"""
+        movies = Movie.objects.filter(draft=False)
+        links = Movie.genres.through.objects.filter(movie__draft=False)
+        if movie_ids is not None:
+            movies = movies.filter(pk__in=movie_ids)
+            links = links.filter(movie_id__in=movie_ids)
+        genres = defaultdict(set)
+        for movie_id, name in links.values_list("movie_id", "genre__name").iterator():
+            genres[movie_id].add(name)
+        return [
+            (movie_id, (year, country, category_id, frozenset(genres[movie_id])))
+            for movie_id, year, country, category_id in movies.values_list("id", "year", "country", "category_id").iterator()
+        ]
+
+    def build(self):
+        # версия читается до данных: изменение во время загрузки оставит индекс устаревшим
+        version = get_catalog_version()
+        rows = self.load()
+        with self.lock:
+            self.clear()
+            for movie_id, row in rows:
+                self.add(movie_id, row)
+            self.version = version
+
+    def build_in_background(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Не удалось построить индекс фильтров каталога")
+        finally:
+            self.building = False
+            connections.close_all()
+
+    def is_fresh(self):
+        """Актуален ли индекс; если нет - запускает перестройку"""
+        if self.version is not None and self.version == get_catalog_version():
+            return True
+        if not self.background_build:
+            self.build()
+            return True
+        with self.lock:
+            if self.building:
+                return False
+            self.building = True
+        threading.Thread(target=self.build_in_background, name="catalog-index", daemon=True).start()
+        return False
+
+    def add(self, movie_id, row):
+        year, country, category_id, genres = row
+        if self.free:
+            slot = heapq.heappop(self.free)
+            self.ids[slot] = movie_id
+        else:
+            slot = len(self.ids)
+            self.ids.append(movie_id)
+        self.slots[movie_id] = slot
+        self.rows[slot] = row
+        bit = 1 << slot
+        self.live |= bit
+        if year not in self.by_year:
+            bisect.insort(self.years, year)
+        self.by_year[year] = self.by_year.get(year, 0) | bit
+        self.by_country[country] = self.by_country.get(country, 0) | bit
+        self.by_category[category_id] = self.by_category.get(category_id, 0) | bit
+        for genre in genres:
+            self.by_genre[genre] = self.by_genre.get(genre, 0) | bit
+
+    def remove(self, movie_id):
+        # слот займёт следующий добавленный фильм, бит в множествах уже снят
+        slot = self.slots.pop(movie_id, None)
+        if slot is None:
+            return
+        year, country, category_id, genres = self.rows.pop(slot)
+        self.ids[slot] = None
+        heapq.heappush(self.free, slot)
+        mask = ~(1 << slot)
+        self.live &= mask
+        for bitsets, key in (
+            (self.by_year, year), (self.by_country, country), (self.by_category, category_id),
+            *((self.by_genre, genre) for genre in genres),
+        ):
+            bitsets[key] &= mask
+            if not bitsets[key]:
+                del bitsets[key]
+        if year not in self.by_year:
+            self.years.remove(year)
+
+    def refresh(self, movie_ids, version):
+        """Применить закоммиченные изменения фильмов movie_ids этого процесса
+
+        version - версия каталога, которую получило это изменение. Если индекс
+        построен не по предыдущей версии, каталог менялся ещё где-то и частичное
+        обновление не поможет: индекс перестроится при следующем обращении.
+        """
+        movie_ids = set(movie_ids)
+        if self.version is None or self.version != version - 1:
+            return
+        rows = self.load(movie_ids)
+        with self.lock:
+            if self.version != version - 1:
+                return
+            for movie_id in movie_ids:
+                self.remove(movie_id)
+            for movie_id, row in rows:
+                self.add(movie_id, row)
+            self.version = version
+
+    def match(self, genres=None, year_min=None, year_max=None):
+        """Множество фильмов под фильтр: жанры через OR, год - диапазон включительно"""
+        with self.lock:
+            bits = self.live
+            if genres:
+                genre_bits = 0
+                for genre in genres:
+                    genre_bits |= self.by_genre.get(genre, 0)
+                bits &= genre_bits
+            if year_min is not None or year_max is not None:
+                start = 0 if year_min is None else bisect.bisect_left(self.years, year_min)
+                stop = len(self.years) if year_max is None else bisect.bisect_right(self.years, year_max)
+                year_bits = 0
+                for year in self.years[start:stop]:
+                    year_bits |= self.by_year[year]
+                bits &= year_bits
+            return bits
+
+    def to_ids(self, bits):
+        # побайтно с таблицей номеров битов: нулевые байты пропускаются целиком
+        ids = []
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        for position, byte in enumerate(data):
+            if byte:
+                base = position * 8
+                ids.extend(self.ids[base + bit] for bit in BYTE_BITS[byte])
+        return ids
+
+    def facets(self, bits, year_bucket):
+        """Число фильмов множества bits всего и по жанрам, корзинам лет, странам и категориям"""
+        def count(bitsets):
+            counts = {key: (bits & value).bit_count() for key, value in bitsets.items()}
+            return {key: total for key, total in counts.items() if total}
+
+        with self.lock:
+            years = {}
+            for year, total in count(self.by_year).items():
+                bucket = year // year_bucket * year_bucket
+                years[bucket] = years.get(bucket, 0) + total
+            return {
+                "count": bits.bit_count(),
+                "genres": count(self.by_genre),
+                "years": years,
+                "countries": count(self.by_country),
+                "categories": count(self.by_category),
+            }
+
+    def resolve(self, genres=None, year_min=None, year_max=None, limit=None):
+        """id фильмов под фильтр или None, если индекс не готов или фильмов больше limit"""
+        if not self.is_fresh():
+            return None
+        with self.lock:
+            bits = self.match(genres, year_min, year_max)
+            if limit is not None and bits.bit_count() > limit:
+                return None
+            return self.to_ids(bits)
+
+
+def get_catalog_index_config():
+    return {**DEFAULTS, **getattr(settings, "CATALOG_INDEX", {})}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_catalog_index():
+    """Индекс процесса или None, если он выключен настройкой CATALOG_INDEX"""
+    global _index
+    config = get_catalog_index_config()
+    if not config["ENABLED"]:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = CatalogIndex(background_build=config["BACKGROUND_BUILD"])
+        return _index
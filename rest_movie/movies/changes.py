@@ -0,0 +1,159 @@
+"""Лента изменений каталога для зеркал
+
+Изменения фильмов, актёров, отзывов и оценок записываются в журнал
+movies.models.Change: сохранения и удаления - сигналами (movies/signals.py),
+изменения в обход save - вызовом Change.record там, где они делаются.
+Эндпоинт changes/ отдаёт записи журнала после номера since пачками не больше
+MAX_LIMIT. Номер (Change.seq) записи получают перед чтением ленты, уже
+закоммиченными и под блокировкой, поэтому запись из транзакции, которая
+закоммитится позже, получит номер больше выданного зеркалу токена.
+Повторные изменения объекта в пачке схлопываются в одно, а данные берутся из
+текущего состояния объекта: объект, которого уже нет или который не виден в
+API (фильм-черновик), отдаётся как удалённый.
+
+Зеркало берёт токен запросом changes/ без since, затем весь каталог через
+movie/export/ и дальше читает ленту с этого токена.
+
+Журнал растёт с каждым сохранением, поэтому команда compact_changes удаляет
+записи старше RETENTION_DAYS, у объекта которых есть запись новее. Зеркало с
+любым токеном от этого ничего не теряет: данные и так берутся из текущего
+состояния, а последняя запись объекта остаётся. Изменение, пришедшее
+зеркалу как updated, может оказаться первым для объекта: его нужно вставить,
+если объекта ещё нет. В журнале остаётся по записи на объект, включая удалённые.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.utils import timezone
+
+from .export import export_movies, get_export_queryset
+from .models import Actor, Change, Rating, Review
+from .serializers import ActorDetailSerializer, MovieExportSerializer
+
+DEFAULTS = {
+    "LIMIT": 500,
+    "MAX_LIMIT": 1000,
+    # сколько записей журнала нумеровать за раз; остальные - при следующем чтении
+    "SEQUENCE_BATCH": 10000,
+    # compact_changes не трогает записи моложе стольких дней
+    "RETENTION_DAYS": 30,
+}
+
+# ключ pg_advisory_xact_lock нумерации журнала
+SEQUENCE_LOCK = 0x6D6F7669  # "movi"
+
+
+def get_change_feed_config():
+    return {**DEFAULTS, **getattr(settings, "CHANGE_FEED", {})}
+
+
+def get_movie_payloads(ids, context):
+    serializer = MovieExportSerializer(context=context)
+    rows = list(get_export_queryset(serializer).filter(pk__in=ids))
+    return {movie["id"]: movie for movie in export_movies(serializer, rows)} if rows else {}
+
+
+def get_actor_payloads(ids, context):
+    actors = ActorDetailSerializer(Actor.objects.filter(pk__in=ids), many=True, context=context).data
+    return {actor["id"]: actor for actor in actors}
+
+
+def get_review_payloads(ids, context):
+    # email автора отзыва в API не выводится
+    return {
+        pk: {"id": pk, "movie": movie_id, "parent": parent_id, "name": name, "text": text}
+        for pk, movie_id, parent_id, name, text in Review.objects.filter(pk__in=ids)
+        .values_list("pk", "movie_id", "parent_id", "name", "text")
+    }
+
+
+def get_rating_payloads(ids, context):
+    return {
+        pk: {"id": pk, "movie": movie_id, "star": star}
+        for pk, movie_id, star in Rating.objects.filter(pk__in=ids).values_list("pk", "movie_id", "star__value")
+    }
+
+
+# модель журнала -> {id: данные} видимых в API объектов, по запросу на модель
+PAYLOADS = {
+    "movie": get_movie_payloads,
+    "actor": get_actor_payloads,
+    "review": get_review_payloads,
+    "rating": get_rating_payloads,
+}
+
+
+def sequence_changes(using=DEFAULT_DB_ALIAS):
+    """Пронумеровать видимые (закоммиченные) записи журнала без номера
+
+    Нумерации идут по одной: в PostgreSQL под advisory-блокировкой, SQLite и
+    так пускает одного писателя. Следующая нумерация начинается после коммита
+    предыдущей и видит её номера, поэтому номера видны в порядке возрастания.
+    """
+    batch = get_change_feed_config()["SEQUENCE_BATCH"]
+    changes = Change.objects.using(using)
+    with transaction.atomic(using=using):
+        connection = connections[using]
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [SEQUENCE_LOCK])
+        pending = list(changes.filter(seq__isnull=True).order_by("pk").only("pk")[:batch])
+        if not pending:
+            return
+        last = changes.aggregate(last=models.Max("seq"))["last"] or 0
+        for seq, change in enumerate(pending, last + 1):
+            change.seq = seq
+        changes.bulk_update(pending, ["seq"], batch_size=1000)
+
+
+def compact_changes(batch_size=1000):
+    """Удалить старые записи журнала, у объекта которых есть запись новее
+
+    Возвращает число удалённых записей.
+    """
+    cutoff = timezone.now() - timedelta(days=get_change_feed_config()["RETENTION_DAYS"])
+    newer = Change.objects.filter(
+        model=models.OuterRef("model"), object_id=models.OuterRef("object_id"), seq__gt=models.OuterRef("seq")
+    )
+    superseded = Change.objects.filter(seq__isnull=False, created__lt=cutoff).filter(models.Exists(newer))
+    deleted = 0
+    while True:
+        ids = list(superseded.order_by("seq").values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += Change.objects.filter(pk__in=ids).delete()[0]
+
+
+def get_feed_token():
+    """Токен текущего конца ленты"""
+    sequence_changes()
+    return str(Change.objects.aggregate(last=models.Max("seq"))["last"] or 0)
+
+
+def get_changes(since, limit, context=None):
+    """Изменения после номера since: не больше limit записей журнала"""
+    sequence_changes()
+    entries = list(
+        Change.objects.filter(seq__gt=since).order_by("seq")
+        .values_list("seq", "model", "object_id", "action")[:limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # (модель, id) -> (номер последнего изменения, создан ли объект в этой пачке)
+    latest = {}
+    for seq, model, object_id, action in entries:
+        _, created = latest.pop((model, object_id), (None, False))
+        latest[(model, object_id)] = (seq, created or action == Change.CREATED)
+    ids = {}
+    for model, object_id in latest:
+        ids.setdefault(model, []).append(object_id)
+    payloads = {model: PAYLOADS[model](model_ids, context) for model, model_ids in ids.items()}
+
+    changes = []
+    for (model, object_id), (seq, created) in latest.items():
+        data = payloads[model].get(object_id)
+        action = Change.DELETED if data is None else Change.CREATED if created else Change.UPDATED
+        changes.append({"seq": seq, "model": model, "id": object_id, "action": action, "data": data})
+    return {"changes": changes, "next": str(entries[-1][0] if entries else since), "has_more": has_more}
@@ -0,0 +1,132 @@
+"""Фильмография актёра, сохранённая в Actor.filmography
+
+Страница актёра отдаёт её одним запросом по id, без обхода связей
+Movie.actors и Movie.directors. Сводка пересчитывается сигналами
+(movies/signals.py) при изменении связей фильма с актёрами и режиссёрами,
+названия, года, публикации и рейтинга фильма; оценки через upsert_ratings и
+действия админки пересчитывают её сами. После загрузки в обход сигналов -
+командой rebuild_filmography.
+
+Изменения фильмов пересчитывают сводки после коммита (refresh_filmography):
+транзакция фильма держит блокировки его строки, а пересчёт блокирует строки
+актёров, сохранение же актёра (signals.actor_changed) берёт их в обратном
+порядке, и две такие транзакции ждали бы друг друга. Если пересчёт после
+коммита не удался, сводку вернёт rebuild_filmography.
+
+В сводку входят только опубликованные фильмы:
+{"acting": [роль], "directing": [роль], "stats": {...}}, где роль -
+{"id", "title", "year", "rating"}, от новых фильмов к старым, а rating -
+средняя оценка фильма или null без оценок.
+"""
+from functools import partial
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Actor, Change, Movie, empty_filmography
+
+# раздел сводки -> промежуточная таблица связи
+ROLES = {
+    "acting": Movie.actors.through,
+    "directing": Movie.directors.through,
+}
+
+
+def get_movie_actor_ids(movie_ids, using="default"):
+    """id актёров и режиссёров фильмов movie_ids, одним запросом"""
+    acting, directing = (
+        through.objects.using(using).filter(movie_id__in=movie_ids).values_list("actor_id", flat=True)
+        for through in ROLES.values()
+    )
+    return set(acting.union(directing))
+
+
+def get_credit_rating(rating_sum, rating_count):
+    """Средняя оценка фильма, как она записана в фильмографии"""
+    return round(rating_sum / rating_count, 2) if rating_count else None
+
+
+def build_filmography(actor_ids, using="default"):
+    """{id актёра: сводка} для actor_ids, запрос на каждую роль"""
+    summaries = {actor_id: empty_filmography() for actor_id in actor_ids}
+    movies = {}
+    for role, through in ROLES.items():
+        rows = (
+            through.objects.using(using)
+            .filter(actor_id__in=summaries, movie__draft=False)
+            .values_list(
+                "actor_id", "movie_id", "movie__title", "movie__year", "movie__rating_sum", "movie__rating_count"
+            )
+        )
+        for actor_id, movie_id, title, year, rating_sum, rating_count in rows:
+            rating = get_credit_rating(rating_sum, rating_count)
+            summaries[actor_id][role].append({"id": movie_id, "title": title, "year": year, "rating": rating})
+            movies.setdefault(actor_id, {})[movie_id] = (year, rating)
+
+    for actor_id, summary in summaries.items():
+        for role in ROLES:
+            summary[role].sort(key=lambda credit: (credit["year"], credit["id"]), reverse=True)
+        credits = movies.get(actor_id, {})
+        if not credits:
+            continue
+        years = [year for year, _ in credits.values()]
+        ratings = [rating for _, rating in credits.values() if rating is not None]
+        summary["stats"] = {
+            "movies": len(credits),
+            "first_year": min(years),
+            "last_year": max(years),
+            # средняя по фильмам с оценками, фильм актёра и режиссёра считается один раз
+            "average_rating": round(sum(ratings) / len(ratings), 2) if ratings else None,
+        }
+    return summaries
+
+
+def update_filmography(actor_ids=None, batch_size=1000):
+    """Пересчитать сводки актёров actor_ids (None - всех), возвращает число изменённых
+
+    Записываются только изменившиеся сводки: у них поднимается версия (ETag
+    страницы актёра) и появляется запись в журнале изменений. Строки актёров
+    блокируются до чтения фильмов в порядке id: две транзакции с общими
+    актёрами (оценки разных фильмов) не перезапишут сводку устаревшей.
+    """
+    if actor_ids is None:
+        actor_ids = Actor.objects.order_by("pk").values_list("pk", flat=True)
+    actor_ids = list(actor_ids)
+    updated = 0
+    for start in range(0, len(actor_ids), batch_size):
+        batch = actor_ids[start:start + batch_size]
+        with transaction.atomic():
+            actors = list(
+                Actor.objects.select_for_update().filter(pk__in=batch).only("id", "version", "filmography").order_by("pk")
+            )
+            summaries = build_filmography([actor.pk for actor in actors])
+            now = timezone.now()
+            changed = []
+            for actor in actors:
+                if actor.filmography != summaries[actor.pk]:
+                    actor.filmography = summaries[actor.pk]
+                    actor.version += 1
+                    actor.updated = now
+                    changed.append(actor)
+            if changed:
+                Actor.objects.bulk_update(changed, ["filmography", "version", "updated"])
+                Change.record(Actor, [actor.pk for actor in changed], Change.UPDATED)
+                updated += len(changed)
+    return updated
+
+
+def update_movie_filmography(movie_ids):
+    """Пересчитать сводки актёров и режиссёров фильмов movie_ids"""
+    return update_filmography(get_movie_actor_ids(movie_ids))
+
+
+def refresh_filmography(actor_ids):
+    """Пересчитать сводки actor_ids после коммита текущей транзакции"""
+    if actor_ids:
+        transaction.on_commit(partial(update_filmography, sorted(set(actor_ids))))
+
+
+def refresh_movie_filmography(movie_ids):
+    """Пересчитать после коммита сводки актёров и режиссёров фильмов movie_ids"""
+    if movie_ids:
+        transaction.on_commit(partial(update_movie_filmography, sorted(set(movie_ids))))
@@ -0,0 +1,223 @@
+"""Уменьшенные копии постеров, фото актёров и кадров из фильмов
+
+Оригиналы загружаются как есть, а для ответов API и миниатюр админки
+готовятся копии по размерам IMAGE_VARIANTS["SIZES"]. Имя копии - хэш
+содержимого оригинала и параметров копии, поэтому одинаковые файлы не
+пересчитываются, а новый файл всегда получает новый адрес и копии можно
+кэшировать без срока. Имена копий хранятся в поле <поле>_variants модели.
+
+Копии загруженного файла готовятся после коммита (movies/signals.py): задачи
+идут в ограниченную очередь потоков, а изображения уменьшает пул процессов.
+Копии уже загруженных файлов и тех, что не влезли в очередь, готовит команда
+build_image_variants. Копии прежнего изображения удаляются из хранилища, когда
+записаны новые и на них не ссылается другая запись.
+"""
+import hashlib
+import logging
+import multiprocessing
+import posixpath
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, models
+from django.utils import timezone
+
+from .imaging import render_variants
+from .models import Actor, Change, Movie, MovieShots, VersionedModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    # готовить копии в фоне после ответа; False - сразу, в потоке запроса
+    "BACKGROUND": True,
+    # процессов в пуле, который уменьшает изображения, и потоков, которые ждут его
+    "WORKERS": 2,
+    # сколько загрузок процесс держит в очереди; остальные ждут build_image_variants
+    "MAX_PENDING": 100,
+    "FORMAT": "WEBP",
+    "QUALITY": 80,
+    # вариант -> рамка (ширина, высота), в которую вписывается копия
+    "SIZES": {"thumb": (120, 160), "small": (320, 480), "medium": (640, 960)},
+}
+
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+
+# модель -> поле изображения; имена копий лежат в поле <поле>_variants
+IMAGE_FIELDS = {Actor: "image", Movie: "poster", MovieShots: "image"}
+
+
+def get_image_variants_config():
+    return {**DEFAULTS, **getattr(settings, "IMAGE_VARIANTS", {})}
+
+
+def get_variants_field(field):
+    return f"{field}_variants"
+
+
+def get_image_field(variants_field):
+    return variants_field.removesuffix("_variants")
+
+
+def get_variant_name(field, data, variant, size, config):
+    """Имя копии: каталог загрузки поля, variants/ и хэш оригинала с параметрами копии"""
+    digest = hashlib.sha256(data)
+    digest.update(f"{variant}:{size[0]}x{size[1]}:{config['FORMAT']}:{config['QUALITY']}".encode())
+    digest = digest.hexdigest()[:32]
+    extension = EXTENSIONS.get(config["FORMAT"], config["FORMAT"].lower())
+    return posixpath.join(field.upload_to, "variants", digest[:2], f"{digest}-{variant}.{extension}")
+
+
+def read_image(file):
+    """Содержимое оригинала или None, если файла нет в хранилище"""
+    if not file:
+        return None
+    try:
+        file.open("rb")
+    except (FileNotFoundError, OSError):
+        logger.warning("Нет файла изображения %s", file.name)
+        return None
+    try:
+        return file.read()
+    finally:
+        file.close()
+
+
+def plan_variants(instance, field, config):
+    """(оригинал, {вариант: имя}, {вариант: размер ещё не готовых копий}, данные) или None"""
+    file = getattr(instance, field)
+    data = read_image(file)
+    if data is None:
+        return None
+    model_field = instance._meta.get_field(field)
+    names, missing = {}, {}
+    for variant, size in config["SIZES"].items():
+        names[variant] = get_variant_name(model_field, data, variant, size, config)
+        if not model_field.storage.exists(names[variant]):
+            missing[variant] = tuple(size)
+    return file.name, names, missing, data
+
+
+def save_variants(model, pk, field, source, names, rendered):
+    """Записать готовые копии в хранилище и их имена в запись, если оригинал не сменился"""
+    storage = model._meta.get_field(field).storage
+    for variant, content in rendered.items():
+        if not storage.exists(names[variant]):
+            names[variant] = storage.save(names[variant], ContentFile(content))
+    variants_field = get_variants_field(field)
+    values = {variants_field: names}
+    if issubclass(model, VersionedModel):
+        # адреса копий входят в ответ, ETag должен смениться
+        values.update(version=models.F("version") + 1, updated=timezone.now())
+    previous = model.objects.filter(pk=pk).values_list(variants_field, flat=True).first() or {}
+    if not model.objects.filter(pk=pk, **{field: source}).update(**values):
+        return False
+    # update не шлёт post_save, в журнал изменений пишем сами
+    Change.record(model, [pk], Change.UPDATED)
+    if model is Actor:
+        # фото актёра выводится в ответе его фильмов, как в signals.actor_changed
+        Movie.touch(models.Q(actors=pk) | models.Q(directors=pk))
+    delete_unused_variants(model, field, previous, names)
+    return True
+
+
+def delete_unused_variants(model, field, previous, names):
+    """Удалить копии прежнего изображения, на которые не ссылается ни одна запись
+
+    Имя копии - хэш содержимого, поэтому у записей с одинаковыми файлами копии
+    общие. Если другая запись сошлётся на удалённую копию одновременно с
+    удалением, build_image_variants приготовит её заново.
+    """
+    storage = model._meta.get_field(field).storage
+    variants_field = get_variants_field(field)
+    for variant, name in previous.items():
+        if name == names.get(variant):
+            continue
+        if model.objects.filter(**{f"{variants_field}__{variant}": name}).exists():
+            continue
+        storage.delete(name)
+
+
+def build_variants(instance, field, config=None, pool=None):
+    """Подготовить копии изображения записи; pool - пул процессов, None - в текущем"""
+    config = config or get_image_variants_config()
+    plan = plan_variants(instance, field, config)
+    if plan is None:
+        return False
+    source, names, missing, data = plan
+    rendered = {}
+    if missing:
+        args = (data, missing, config["FORMAT"], config["QUALITY"])
+        rendered = pool.submit(render_variants, *args).result() if pool else render_variants(*args)
+    return save_variants(type(instance), instance.pk, field, source, names, rendered)
+
+
+def build_in_background(model, pk, field):
+    try:
+        instance = model.objects.filter(pk=pk).first()
+        if instance is not None:
+            build_variants(instance, field, pool=get_image_pool())
+    except Exception:
+        logger.exception("Не удалось подготовить копии изображения %s %s", model.__name__, pk)
+    finally:
+        connections.close_all()
+
+
+def schedule_variants(instance, field):
+    """Подготовить копии только что загруженного изображения, см. IMAGE_VARIANTS"""
+    config = get_image_variants_config()
+    if not config["ENABLED"]:
+        return
+    if not config["BACKGROUND"]:
+        build_variants(instance, field, config)
+        return
+    executor, pending = get_image_executor()
+    if not pending.acquire(blocking=False):
+        logger.warning(
+            "Очередь копий изображений полна: %s %s ждёт build_image_variants", type(instance).__name__, instance.pk
+        )
+        return
+    future = executor.submit(build_in_background, type(instance), instance.pk, field)
+    future.add_done_callback(lambda future: pending.release())
+
+
+def get_variant_url(instance, field, variant):
+    """Адрес копии, а пока её нет - оригинала"""
+    name = getattr(instance, get_variants_field(field)).get(variant)
+    if name:
+        return instance._meta.get_field(field).storage.url(name)
+    file = getattr(instance, field)
+    return file.url if file else None
+
+
+def create_image_pool(workers):
+    # spawn: рабочим процессам не достаются потоки и соединения с бд родителя
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+_pending = None
+
+
+def get_image_pool():
+    """Пул процессов для уменьшения изображений, один на процесс"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_image_pool(get_image_variants_config()["WORKERS"])
+        return _pool
+
+
+def get_image_executor():
+    """Потоки фоновых задач копий и семафор их очереди, одни на процесс"""
+    global _executor, _pending
+    with _pool_lock:
+        if _executor is None:
+            config = get_image_variants_config()
+            _executor = ThreadPoolExecutor(max_workers=config["WORKERS"], thread_name_prefix="image-variants")
+            _pending = threading.BoundedSemaphore(config["MAX_PENDING"])
+        return _executor, _pending
@@ -0,0 +1,30 @@
+"""Уменьшение изображений для movies.images
+
+Модуль не зависит от Django: его функции выполняются в процессах пула,
+запущенных через spawn, которым не нужны настройки и приложения проекта.
+"""
+import io
+
+from PIL import Image, ImageOps
+
+
+def render_variants(data, sizes, image_format, quality):
+    """Уменьшенные копии изображения data: {вариант: байты}
+
+    sizes - {вариант: (ширина, высота)}, копия вписывается в эту рамку с
+    сохранением пропорций и никогда не увеличивается.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        mode = "RGBA" if alpha and image_format != "JPEG" else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
+        variants = {}
+        for variant, size in sizes.items():
+            copy = image.copy()
+            copy.thumbnail(size, Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            copy.save(output, image_format, quality=quality, optimize=True)
+            variants[variant] = output.getvalue()
+        return variants
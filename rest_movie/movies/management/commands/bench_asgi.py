@@ -0,0 +1,148 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import AsyncClient, Client, override_settings
+
+from movies.async_urls import urlpatterns
+from movies.models import Actor, Movie
+
+from .bench_endpoints import percentile
+
+SYNC_PREFIX = "/api/v1/"
+ASYNC_PREFIX = "/api/async/v1/"
+# режим -> (сервер, префикс маршрутов)
+MODES = {
+    "wsgi": ("wsgi", SYNC_PREFIX),
+    "asgi-sync": ("asgi", SYNC_PREFIX),
+    "asgi-async": ("asgi", ASYNC_PREFIX),
+}
+
+
+class Command(BaseCommand):
+    """Пропускная способность эндпоинтов чтения через WSGI и ASGI при параллельных клиентах"""
+
+    help = (
+        "Гоняет маршруты movies/async_urls.py параллельными клиентами: синхронные представления "
+        "через WSGI (поток на клиента) и через ASGI, асинхронные - через ASGI (задача на клиента). "
+        "Каталог готовит seed_catalog, для замеров на PostgreSQL запускать с настройками продакшена"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32], help="число параллельных клиентов")
+        parser.add_argument("--requests", type=int, default=200, help="запросов на сценарий и режим")
+        parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--no-cache", action="store_true", help="без кэша списков и индекса каталога")
+        parser.add_argument("--output", help="файл для JSON результата, - для stdout")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        movie_ids = list(Movie.objects.filter(draft=False).values_list("id", flat=True)[:1000])
+        actor_ids = list(Actor.objects.values_list("id", flat=True)[:1000])
+        if not movie_ids or not actor_ids:
+            raise CommandError("Каталог пуст, сначала запустите seed_catalog")
+        count = options["requests"]
+        # маршрут -> пути запросов без префикса, одинаковые для всех режимов
+        scenarios = {
+            "movie/": ["movie/"] * count,
+            "movie/<int:pk>/": [f"movie/{rng.choice(movie_ids)}/" for _ in range(count)],
+            "actors/": ["actors/"] * count,
+            "actors/<int:pk>/": [f"actors/{rng.choice(actor_ids)}/" for _ in range(count)],
+        }
+        missing = {str(pattern.pattern) for pattern in urlpatterns} - set(scenarios)
+        if missing:
+            raise CommandError(f"Нет сценария для маршрутов: {', '.join(sorted(missing))}")
+
+        overrides = {"ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"]}
+        if options["no_cache"]:
+            overrides["CACHES"] = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+            overrides["CATALOG_INDEX"] = {"ENABLED": False}
+        results = []
+        with override_settings(**overrides):
+            for route, paths in scenarios.items():
+                for mode in options["modes"]:
+                    server, prefix = MODES[mode]
+                    for clients in options["clients"]:
+                        urls = [prefix + path for path in paths]
+                        if server == "wsgi":
+                            latencies, elapsed = self.run_wsgi(urls, clients)
+                        else:
+                            latencies, elapsed = asyncio.run(self.run_asgi(urls, clients))
+                        results.append(self.summarize(route, mode, clients, latencies, elapsed))
+                        self.write_row(results[-1])
+
+        report = {"meta": {"database": connection.vendor, "requests": count, "no_cache": options["no_cache"]}, "results": results}
+        if options["output"] == "-":
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        elif options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+
+    def run_wsgi(self, urls, clients):
+        """Поток на клиента, как у многопоточного WSGI-сервера"""
+        local = threading.local()
+
+        def fetch(url):
+            if not hasattr(local, "client"):
+                local.client = Client()
+            started = time.perf_counter()
+            response = local.client.get(url)
+            self.check_response(url, response)
+            return time.perf_counter() - started
+
+        def close(_):
+            connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            started = time.perf_counter()
+            latencies = list(pool.map(fetch, urls))
+            elapsed = time.perf_counter() - started
+            list(pool.map(close, range(clients)))
+        return latencies, elapsed
+
+    async def run_asgi(self, urls, clients):
+        """Задача на клиента в одном цикле событий, как у ASGI-сервера"""
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(clients)
+
+        async def fetch(url):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get(url)
+                self.check_response(url, response)
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(fetch(url) for url in urls))
+        return latencies, time.perf_counter() - started
+
+    @staticmethod
+    def check_response(url, response):
+        if response.status_code != 200:
+            raise CommandError(f"{url}: {response.status_code}")
+
+    @staticmethod
+    def summarize(route, mode, clients, latencies, elapsed):
+        latencies = [latency * 1000 for latency in latencies]
+        return {
+            "route": route,
+            "mode": mode,
+            "clients": clients,
+            "requests": len(latencies),
+            "rps": round(len(latencies) / elapsed, 1),
+            "latency_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+        }
+
+    def write_row(self, result):
+        latency = result["latency_ms"]
+        self.stderr.write(
+            f"{result['route']:<18} {result['mode']:<10} clients {result['clients']:>3}  "
+            f"{result['rps']:>8.1f} req/s  p50 {latency['p50']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms"
+        )
@@ -0,0 +1,174 @@
+import json
+import math
+import platform
+import random
+import time
+from urllib.parse import quote
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from movies.models import Actor, Movie, RatingStar
+from movies.urls import urlpatterns
+
+API_PREFIX = "/api/v1/"
+
+
+class Command(BaseCommand):
+    """Замер задержки, числа запросов и размера ответа всех маршрутов movies/urls.py"""
+
+    help = (
+        "Гоняет каждый маршрут movies/urls.py на текущей базе (см. seed_catalog) и выводит "
+        "перцентили задержки, число запросов к бд и размер ответа. --output пишет JSON для сравнения коммитов"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=50, help="запросов на сценарий")
+        parser.add_argument("--warmup", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--cold", action="store_true", help="очищать кэш перед каждым запросом")
+        parser.add_argument("--output", help="файл для JSON результата, - для stdout")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        # Хост из ALLOWED_HOSTS (при DEBUG и пустом списке разрешён localhost),
+        # чтобы запросы не падали на проверке заголовка Host
+        hosts = [host for host in settings.ALLOWED_HOSTS if host != "*" and not host.startswith(".")]
+        self.client = Client(SERVER_NAME=hosts[0] if hosts else "localhost")
+        scenarios = self.get_scenarios()
+        missing = {str(pattern.pattern) for pattern in urlpatterns} - {route for route, *_ in scenarios}
+        if missing:
+            raise CommandError(f"Нет сценария для маршрутов: {', '.join(sorted(missing))}")
+
+        results = {}
+        for route, name, method, make_request in scenarios:
+            results[name] = self.run_scenario(route, method, make_request, options)
+            self.write_row(name, results[name])
+
+        report = {"meta": self.get_meta(options), "endpoints": results}
+        if options["output"] == "-":
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        elif options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+
+    def get_scenarios(self):
+        """(маршрут, имя сценария, метод, функция номера запроса -> (путь, данные, заголовки))"""
+        published = Movie.objects.filter(draft=False)
+        movie_ids = list(published.values_list("id", flat=True)[:1000])
+        actor_ids = list(Actor.objects.values_list("id", flat=True)[:1000])
+        star_ids = list(RatingStar.objects.values_list("id", flat=True))
+        if not movie_ids or not actor_ids or not star_ids:
+            raise CommandError("Каталог пуст, сначала запустите seed_catalog")
+        popular = published.annotate(total=models.Count("reviews")).order_by("-total").values_list("id", flat=True)[0]
+        genres = ",".join(published.values_list("genres__name", flat=True).distinct()[:2])
+        rng = self.rng
+
+        def get(path):
+            return lambda i: (path, None, {})
+
+        return [
+            ("movie/", "GET movie/", "get", get("movie/")),
+            ("movie/", "GET movie/?ordering=-rating", "get", get("movie/?ordering=-rating")),
+            ("movie/", "GET movie/?genres&year", "get", get(f"movie/?genres={genres}&year_min=1990&year_max=2010")),
+            ("movie/", "GET movie/?search", "get", lambda i: (f"movie/?search={quote(f'фильм {rng.randint(1, 99)}')}", None, {})),
+            ("movie/facets/", "GET movie/facets/", "get", get("movie/facets/")),
+            ("movie/facets/", "GET movie/facets/?genres&year", "get", get(f"movie/facets/?genres={genres}&year_min=1990")),
+            ("movie/export/", "GET movie/export/ NDJSON", "get", get("movie/export/")),
+            ("movie/<int:pk>/", "GET movie/<pk>/ popular", "get", get(f"movie/{popular}/")),
+            ("movie/<int:pk>/", "GET movie/<pk>/", "get", lambda i: (f"movie/{rng.choice(movie_ids)}/", None, {})),
+            # записи с разных ip, чтобы замер не упирался в movies.throttling
+            ("review/", "POST review/", "post", lambda i: ("review/", {
+                "email": "bench@example.com", "name": "bench", "text": "-", "movie": rng.choice(movie_ids),
+            }, {"REMOTE_ADDR": f"172.18.{i // 256 % 256}.{i % 256}"})),
+            ("rating/", "POST rating/", "post", lambda i: ("rating/", {
+                "star": rng.choice(star_ids), "movie": rng.choice(movie_ids),
+            }, {"REMOTE_ADDR": f"172.16.{i // 256 % 256}.{i % 256}"})),
+            ("rating/bulk/", "POST rating/bulk/ x50", "post", lambda i: ("rating/bulk/", json.dumps({"ratings": [
+                {"star": rng.choice(star_ids), "movie": movie_id}
+                for movie_id in rng.sample(movie_ids, min(50, len(movie_ids)))
+            ]}), {"REMOTE_ADDR": f"172.17.{i // 256 % 256}.{i % 256}", "content_type": "application/json"})),
+            ("actors/", "GET actors/", "get", get("actors/")),
+            ("actors/<int:pk>/", "GET actors/<pk>/", "get", lambda i: (f"actors/{rng.choice(actor_ids)}/", None, {})),
+            ("changes/", "GET changes/?since", "get", get("changes/?since=0")),
+        ]
+
+    def run_scenario(self, route, method, make_request, options):
+        latencies, queries, sizes, statuses, timings = [], [], [], set(), []
+        for i in range(options["warmup"] + options["requests"]):
+            path, data, headers = make_request(i)
+            if options["cold"]:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(self.client, method)(API_PREFIX + path, data, **headers)
+                content = b"".join(response) if response.streaming else response.content
+                elapsed = time.perf_counter() - started
+            if i < options["warmup"]:
+                continue
+            latencies.append(elapsed * 1000)
+            queries.append(len(captured))
+            sizes.append(len(content))
+            statuses.add(response.status_code)
+            timings.append(parse_server_timing(response.get("Server-Timing", "")))
+        return {
+            "route": route,
+            "status": sorted(statuses),
+            "requests": len(latencies),
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "mean": round(sum(latencies) / len(latencies), 3),
+                "max": round(max(latencies), 3),
+            },
+            "queries": {"min": min(queries), "max": max(queries)},
+            # средние по Server-Timing (movies.metrics), если заголовок есть
+            "server_timing_ms": {
+                name: round(sum(timing.get(name, 0) for timing in timings) / len(timings), 3)
+                for name in sorted({name for timing in timings for name in timing})
+            },
+            "bytes": {"min": min(sizes), "max": max(sizes)},
+        }
+
+    def get_meta(self, options):
+        return {
+            "database": connection.vendor,
+            "movies": Movie.objects.count(),
+            "actors": Actor.objects.count(),
+            "requests": options["requests"],
+            "cold_cache": options["cold"],
+            "python": platform.python_version(),
+            "django": django.get_version(),
+        }
+
+    def write_row(self, name, result):
+        latency = result["latency_ms"]
+        self.stderr.write(
+            f"{name:<32} p50 {latency['p50']:>8.2f} ms  p90 {latency['p90']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms  "
+            f"queries {result['queries']['max']:>3}  db {result['server_timing_ms'].get('db', 0):>7.2f} ms  bytes {result['bytes']['max']:>8}  status {result['status']}"
+        )
+
+
+def parse_server_timing(header):
+    """{метрика: dur} из заголовка Server-Timing"""
+    timings = {}
+    for entry in filter(None, (entry.strip() for entry in header.split(","))):
+        name, *params = entry.split(";")
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name.strip()] = float(value)
+    return timings
+
+
+def percentile(values, percent):
+    """Перцентиль методом ближайшего ранга"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return round(ordered[rank - 1], 3)
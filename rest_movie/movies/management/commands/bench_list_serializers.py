@@ -0,0 +1,86 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+
+from movies.models import Actor, Movie
+from movies.serializers import (
+    ActorListSerializer,
+    ActorValuesSerializer,
+    MovieListSerializer,
+    MovieValuesSerializer,
+)
+
+
+class Command(BaseCommand):
+    """Сравнение ModelSerializer и быстрых сериализаторов списков"""
+
+    help = "Замеряет вывод списков фильмов и актёров обычным и быстрым сериализатором"
+
+    def add_arguments(self, parser):
+        parser.add_argument("rows", nargs="*", type=int, default=[10_000, 100_000])
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        # Строки собираются в памяти: замеряется только сериализация, без бд
+        context = {"request": RequestFactory().get("/api/v1/movie/")}
+        for rows in options["rows"]:
+            movie_rows = [self.movie_row(i) for i in range(rows)]
+            movies = [self.movie_instance(row) for row in movie_rows]
+            actor_rows = [self.actor_row(i) for i in range(rows)]
+            actors = [Actor(**row) for row in actor_rows]
+            self.compare(
+                f"movies x{rows}", options["repeat"],
+                lambda: MovieListSerializer(movies, many=True, context=context).data,
+                lambda: MovieValuesSerializer(context).to_representation(movie_rows),
+            )
+            self.compare(
+                f"actors x{rows}", options["repeat"],
+                lambda: ActorListSerializer(actors, many=True, context=context).data,
+                lambda: ActorValuesSerializer(context).to_representation(actor_rows),
+            )
+
+    @staticmethod
+    def actor_row(i):
+        image = f"actors/{i}.jpg" if i % 5 else ""
+        variants = {"thumb": f"actors/variants/{i:02}/{i}-thumb.webp", "small": f"actors/variants/{i:02}/{i}-small.webp"}
+        return {"id": i, "name": f"actor {i}", "image": image, "image_variants": variants if i % 2 else {}}
+
+    @staticmethod
+    def movie_row(i):
+        return {
+            "id": i,
+            "title": f"movie {i}",
+            "tagline": "слоган",
+            "category_id": i % 7 or None,
+            "rating_user": bool(i % 2),
+            "middle_star": i % 5 or None,
+        }
+
+    @staticmethod
+    def movie_instance(row):
+        movie = Movie(id=row["id"], title=row["title"], tagline=row["tagline"], category_id=row["category_id"])
+        movie.rating_user = row["rating_user"]
+        movie.middle_star = row["middle_star"]
+        return movie
+
+    def compare(self, name, repeat, model_serializer, values_serializer):
+        renderer = JSONRenderer()
+        timings = {}
+        output = {}
+        for label, serialize in (("model", model_serializer), ("values", values_serializer)):
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                data = serialize()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[label] = best
+            output[label] = renderer.render(data)
+        if output["model"] != output["values"]:
+            raise CommandError(f"{name}: JSON быстрого сериализатора отличается")
+        self.stdout.write(
+            f"{name}: model {timings['model'] * 1000:.1f} ms, values {timings['values'] * 1000:.1f} ms, "
+            f"x{timings['model'] / timings['values']:.1f}"
+        )
@@ -0,0 +1,79 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from movies.images import (
+    IMAGE_FIELDS, create_image_pool, get_image_variants_config, get_variants_field, plan_variants, save_variants,
+)
+from movies.imaging import render_variants
+
+MODELS = {model._meta.model_name: model for model in IMAGE_FIELDS}
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Уменьшенные копии уже загруженных постеров, фото актёров и кадров"""
+
+    help = (
+        "Готовит копии изображений по IMAGE_VARIANTS['SIZES'] для записей, у которых их нет "
+        "или набор вариантов устарел. Изображения уменьшаются в пуле процессов"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS))
+        parser.add_argument("--force", action="store_true", help="проверить копии всех записей")
+        parser.add_argument("--workers", type=int, help="по умолчанию IMAGE_VARIANTS['WORKERS']")
+        parser.add_argument("--window", type=int, default=32, help="сколько изображений уменьшается одновременно")
+
+    def handle(self, *args, **options):
+        config = get_image_variants_config()
+        sizes = set(config["SIZES"])
+        built = skipped = missing = failed = 0
+        with create_image_pool(options["workers"] or config["WORKERS"]) as pool:
+            for name in options["models"]:
+                model = MODELS[name]
+                field = IMAGE_FIELDS[model]
+                variants_field = get_variants_field(field)
+                pending = []
+                queryset = model.objects.exclude(**{field: ""}).only("pk", field, variants_field).order_by("pk")
+                for instance in queryset.iterator(chunk_size=500):
+                    if not options["force"] and set(getattr(instance, variants_field)) == sizes:
+                        skipped += 1
+                        continue
+                    plan = plan_variants(instance, field, config)
+                    if plan is None:
+                        missing += 1
+                        continue
+                    source, names, sizes_left, data = plan
+                    future = None
+                    if sizes_left:
+                        future = pool.submit(render_variants, data, sizes_left, config["FORMAT"], config["QUALITY"])
+                    pending.append((instance.pk, source, names, future))
+                    if len(pending) >= options["window"]:
+                        saved, errors = self.save(model, field, pending)
+                        built, failed = built + saved, failed + errors
+                        pending = []
+                saved, errors = self.save(model, field, pending)
+                built, failed = built + saved, failed + errors
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово копий: {built}, уже были: {skipped}, нет оригинала: {missing}, ошибок: {failed}"
+        ))
+
+    @staticmethod
+    def save(model, field, pending):
+        """Записать готовые копии окна: (сколько записано, сколько не удалось)
+
+        Ошибка одной записи (битый файл, который Pillow не открывает) не
+        прерывает остальные, как и в movies.images.build_in_background.
+        """
+        saved = failed = 0
+        for pk, source, names, future in pending:
+            try:
+                rendered = future.result() if future else {}
+                saved += save_variants(model, pk, field, source, names, rendered)
+            except Exception:
+                logger.exception("Не удалось подготовить копии изображения %s %s", model.__name__, pk)
+                failed += 1
+        return saved, failed
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from movies.changes import compact_changes, sequence_changes
+
+
+class Command(BaseCommand):
+    """Очистка журнала изменений от вытесненных записей"""
+
+    help = (
+        "Удаляет записи журнала изменений (movies.Change) старше CHANGE_FEED['RETENTION_DAYS'], "
+        "у объекта которых есть запись новее. Запускать по расписанию, например раз в сутки"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # записи без номера сравнить с соседями нельзя, нумеруем закоммиченные
+        sequence_changes()
+        deleted = compact_changes(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Удалено записей журнала: {deleted}"))
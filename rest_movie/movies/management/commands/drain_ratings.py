@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from movies.buffer import close_rating_buffer, get_rating_buffer_config
+from movies.models import Movie, RatingStar
+from movies.service import upsert_ratings
+
+
+class Command(BaseCommand):
+    """Запись оценок, сброшенных буфером отложенной записи в SPOOL_DIR"""
+
+    help = (
+        "Дописывает в бд оценки из файлов RATING_WRITE_BEHIND['SPOOL_DIR'], "
+        "оставшиеся после остановки процесса без доступа к бд"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--spool-dir", help="по умолчанию RATING_WRITE_BEHIND['SPOOL_DIR']")
+
+    def handle(self, *args, **options):
+        config = get_rating_buffer_config()
+        # буфер этого процесса тоже дописывается, если он был создан
+        close_rating_buffer()
+        spool_dir = options["spool_dir"] or config["SPOOL_DIR"]
+        if not spool_dir or not Path(spool_dir).is_dir():
+            self.stdout.write("Нет файлов с оценками")
+            return
+
+        batch_size = config["FLUSH_SIZE"]
+        written = skipped = 0
+        for path in sorted(Path(spool_dir).glob("*.jsonl")):
+            with open(path, encoding="utf-8") as file:
+                rows = [json.loads(line) for line in file if line.strip()]
+            stars = RatingStar.objects.in_bulk({row["star"] for row in rows})
+            movies = set(Movie.objects.filter(pk__in={row["movie"] for row in rows}).values_list("pk", flat=True))
+            # оценки удалённых с тех пор фильмов и звёзд пропускаются
+            pending = {
+                (row["ip"], row["movie"]): stars[row["star"]]
+                for row in rows if row["movie"] in movies and row["star"] in stars
+            }
+            skipped += len(rows) - len(pending)
+            items = list(pending.items())
+            for start in range(0, len(items), batch_size):
+                upsert_ratings(dict(items[start:start + batch_size]))
+            written += len(pending)
+            # файл удаляется только после записи: при ошибке команду можно повторить
+            path.unlink()
+
+        self.stdout.write(self.style.SUCCESS(f"Записано оценок: {written}, пропущено: {skipped}"))
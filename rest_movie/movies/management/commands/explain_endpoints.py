@@ -0,0 +1,112 @@
+import json
+import logging
+import random
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from movies.catalog_index import get_catalog_index
+
+from .bench_endpoints import API_PREFIX, Command as BenchCommand
+
+logger = logging.getLogger(__name__)
+
+# сценарий bench_endpoints -> таблицы, которые он намеренно читает целиком
+ALLOWED_SCANS = {
+    # выгрузка отдаёт весь опубликованный каталог
+    "GET movie/export/ NDJSON": {"movies_movie"},
+}
+
+# SCAN таблицы или всего индекса; SEARCH, виртуальные таблицы и подзапросы не подходят
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: USING (?:COVERING )?INDEX \w+)?$")
+LIMIT = re.compile(r"\sLIMIT \d+(?: OFFSET \d+)?$")
+
+
+def get_plan(sql):
+    """Строки EXPLAIN QUERY PLAN запроса, записанного с подставленными параметрами"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        return [row[3] for row in cursor.fetchall()]
+
+
+def find_full_scans(sql, plan):
+    """Таблицы, которые запрос читает целиком
+
+    SCAN без условия поиска - проход по всей таблице или индексу. Он короткий,
+    только если строки идут сразу в порядке ORDER BY (нет TEMP B-TREE) и у
+    запроса есть LIMIT: так KeysetPagination читает страницу и останавливается.
+    """
+    if LIMIT.search(sql) and "USE TEMP B-TREE FOR ORDER BY" not in plan:
+        return set()
+    return {match.group(1) for match in map(SCAN.match, plan) if match}
+
+
+class Command(BaseCommand):
+    """Планы запросов к бд всех маршрутов movies/urls.py"""
+
+    help = (
+        "Гоняет сценарии bench_endpoints на текущей базе SQLite (см. seed_catalog), выполняет "
+        "EXPLAIN QUERY PLAN для каждого SELECT и падает, если запрос читает таблицу целиком. "
+        "Запросы дольше --slow-ms пишутся в лог вместе с планом"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--slow-ms", type=float, default=50.0, help="порог медленного запроса, мс")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Разбираются только планы SQLite: запустите с SQLITE_DB=<файл>")
+        bench = BenchCommand(stdout=self.stdout, stderr=self.stderr)
+        bench.rng = random.Random(options["seed"])
+        hosts = [host for host in settings.ALLOWED_HOSTS if host != "*" and not host.startswith(".")]
+        self.client = Client(SERVER_NAME=hosts[0] if hosts else "localhost")
+
+        failures = []
+        for route, name, method, make_request in bench.get_scenarios():
+            # индекс фильтров читает весь каталог; в работе его строит фоновый поток,
+            # а в тестах - первый запрос, поэтому он строится до замера
+            index = get_catalog_index()
+            if index is not None:
+                index.is_fresh()
+            path, data, headers = make_request(0)
+            queries = self.request(method, API_PREFIX + path, data, headers)
+            scans, slow = set(), 0
+            for query in queries:
+                sql = query["sql"]
+                if not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+                    continue
+                plan = get_plan(sql)
+                found = find_full_scans(sql, plan) - ALLOWED_SCANS.get(name, set())
+                if found:
+                    scans |= found
+                    failures.append(f"{name}: {', '.join(sorted(found))}\n  {sql}\n    " + "\n    ".join(plan))
+                elapsed = float(query["time"]) * 1000
+                if elapsed >= options["slow_ms"]:
+                    slow += 1
+                    logger.warning("Медленный запрос %s, %.2f мс:\n%s\n  %s", name, elapsed, sql, "\n  ".join(plan))
+            self.stdout.write(
+                f"{name:<32} queries {len(queries):>3}  slow {slow:>2}  "
+                f"{'full scan: ' + ', '.join(sorted(scans)) if scans else 'ok'}"
+            )
+        if failures:
+            raise CommandError("Запросы читают таблицы целиком:\n" + "\n".join(failures))
+
+    def request(self, method, url, data, headers, follow=True):
+        """Запросы к бд ответа и, для списков, его второй страницы"""
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, data, **headers)
+            content = b"".join(response) if response.streaming else response.content
+        if response.status_code >= 300:
+            raise CommandError(f"{method.upper()} {url}: {response.status_code}")
+        queries = list(captured.captured_queries)
+        # страницы после первой ищутся по ключу из курсора, план у них свой
+        if follow and response.get("Content-Type") == "application/json":
+            body = json.loads(content)
+            if isinstance(body, dict) and "results" in body and body["next"]:
+                queries += self.request("get", body["next"], None, {}, follow=False)
+        return queries
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from movies.export import export_catalog
+
+
+class Command(BaseCommand):
+    """Выгрузка опубликованного каталога в NDJSON"""
+
+    help = (
+        "Пишет опубликованные фильмы со связями и агрегатами рейтинга в NDJSON, строка на фильм. "
+        "То же отдаёт эндпоинт movie/export/, только адреса постеров здесь без домена"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="-", help="файл, - для stdout")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="фильмов в пачке")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        movies = 0
+        file = None if options["output"] == "-" else open(options["output"], "wb")
+        try:
+            for chunk in export_catalog(chunk_size=options["chunk_size"]):
+                if file is None:
+                    self.stdout.write(chunk.decode(), ending="")
+                else:
+                    file.write(chunk)
+                movies += chunk.count(b"\n")
+        finally:
+            if file is not None:
+                file.close()
+        elapsed = time.perf_counter() - started
+        self.stderr.write(f"Выгружено фильмов: {movies} за {elapsed:.1f} с, {movies / max(elapsed, 1e-9):.0f} фильмов/с")
@@ -0,0 +1,275 @@
+import csv
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from movies.models import Actor, Category, Change, Genre, Movie, VersionedModel
+from movies.utils import bump_catalog_version, bump_movie_list_version
+
+# вид файла -> (модель, ключ записи, поля); порядок - порядок загрузки
+RECORDS = {
+    "categories": (Category, "url", ("name", "description")),
+    "genres": (Genre, "url", ("name", "description")),
+    "actors": (Actor, "name", ("age", "description", "image")),
+    "movies": (Movie, "url", (
+        "title", "tagline", "description", "poster", "year", "country", "world_premiere",
+        "budget", "fess_in_usa", "fess_in_world", "category", "draft",
+    )),
+}
+# вид файла -> (промежуточная таблица m2m, колонка второй стороны связи)
+LINKS = {
+    "movie_genres": (Movie.genres.through, "genre"),
+    "movie_actors": (Movie.actors.through, "actor"),
+    "movie_directors": (Movie.directors.through, "actor"),
+}
+# модель второй стороны связи -> поле, по которому она ищется
+LINK_KEYS = {Genre: "url", Actor: "name"}
+KINDS = [*RECORDS, *LINKS]
+
+
+def read_rows(path, offset=0):
+    """Строки CSV или JSONL как словари с байтовым смещением конца каждой строки
+
+    Файл читается потоком с байта offset: так память не зависит от размера
+    файла, а загрузку можно продолжить с сохранённого смещения.
+    """
+    with open(path, "rb") as file:
+        position = 0
+        header = None
+        if path.suffix == ".csv":
+            line = file.readline()
+            position = len(line)
+            header = next(csv.reader([line.decode("utf-8-sig")]), None)
+        if offset > position:
+            file.seek(offset)
+            position = offset
+
+        def lines():
+            nonlocal position
+            for line in file:
+                position += len(line)
+                yield line.decode("utf-8")
+
+        if header is not None:
+            # csv.reader берёт строки по одной, поэтому position - конец текущей записи
+            for values in csv.reader(lines()):
+                if values:
+                    yield dict(zip(header, values)), position
+        else:
+            for line in lines():
+                if line.strip():
+                    yield json.loads(line), position
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    """Потоковая загрузка каталога из CSV и JSONL"""
+
+    help = (
+        "Загружает категории, жанры, актёров, фильмы и их связи из файлов CSV или JSONL. "
+        "Вид файла - начало его имени: categories, genres, actors, movies, movie_genres, "
+        "movie_actors, movie_directors (например movies-2024.csv). Записи обновляются по url, "
+        "актёры - по имени; фильм ссылается на категорию по url, связи - на фильм по url, "
+        "на жанр по url и на актёра по имени. Связи только добавляются. Пачки пишутся в своих "
+        "транзакциях, смещение каждого файла сохраняется в <файл>.progress, поэтому прерванную "
+        "загрузку можно продолжить тем же вызовом. Копии изображений потом готовит build_image_variants"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", type=Path)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--restart", action="store_true", help="загрузить файлы с начала")
+        parser.add_argument("--state-dir", type=Path, help="где хранить .progress, по умолчанию рядом с файлами")
+        parser.add_argument("--progress-every", type=float, default=5.0, help="секунд между сообщениями о ходе")
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.progress_every = options["progress_every"]
+        files = []
+        for path in options["paths"]:
+            if not path.is_file() or path.suffix not in (".csv", ".jsonl"):
+                raise CommandError(f"{path}: нужен файл .csv или .jsonl")
+            match = re.match(r"[a-z_]+", path.stem)
+            kind = match and match.group().rstrip("_")
+            if kind not in KINDS:
+                raise CommandError(f"{path}: имя должно начинаться с одного из видов: {', '.join(KINDS)}")
+            files.append((KINDS.index(kind), kind, path))
+
+        imported = set()
+        for _, kind, path in sorted(files, key=lambda item: item[0]):
+            state = (options["state_dir"] or path.parent) / f"{path.name}.progress"
+            if options["restart"]:
+                state.unlink(missing_ok=True)
+            if self.import_file(kind, path, state):
+                imported.add(kind)
+
+        if imported:
+            # bulk-операции не шлют сигналов: индексы и кэши обновляем сами
+            if imported & {"movies", "actors", "movie_actors"}:
+                call_command("rebuild_search_index", stdout=self.stdout)
+            if imported & {"movies", "actors", "movie_actors", "movie_directors"}:
+                call_command("rebuild_filmography", batch_size=self.batch_size, stdout=self.stdout)
+            bump_movie_list_version()
+            bump_catalog_version()
+
+    def import_file(self, kind, path, state):
+        offset = 0
+        if state.exists():
+            offset = json.loads(state.read_text())["offset"]
+        size = path.stat().st_size
+        if offset > size:
+            self.stderr.write(f"{path}: файл короче сохранённого смещения, загрузка с начала")
+            offset = 0
+        if offset == size:
+            self.stdout.write(f"{path}: уже загружен")
+            return False
+
+        counts = {"rows": 0, "created": 0, "updated": 0, "skipped": 0}
+        started = reported = time.perf_counter()
+        try:
+            for batch in batched(read_rows(path, offset), self.batch_size):
+                with transaction.atomic():
+                    result = self.save_batch(kind, [row for row, _ in batch])
+                # смещение пишется после коммита; если записать его не успели,
+                # пачка загрузится повторно и просто обновит те же записи
+                position = batch[-1][1]
+                self.save_state(state, position)
+                counts["rows"] += len(batch)
+                for key, value in result.items():
+                    counts[key] += value
+                if time.perf_counter() - reported >= self.progress_every:
+                    reported = time.perf_counter()
+                    self.stderr.write(
+                        f"{path}: {position / size:.0%}, строк {counts['rows']}, "
+                        f"{counts['rows'] / (reported - started):.0f} строк/с"
+                    )
+        except (ValidationError, ValueError) as exc:
+            messages = exc.messages if isinstance(exc, ValidationError) else [str(exc)]
+            raise CommandError(f"{path}: пачка после строки {counts['rows']}: {'; '.join(messages)}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{path}: строк {counts['rows']}, создано {counts['created']}, обновлено {counts['updated']}, "
+            f"пропущено {counts['skipped']}, {counts['rows'] / max(elapsed, 1e-9):.0f} строк/с"
+        ))
+        return True
+
+    @staticmethod
+    def save_state(state, offset):
+        # атомарная замена: при обрыве остаётся прежнее смещение, а не обрезанный файл
+        temporary = state.with_name(state.name + ".tmp")
+        temporary.write_text(json.dumps({"offset": offset}))
+        os.replace(temporary, state)
+
+    def save_batch(self, kind, rows):
+        if kind in RECORDS:
+            return self.upsert(*RECORDS[kind], rows)
+        return self.link(*LINKS[kind], rows)
+
+    def upsert(self, model, key, fields, rows):
+        """Создать новые и обновить существующие записи пачки по ключу key"""
+        values = {}
+        for row in rows:
+            unknown = set(row) - {key, *fields}
+            if unknown:
+                raise ValidationError(f"неизвестные колонки {', '.join(sorted(unknown))}")
+            if not row.get(key):
+                raise ValidationError(f"нет значения {key}")
+            # пустая ячейка CSV - колонки нет: новой записи достаётся значение по умолчанию
+            values[row[key]] = {name: value for name, value in row.items() if name != key and value not in ("", None)}
+        skipped = 0
+        if model is Movie:
+            urls = {row["category"] for row in values.values() if "category" in row}
+            categories = dict(Category.objects.filter(url__in=urls).values_list("url", "pk"))
+            for row in values.values():
+                if "category" in row:
+                    row["category_id"] = categories.get(row.pop("category"))
+                    skipped += row["category_id"] is None
+
+        existing = {}
+        # при повторяющемся ключе (имя актёра) обновляется самая ранняя запись;
+        # строки заблокированы до записи: version + 1 считается от значения в бд
+        for instance in model.objects.select_for_update().filter(**{f"{key}__in": values}).order_by("-pk"):
+            existing[getattr(instance, key)] = instance
+        created, updated, update_fields = [], [], set()
+        now = timezone.now()
+        for value, row in values.items():
+            instance = existing.get(value) or model(**{key: value})
+            for name, raw in row.items():
+                field = model._meta.get_field(name)
+                setattr(instance, field.attname, field.to_python(raw))
+            if instance.pk is None:
+                if issubclass(model, VersionedModel):
+                    instance.version, instance.updated = 1, now
+                created.append(instance)
+            else:
+                if issubclass(model, VersionedModel):
+                    instance.version += 1
+                    instance.updated = now
+                    update_fields |= {"version", "updated"}
+                update_fields |= {model._meta.get_field(name).attname for name in row}
+                updated.append(instance)
+        updated_ids = [instance.pk for instance in updated]
+        if updated and model._meta.get_field(key).unique:
+            # одним INSERT ... ON CONFLICT DO UPDATE: bulk_update строит CASE на каждое
+            # поле каждой строки и на больших пачках в разы медленнее
+            columns = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+            updated = [model(**{name: getattr(instance, name) for name in columns}) for instance in updated]
+            model.objects.bulk_create(
+                created + updated, update_conflicts=True, unique_fields=[key], update_fields=sorted(update_fields)
+            )
+            # с update_conflicts id новых записей не возвращаются
+            created_ids = model.objects.filter(
+                **{f"{key}__in": [getattr(instance, key) for instance in created]}
+            ).values_list("pk", flat=True) if created else []
+        else:
+            model.objects.bulk_create(created)
+            created_ids = [instance.pk for instance in created]
+            if updated and update_fields:
+                model.objects.bulk_update(updated, sorted(update_fields))
+        Change.record(model, list(created_ids), Change.CREATED)
+        Change.record(model, updated_ids, Change.UPDATED)
+        return {"created": len(created), "updated": len(updated), "skipped": skipped}
+
+    def link(self, through, column, rows):
+        """Добавить связи фильм - жанр или актёр, уже существующие пропускаются"""
+        related = through._meta.get_field(column).related_model
+        related_key = LINK_KEYS[related]
+        pairs = set()
+        for row in rows:
+            if set(row) != {"movie", column}:
+                raise ValidationError(f"нужны колонки movie и {column}")
+            pairs.add((row["movie"], row[column]))
+        movies = dict(Movie.objects.filter(url__in={movie for movie, _ in pairs}).values_list("url", "pk"))
+        others = {}
+        for value, pk in related.objects.filter(
+            **{f"{related_key}__in": {other for _, other in pairs}}
+        ).order_by("-pk").values_list(related_key, "pk"):
+            others[value] = pk
+        resolved = {(movies[movie], others[other]) for movie, other in pairs if movie in movies and other in others}
+        existing = set(through.objects.filter(
+            movie_id__in={movie for movie, _ in resolved}, **{f"{column}_id__in": {other for _, other in resolved}}
+        ).values_list("movie_id", f"{column}_id"))
+        links = [through(movie_id=movie, **{f"{column}_id": other}) for movie, other in resolved - existing]
+        through.objects.bulk_create(links, ignore_conflicts=True)
+        # связи входят в ответ фильма, как в signals.movie_links_changed
+        Movie.touch(pk__in={link.movie_id for link in links})
+        return {"created": len(links), "updated": 0, "skipped": len(rows) - len(resolved)}
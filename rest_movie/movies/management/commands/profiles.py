@@ -0,0 +1,188 @@
+import sysconfig
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from movies.profiling import get_profile_dir, list_profiles, load_profile
+
+
+def get_label(function):
+    """Функция pstats коротко: путь от site-packages, stdlib или проекта, строка, имя"""
+    filename, line, name = function
+    path = filename.replace("\\", "/")
+    if "site-packages/" in path:
+        path = path.rsplit("site-packages/", 1)[1]
+    else:
+        for base in (settings.BASE_DIR, sysconfig.get_paths()["stdlib"]):
+            path = path.removeprefix(str(Path(base)).replace("\\", "/") + "/")
+    return f"{path}:{line}({name})" if line else name
+
+
+def get_sql_summary(meta):
+    """{текст запроса: [число, мс]} запросов профиля"""
+    summary = defaultdict(lambda: [0, 0.0])
+    for query in meta["sql"]:
+        summary[query["sql"]][0] += 1
+        summary[query["sql"]][1] += query["ms"]
+    return summary
+
+
+def shorten(sql, width=100):
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= width else sql[:width - 3] + "..."
+
+
+class Command(BaseCommand):
+    """Просмотр профилей запросов, снятых movies.profiling"""
+
+    help = (
+        "list - снятые профили, show <id> - фазы, дерево вызовов, самые дорогие функции и запросы к бд, "
+        "diff <id> <id> - разница фаз, функций и запросов двух профилей. Профили снимаются заголовком "
+        "X-Profile от staff или выборкой PROFILING['SAMPLE_RATE']"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", type=Path, help="по умолчанию PROFILING['DIR']")
+        actions = parser.add_subparsers(dest="action", required=True)
+        listing = actions.add_parser("list")
+        listing.add_argument("--route", help="только профили маршрута, например /api/v1/movie/<int:pk>/")
+        show = actions.add_parser("show")
+        show.add_argument("id")
+        show.add_argument("--limit", type=int, default=20, help="строк в таблицах функций и запросов")
+        show.add_argument("--sort", choices=("cumulative", "tottime", "ncalls"), default="cumulative")
+        show.add_argument(
+            "--threshold", type=float, default=1.0, help="в дереве только вызовы от стольких %% общего времени"
+        )
+        diff = actions.add_parser("diff")
+        diff.add_argument("base")
+        diff.add_argument("other")
+        diff.add_argument("--limit", type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.directory = options["dir"] or get_profile_dir()
+        if options["action"] == "list":
+            self.write_list(options["route"])
+        elif options["action"] == "show":
+            self.write_profile(options["id"], options["limit"], options["sort"], options["threshold"])
+        else:
+            self.write_diff(options["base"], options["other"], options["limit"])
+
+    def load(self, profile_id):
+        try:
+            return load_profile(self.directory, profile_id)
+        except FileNotFoundError:
+            raise CommandError(f"Нет профиля {profile_id} в {self.directory}")
+
+    def write_list(self, route):
+        profiles = [meta for meta in list_profiles(self.directory) if route is None or meta["route"] == route]
+        if not profiles:
+            self.stdout.write(f"Нет профилей в {self.directory}")
+            return
+        for meta in profiles:
+            self.stdout.write(
+                f"{meta['id']}  {meta['trigger']:<6}  {meta['status']}  {meta['phases_ms']['total']:>9.2f} ms  "
+                f"queries {meta['queries']:>3}  {meta['method']} {meta['path']}"
+            )
+
+    def write_profile(self, profile_id, limit, sort, threshold):
+        meta, stats = self.load(profile_id)
+        self.stdout.write(f"{meta['method']} {meta['path']} -> {meta['status']}  ({meta['trigger']}, {meta['created']})")
+        self.stdout.write("\nФазы, мс:")
+        for phase, elapsed in meta["phases_ms"].items():
+            self.stdout.write(f"  {phase:<10} {elapsed:>9.2f}")
+
+        self.stdout.write(f"\nДерево вызовов (от {threshold}% общего времени), мс:")
+        self.write_tree(stats, threshold)
+
+        self.stdout.write(f"\nФункции по {sort}:")
+        self.stdout.write(f"  {'ncalls':>8} {'tottime':>9} {'cumtime':>9}  функция")
+        column = {"ncalls": 1, "tottime": 2, "cumulative": 3}[sort]
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)[:limit]
+        for function, (_, calls, own, cumulative, _) in rows:
+            self.stdout.write(f"  {calls:>8} {own * 1000:>9.2f} {cumulative * 1000:>9.2f}  {get_label(function)}")
+
+        summary = get_sql_summary(meta)
+        self.stdout.write(f"\nЗапросы к бд: {meta['queries']}, {meta['phases_ms']['db']:.2f} мс")
+        if meta["sql_truncated"]:
+            self.stdout.write(f"  (сохранены первые {len(meta['sql'])})")
+        for sql, (count, elapsed) in sorted(summary.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            self.stdout.write(f"  {count:>4} x {elapsed:>8.2f} мс  {shorten(sql)}")
+
+    def write_tree(self, stats, threshold):
+        # callers в pstats: функция -> {вызвавшая: (cc, nc, tt, ct)}; переворачиваем
+        callees = defaultdict(dict)
+        for function, (*_, callers) in stats.stats.items():
+            for caller, (_, _, _, cumulative) in callers.items():
+                callees[caller][function] = cumulative
+        # корни - функции, часть вызовов которых пришла из кадра, включившего профилировщик
+        roots = {
+            function: cumulative
+            for function, (_, calls, _, cumulative, callers) in stats.stats.items()
+            if calls > sum(caller[1] for caller in callers.values())
+        }
+        total = max(roots.values(), default=0) or 1e-9
+        minimum = total * threshold / 100
+
+        expanded = set()
+
+        def walk(function, cumulative, depth, path):
+            """path - функции-предки в дереве"""
+            children = sorted(callees[function].items(), key=lambda item: item[1], reverse=True)
+            children = [(child, elapsed) for child, elapsed in children if elapsed >= minimum]
+            # pstats хранит время по парам вызывающая - вызванная, а не по путям, поэтому
+            # вызовы функции раскрываются один раз, в самом дорогом месте
+            folded = bool(children) and function in expanded and function not in path
+            self.stdout.write(
+                f"  {'  ' * depth}{cumulative * 1000:>8.2f}  {get_label(function)}{' ...' if folded else ''}"
+            )
+            if folded:
+                return
+            expanded.add(function)
+            path = path | {function}
+            for child, elapsed in children:
+                # рекурсию (цепочку middleware) разворачиваем, пока время убывает
+                if child not in path or elapsed < cumulative:
+                    walk(child, elapsed, depth + 1, path)
+
+        for root, cumulative in sorted(roots.items(), key=lambda item: item[1], reverse=True):
+            if cumulative >= minimum:
+                walk(root, cumulative, 0, set())
+
+    def write_diff(self, base_id, other_id, limit):
+        base, base_stats = self.load(base_id)
+        other, other_stats = self.load(other_id)
+        self.stdout.write(f"A: {base['id']}  {base['method']} {base['path']}")
+        self.stdout.write(f"B: {other['id']}  {other['method']} {other['path']}")
+
+        self.stdout.write(f"\n  {'фаза':<10} {'A, мс':>9} {'B, мс':>9} {'B-A':>9}")
+        for phase in base["phases_ms"]:
+            a, b = base["phases_ms"][phase], other["phases_ms"].get(phase, 0.0)
+            self.stdout.write(f"  {phase:<10} {a:>9.2f} {b:>9.2f} {b - a:>+9.2f}")
+        queries = base["queries"], other["queries"]
+        self.stdout.write(f"  {'queries':<10} {queries[0]:>9} {queries[1]:>9} {queries[1] - queries[0]:>+9}")
+
+        # собственное время функций: в нём видно, где именно прибавилось
+        self.stdout.write("\nФункции с наибольшей разницей tottime:")
+        self.stdout.write(f"  {'A calls':>8} {'B calls':>8} {'A, мс':>9} {'B, мс':>9} {'B-A':>9}  функция")
+        functions = set(base_stats.stats) | set(other_stats.stats)
+        empty = (0, 0, 0.0, 0.0, {})
+        rows = []
+        for function in functions:
+            a, b = base_stats.stats.get(function, empty), other_stats.stats.get(function, empty)
+            rows.append((b[2] - a[2], function, a, b))
+        for delta, function, a, b in sorted(rows, key=lambda row: abs(row[0]), reverse=True)[:limit]:
+            self.stdout.write(
+                f"  {a[1]:>8} {b[1]:>8} {a[2] * 1000:>9.2f} {b[2] * 1000:>9.2f} {delta * 1000:>+9.2f}  {get_label(function)}"
+            )
+
+        self.stdout.write("\nЗапросы к бд с наибольшей разницей:")
+        self.stdout.write(f"  {'A':>4} {'B':>4} {'A, мс':>9} {'B, мс':>9}  запрос")
+        base_sql, other_sql = get_sql_summary(base), get_sql_summary(other)
+        rows = []
+        for sql in set(base_sql) | set(other_sql):
+            a, b = base_sql.get(sql, (0, 0.0)), other_sql.get(sql, (0, 0.0))
+            rows.append((abs(b[1] - a[1]) + abs(b[0] - a[0]), sql, a, b))
+        for _, sql, a, b in sorted(rows, key=lambda row: row[0], reverse=True)[:limit]:
+            self.stdout.write(f"  {a[0]:>4} {b[0]:>4} {a[1]:>9.2f} {b[1]:>9.2f}  {shorten(sql)}")
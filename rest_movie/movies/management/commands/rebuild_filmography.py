@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from movies.filmography import update_filmography
+
+
+class Command(BaseCommand):
+    """Пересчёт сохранённых фильмографий актёров"""
+
+    help = (
+        "Пересчитывает Actor.filmography (movies.filmography) у всех актёров. "
+        "Нужна после загрузки связей и оценок в обход сигналов: bulk_create, raw SQL, loaddata"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = update_filmography(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Пересчитана фильмография {updated} актёров"))
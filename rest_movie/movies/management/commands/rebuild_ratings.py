@@ -0,0 +1,54 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from movies.models import Movie, Rating
+
+
+class Command(BaseCommand):
+    """Пересчёт сохранённых агрегатов рейтинга фильмов"""
+
+    help = (
+        "Пересчитывает rating_count, rating_sum и rating_histogram у фильмов по таблице Rating, "
+        "затем фильмографии актёров (rebuild_filmography)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        # Одна группировка по (фильм, значение звезды) вместо запроса на каждый фильм
+        rows = (
+            Rating.objects.values_list("movie_id", "star__value")
+            .annotate(total=models.Count("id"))
+            .order_by("movie_id")
+        )
+        histograms = {}
+        for movie_id, value, total in rows.iterator():
+            histograms.setdefault(movie_id, {})[str(value)] = total
+
+        updated = 0
+        with transaction.atomic():
+            batch = []
+            for movie in Movie.objects.only("id").order_by("id").iterator(chunk_size=batch_size):
+                histogram = histograms.get(movie.pk, {})
+                movie.rating_histogram = histogram
+                movie.rating_count = sum(histogram.values())
+                movie.rating_sum = sum(int(value) * total for value, total in histogram.items())
+                batch.append(movie)
+                if len(batch) >= batch_size:
+                    updated += self._flush(batch)
+            updated += self._flush(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Пересчитан рейтинг {updated} фильмов"))
+        # средние оценки фильмов входят в фильмографии актёров
+        call_command("rebuild_filmography", batch_size=batch_size, stdout=self.stdout)
+
+    @staticmethod
+    def _flush(batch):
+        count = len(batch)
+        if batch:
+            Movie.objects.bulk_update(batch, ["rating_count", "rating_sum", "rating_histogram"])
+            batch.clear()
+        return count
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from movies.models import Movie
+from movies.search import update_search_index
+from movies.utils import bump_movie_list_version
+
+
+class Command(BaseCommand):
+    """Пересборка полнотекстового индекса фильмов"""
+
+    help = (
+        "Заново заполняет индекс поиска (movies.search) по всем фильмам. "
+        "Нужна после загрузки в обход сигналов: bulk_create, raw SQL, loaddata"
+    )
+
+    def handle(self, *args, **options):
+        update_search_index()
+        bump_movie_list_version()
+        self.stdout.write(self.style.SUCCESS(f"Индекс поиска пересобран для {Movie.objects.count()} фильмов"))
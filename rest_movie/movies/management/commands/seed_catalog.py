@@ -0,0 +1,163 @@
+import random
+import time
+from datetime import date
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from movies.models import Actor, Category, Genre, Movie, Rating, RatingStar, Review
+from movies.utils import bump_catalog_version, bump_movie_list_version
+
+COUNTRIES = ("США", "Россия", "Франция", "Великобритания", "Германия", "Япония", "Индия", "Италия")
+
+
+class Command(BaseCommand):
+    """Синтетический каталог для замеров производительности"""
+
+    help = (
+        "Детерминированно заполняет каталог фильмами, актёрами, жанрами, отзывами и оценками. "
+        "Для замеров запускается на SQLite: SQLITE_DB=bench.sqlite3 python manage.py seed_catalog"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--movies", type=int, default=1000)
+        parser.add_argument("--actors", type=int, default=None, help="по умолчанию вдвое больше фильмов")
+        parser.add_argument("--genres", type=int, default=20)
+        parser.add_argument("--categories", type=int, default=5)
+        parser.add_argument("--cast", type=int, default=8, help="актёров на фильм")
+        parser.add_argument("--reviews", type=int, default=10, help="отзывов на фильм")
+        parser.add_argument("--ratings", type=int, default=50, help="оценок на фильм")
+        parser.add_argument("--ips", type=int, default=100_000, help="число разных ip у оценок")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--flush", action="store_true", help="очистить базу перед заполнением (manage.py flush)")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        movies = options["movies"]
+        actors = options["actors"] if options["actors"] is not None else movies * 2
+        if options["ratings"] > options["ips"]:
+            raise CommandError("--ratings не может быть больше --ips: у ip одна оценка на фильм")
+
+        if options["flush"]:
+            # flush очищает таблицы без сигналов на каждую удаляемую запись
+            call_command("flush", interactive=False, verbosity=0)
+        elif Movie.objects.exists():
+            raise CommandError("Каталог не пуст, для пересоздания укажите --flush")
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            stars = self.seed_stars()
+            categories = self.bulk(Category, [
+                Category(name=f"Категория {i}", description="-", url=f"category-{i}")
+                for i in range(options["categories"])
+            ])
+            genres = self.bulk(Genre, [
+                Genre(name=f"genre{i}", description="-", url=f"genre-{i}") for i in range(options["genres"])
+            ])
+            actor_ids = [actor.pk for actor in self.bulk(Actor, [
+                Actor(name=f"Актёр {i}", age=self.rng.randint(18, 90), description="-", image="actors/Arnold.jpg")
+                for i in range(actors)
+            ])]
+            movie_ids = [movie.pk for movie in self.bulk(Movie, [self.make_movie(i, categories) for i in range(movies)])]
+            self.seed_links(movie_ids, actor_ids, [genre.pk for genre in genres], options["cast"])
+            self.seed_reviews(movie_ids, options["reviews"])
+            self.seed_ratings(movie_ids, stars, options["ratings"], options["ips"])
+            call_command("rebuild_ratings", batch_size=self.batch_size, stdout=self.stdout)
+            call_command("rebuild_search_index", stdout=self.stdout)
+        bump_movie_list_version()
+        bump_catalog_version()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Каталог: {movies} фильмов, {actors} актёров за {time.perf_counter() - started:.1f} с"
+        ))
+
+    def bulk(self, model, objects):
+        return model.objects.bulk_create(objects, batch_size=self.batch_size)
+
+    def seed_stars(self):
+        stars = {star.value: star for star in RatingStar.objects.filter(value__in=range(1, 6))}
+        for value in range(1, 6):
+            if value not in stars:
+                stars[value] = RatingStar.objects.create(value=value)
+        return [stars[value] for value in range(1, 6)]
+
+    def make_movie(self, i, categories):
+        rng = self.rng
+        return Movie(
+            title=f"Фильм {i}",
+            tagline=f"Слоган {i}",
+            description="Описание " * rng.randint(5, 50),
+            poster="movies/terminator.jpg",
+            year=rng.randint(1950, 2023),
+            country=rng.choice(COUNTRIES),
+            world_premiere=date(rng.randint(1950, 2023), rng.randint(1, 12), rng.randint(1, 28)),
+            budget=rng.randint(0, 300) * 1_000_000,
+            category=rng.choice(categories) if categories else None,
+            url=f"movie-{i}",
+            # небольшая доля черновиков, как в живом каталоге
+            draft=rng.random() < 0.05,
+        )
+
+    def seed_links(self, movie_ids, actor_ids, genre_ids, cast):
+        """Связи m2m пишутся напрямую в промежуточные таблицы"""
+        rng = self.rng
+        actors, directors, genres = [], [], []
+        for movie_id in movie_ids:
+            for actor_id in rng.sample(actor_ids, min(cast, len(actor_ids))):
+                actors.append(Movie.actors.through(movie_id=movie_id, actor_id=actor_id))
+            if actor_ids:
+                directors.append(Movie.directors.through(movie_id=movie_id, actor_id=rng.choice(actor_ids)))
+            for genre_id in rng.sample(genre_ids, min(rng.randint(1, 3), len(genre_ids))):
+                genres.append(Movie.genres.through(movie_id=movie_id, genre_id=genre_id))
+        for through, links in (
+            (Movie.actors.through, actors),
+            (Movie.directors.through, directors),
+            (Movie.genres.through, genres),
+        ):
+            self.bulk(through, links)
+
+    def seed_reviews(self, movie_ids, per_movie):
+        """Отзывы уровнями: корни, затем ответы на отзывы предыдущего уровня"""
+        rng = self.rng
+        remaining = {movie_id: per_movie for movie_id in movie_ids}
+        parents = {movie_id: [None] for movie_id in movie_ids}
+        while any(remaining.values()):
+            level = []
+            for movie_id, left in remaining.items():
+                if not left:
+                    continue
+                # первый уровень - треть отзывов фильма, дальше половина оставшихся
+                # отвечает на отзывы предыдущего уровня
+                count = max(1, left // 2) if parents[movie_id] != [None] else max(1, (left + 2) // 3)
+                for _ in range(count):
+                    level.append(Review(
+                        movie_id=movie_id,
+                        parent_id=rng.choice(parents[movie_id]),
+                        name=f"Зритель {rng.randint(1, 10_000)}",
+                        email="viewer@example.com",
+                        text="Отзыв " * rng.randint(3, 40),
+                    ))
+                remaining[movie_id] = left - count
+            created = self.bulk(Review, level)
+            parents = {movie_id: [] for movie_id in movie_ids}
+            for review in created:
+                parents[review.movie_id].append(review.pk)
+            parents = {movie_id: ids or [None] for movie_id, ids in parents.items()}
+
+    def seed_ratings(self, movie_ids, stars, per_movie, ips):
+        rng = self.rng
+        batch = []
+        for movie_id in movie_ids:
+            for ip in rng.sample(range(ips), per_movie):
+                batch.append(Rating(
+                    movie_id=movie_id,
+                    ip=f"10.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}",
+                    star=rng.choices(stars, weights=(1, 2, 4, 6, 4))[0],
+                ))
+            if len(batch) >= self.batch_size:
+                self.bulk(Rating, batch)
+                batch = []
+        self.bulk(Rating, batch)
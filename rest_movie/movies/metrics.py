@@ -0,0 +1,304 @@
+"""Метрики запросов: Server-Timing и гистограммы для Prometheus
+
+MetricsMiddleware считает для каждого запроса число и время запросов к бд,
+время сериализации и общее время и отдаёт их заголовком Server-Timing
+(видно во вкладке Network браузера). Те же значения копятся в гистограммах
+по маршруту (шаблон из urls.py, а не путь) и методу и отдаются в текстовом
+формате Prometheus на metrics/.
+
+Запросы к бд считает обёртка execute_wrapper, которую получает каждое
+соединение (connection_created), сериализацию - serialization_timer в
+serializers.py. Вне запроса обе ничего не делают. Тело потокового ответа
+(movie/export/) создаётся уже после middleware и в метрики не входит.
+
+По тем же замерам ведётся скользящее среднее времени запроса к бд
+(get_db_latency), по нему movies.throttling сбрасывает нагрузку.
+
+Гистограммы живут в памяти процесса: при нескольких воркерах у каждого свои,
+Prometheus собирает их с каждого процесса отдельно.
+"""
+import bisect
+import contextvars
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+DEFAULTS = {
+    "ENABLED": True,
+    "SERVER_TIMING": True,
+    # метрики собираются только для путей с этими префиксами
+    "PATH_PREFIXES": ("/api/",),
+    # границы корзин гистограмм времени, секунды
+    "BUCKETS": (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+    # кроме staff, metrics/ доступен с этих адресов
+    "SCRAPE_IPS": ("127.0.0.1",),
+    # вес нового запроса в скользящем среднем времени запроса к бд
+    "DB_LATENCY_ALPHA": 0.1,
+}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def get_metrics_config():
+    return {**DEFAULTS, **getattr(settings, "METRICS", {})}
+
+
+class RequestTimings:
+    """Счётчики одного запроса"""
+    __slots__ = ("queries", "db", "serialize", "depth", "sql")
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        # вложенные сериализаторы не считаются повторно
+        self.depth = 0
+        # список (sql, секунды) каждого запроса к бд; собирается, только
+        # если его завёл профилировщик (movies.profiling)
+        self.sql = None
+
+
+# счётчики текущего запроса; sync_to_async передаёт контекст в поток с ORM
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        timings.db += elapsed
+        timings.queries += 1
+        if timings.sql is not None:
+            timings.sql.append((sql, elapsed))
+
+
+@receiver(connection_created)
+def install_execute_wrapper(sender, connection, **kwargs):
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+class serialization_timer:
+    """Время внутри блока идёт в сериализацию текущего запроса"""
+    __slots__ = ("timings", "started")
+
+    def __enter__(self):
+        self.timings = current_timings.get()
+        if self.timings is not None:
+            self.timings.depth += 1
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        timings = self.timings
+        if timings is not None:
+            timings.depth -= 1
+            if not timings.depth:
+                timings.serialize += time.perf_counter() - self.started
+
+
+class Histogram:
+    """Гистограмма Prometheus с произвольными метками, потокобезопасная"""
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счётчики корзин..., счётчик сверх последней границы, сумма]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def expose(self, label_names):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, list(values)) for labels, values in sorted(self.series.items())]
+        for labels, values in series:
+            prefix = format_labels(label_names, labels)
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values):
+                total += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {total}')
+            lines.append(f"{self.name}_sum{{{prefix.rstrip(',')}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{prefix.rstrip(',')}}} {total}")
+        return lines
+
+
+def format_labels(names, values):
+    return "".join(f'{name}="{escape_label(value)}",' for name, value in zip(names, values))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class RequestMetrics:
+    """Гистограммы запросов по (маршрут, метод, код ответа)"""
+    labels = ("route", "method", "status")
+
+    def __init__(self, buckets):
+        self.duration = Histogram(
+            "movies_request_duration_seconds", "Время обработки запроса до отдачи заголовков.", buckets
+        )
+        self.db = Histogram("movies_request_db_duration_seconds", "Время запросов к бд за запрос.", buckets)
+        self.serialize = Histogram(
+            "movies_request_serialize_duration_seconds", "Время сериализации ответа за запрос.", buckets
+        )
+        self.queries = Histogram(
+            "movies_request_db_queries", "Число запросов к бд за запрос.", (0, 1, 2, 5, 10, 20, 50, 100)
+        )
+
+    def observe(self, labels, total, timings):
+        self.duration.observe(labels, total)
+        self.db.observe(labels, timings.db)
+        self.serialize.observe(labels, timings.serialize)
+        self.queries.observe(labels, timings.queries)
+
+    def expose(self):
+        lines = []
+        for histogram in (self.duration, self.db, self.serialize, self.queries):
+            lines += histogram.expose(self.labels)
+        name = "movies_db_query_latency_seconds"
+        lines += [
+            f"# HELP {name} Скользящее среднее времени одного запроса к бд.",
+            f"# TYPE {name} gauge",
+            f"{name} {get_db_latency().get(max_age=float('inf'))}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class LatencyTracker:
+    """Экспоненциальное скользящее среднее с временем последнего замера
+
+    Обновляется без блокировки: при гонке теряется один замер, для среднего это неважно.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+        self.updated = 0.0
+
+    def observe(self, value):
+        self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+        self.updated = time.monotonic()
+
+    def get(self, max_age):
+        """Среднее или 0, если замеров не было дольше max_age секунд"""
+        if self.value is None or time.monotonic() - self.updated > max_age:
+            return 0.0
+        return self.value
+
+
+_metrics = None
+_db_latency = None
+_metrics_lock = threading.Lock()
+
+
+def get_request_metrics():
+    """Гистограммы запросов, одни на процесс"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = RequestMetrics(get_metrics_config()["BUCKETS"])
+        return _metrics
+
+
+def get_db_latency():
+    """Среднее время одного запроса к бд по последним запросам к PATH_PREFIXES"""
+    global _db_latency
+    with _metrics_lock:
+        if _db_latency is None:
+            _db_latency = LatencyTracker(get_metrics_config()["DB_LATENCY_ALPHA"])
+        return _db_latency
+
+
+def get_route(request):
+    match = request.resolver_match
+    return "/" + match.route if match is not None else "unmatched"
+
+
+def format_server_timing(total, timings):
+    return (
+        f'db;dur={timings.db * 1000:.2f};desc="{timings.queries} queries", '
+        f"serialize;dur={timings.serialize * 1000:.2f}, "
+        f"total;dur={total * 1000:.2f}"
+    )
+
+
+class MetricsMiddleware:
+    """Server-Timing и гистограммы для запросов к PATH_PREFIXES, см. модуль"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = get_metrics_config()
+        self.enabled = config["ENABLED"]
+        self.server_timing = config["SERVER_TIMING"]
+        self.prefixes = tuple(config["PATH_PREFIXES"])
+        self.db_latency = get_db_latency()
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.enabled or not request.path.startswith(self.prefixes):
+            return self.get_response(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, time.perf_counter() - started, timings)
+
+    async def __acall__(self, request):
+        if not self.enabled or not request.path.startswith(self.prefixes):
+            return await self.get_response(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, time.perf_counter() - started, timings)
+
+    def finish(self, request, response, total, timings):
+        if self.server_timing:
+            response["Server-Timing"] = format_server_timing(total, timings)
+        get_request_metrics().observe((get_route(request), request.method, response.status_code), total, timings)
+        if timings.queries:
+            self.db_latency.observe(timings.db / timings.queries)
+        return response
+
+
+def metrics_view(request):
+    """Метрики процесса в текстовом формате Prometheus"""
+    user = getattr(request, "user", None)
+    # REMOTE_ADDR, а не get_client_ip: X-Forwarded-For подставляет сам клиент
+    allowed = request.META.get("REMOTE_ADDR") in get_metrics_config()["SCRAPE_IPS"]
+    if not allowed and not (user is not None and user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(get_request_metrics().expose(), content_type=CONTENT_TYPE)
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_rating_aggregates(apps, schema_editor):
+    Movie = apps.get_model('movies', 'Movie')
+    Rating = apps.get_model('movies', 'Rating')
+    histograms = {}
+    rows = (
+        Rating.objects.values_list('movie_id', 'star__value')
+        .annotate(total=models.Count('id'))
+        .order_by('movie_id')
+    )
+    for movie_id, value, total in rows.iterator():
+        histograms.setdefault(movie_id, {})[str(value)] = total
+    for movie_id, histogram in histograms.items():
+        Movie.objects.filter(pk=movie_id).update(
+            rating_histogram=histogram,
+            rating_count=sum(histogram.values()),
+            rating_sum=sum(int(value) * total for value, total in histogram.items()),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество оценок'),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_histogram',
+            field=models.JSONField(default=dict, editable=False, verbose_name='Распределение оценок'),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Сумма оценок'),
+        ),
+        migrations.AlterField(
+            model_name='rating',
+            name='movie',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratings', to='movies.movie', verbose_name='фильм'),
+        ),
+        migrations.AlterField(
+            model_name='review',
+            name='movie',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reviews', to='movies.movie', verbose_name='фильм'),
+        ),
+        migrations.AlterField(
+            model_name='review',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='movies.review', verbose_name='Родитель'),
+        ),
+        migrations.RunPython(fill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0002_movie_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['draft', 'year', 'id'], name='movie_draft_year_id_idx'),
+        ),
+    ]
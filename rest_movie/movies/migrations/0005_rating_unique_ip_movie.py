@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:28
+
+from django.db import migrations, models
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    """Оставить одну, самую позднюю оценку на пару (ip, фильм) и пересчитать агрегаты"""
+    Movie = apps.get_model('movies', 'Movie')
+    Rating = apps.get_model('movies', 'Rating')
+    duplicated = set(
+        Rating.objects.values('ip', 'movie').annotate(total=models.Count('id'))
+        .filter(total__gt=1).values_list('movie', flat=True)
+    )
+    if not duplicated:
+        return
+    latest = Rating.objects.values('ip', 'movie').annotate(latest=models.Max('id')).values('latest')
+    Rating.objects.filter(movie__in=duplicated).exclude(pk__in=latest).delete()
+
+    histograms = {movie_id: {} for movie_id in duplicated}
+    rows = (
+        Rating.objects.filter(movie__in=duplicated).values_list('movie_id', 'star__value')
+        .annotate(total=models.Count('id')).order_by('movie_id')
+    )
+    for movie_id, value, total in rows.iterator():
+        histograms[movie_id][str(value)] = total
+    for movie_id, histogram in histograms.items():
+        Movie.objects.filter(pk=movie_id).update(
+            rating_histogram=histogram,
+            rating_count=sum(histogram.values()),
+            rating_sum=sum(int(value) * total for value, total in histogram.items()),
+            version=models.F('version') + 1,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0004_versioned_movie_actor'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('ip', 'movie'), name='rating_unique_ip_movie'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+# Копия movies.search на момент миграции: миграция не зависит от того, как код
+# индекса поменяется потом
+SEARCH_TABLE = 'movies_movie_search'
+SEARCH_CONFIG = 'russian'
+
+
+def create_search_index(apps, schema_editor):
+    """Таблица полнотекстового индекса: tsvector с GIN в PostgreSQL, FTS5 в SQLite"""
+    Movie = apps.get_model('movies', 'Movie')
+    Actor = apps.get_model('movies', 'Actor')
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    movie_table = qn(Movie._meta.db_table)
+    actors_table = qn(Movie._meta.get_field('actors').remote_field.through._meta.db_table)
+    actor_table = qn(Actor._meta.db_table)
+
+    if connection.vendor == 'postgresql':
+        # без внешнего ключа: manage.py flush очищает movies_movie без CASCADE,
+        # записи удалённых фильмов убирает сигнал post_delete
+        schema_editor.execute(f'CREATE TABLE {SEARCH_TABLE} (movie_id bigint PRIMARY KEY, document tsvector NOT NULL)')
+        schema_editor.execute(f'CREATE INDEX {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING gin (document)')
+        actor_names = "string_agg(a.name, ' ')"
+        columns = 'movie_id, document'
+        document = (
+            "setweight(to_tsvector('{config}', m.title), 'A') || "
+            "setweight(to_tsvector('{config}', m.tagline), 'B') || "
+            "setweight(to_tsvector('{config}', {actors}), 'B') || "
+            "setweight(to_tsvector('{config}', m.description), 'C')"
+        )
+    else:
+        # rowid записи - id фильма
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5('
+            f"title, tagline, description, actors, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        actor_names = "group_concat(a.name, ' ')"
+        columns = 'rowid, title, tagline, description, actors'
+        document = 'm.title, m.tagline, m.description, {actors}'
+    actors = (
+        f"coalesce((SELECT {actor_names} FROM {actors_table} ma JOIN {actor_table} a ON a.id = ma.actor_id "
+        f"WHERE ma.movie_id = m.id), '')"
+    )
+    document = document.format(actors=actors, config=SEARCH_CONFIG)
+    schema_editor.execute(f'INSERT INTO {SEARCH_TABLE} ({columns}) SELECT m.id, {document} FROM {movie_table} m')
+
+
+def drop_search_index(apps, schema_editor):
+    schema_editor.execute(f'DROP TABLE {SEARCH_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0005_rating_unique_ip_movie'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
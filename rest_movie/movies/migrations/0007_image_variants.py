@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0006_movie_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actor',
+            name='image_variants',
+            field=models.JSONField(default=dict, editable=False, verbose_name='Копии изображения'),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='poster_variants',
+            field=models.JSONField(default=dict, editable=False, verbose_name='Копии постера'),
+        ),
+        migrations.AddField(
+            model_name='movieshots',
+            name='image_variants',
+            field=models.JSONField(default=dict, editable=False, verbose_name='Копии изображения'),
+        ),
+    ]
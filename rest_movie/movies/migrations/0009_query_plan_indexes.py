@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:13
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0008_change_feed'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='movie',
+            name='movie_draft_year_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['name'], name='genre_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(condition=models.Q(('draft', False)), fields=['year', 'id'], name='movie_published_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(django.db.models.functions.comparison.Coalesce(django.db.models.expressions.CombinedExpression(models.F('rating_sum'), '/', django.db.models.functions.comparison.NullIf(models.F('rating_count'), 0)), 0), models.F('id'), condition=models.Q(('draft', False)), name='movie_published_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(condition=models.Q(('parent', None)), fields=['movie', 'id'], name='review_movie_root_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:21
+
+from django.db import migrations, models
+import movies.models
+
+
+def fill_filmography(apps, schema_editor):
+    """Сводки актёров, как movies.filmography.build_filmography на момент миграции"""
+    Actor = apps.get_model('movies', 'Actor')
+    Movie = apps.get_model('movies', 'Movie')
+    alias = schema_editor.connection.alias
+    roles = {
+        'acting': Movie._meta.get_field('actors').remote_field.through,
+        'directing': Movie._meta.get_field('directors').remote_field.through,
+    }
+    actor_ids = list(Actor.objects.using(alias).order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(actor_ids), 1000):
+        summaries = {
+            pk: {
+                'acting': [],
+                'directing': [],
+                'stats': {'movies': 0, 'first_year': None, 'last_year': None, 'average_rating': None},
+            }
+            for pk in actor_ids[start:start + 1000]
+        }
+        movies = {}
+        for role, through in roles.items():
+            rows = (
+                through.objects.using(alias)
+                .filter(actor_id__in=summaries, movie__draft=False)
+                .values_list('actor_id', 'movie_id', 'movie__title', 'movie__year', 'movie__rating_sum', 'movie__rating_count')
+            )
+            for actor_id, movie_id, title, year, rating_sum, rating_count in rows:
+                rating = round(rating_sum / rating_count, 2) if rating_count else None
+                summaries[actor_id][role].append({'id': movie_id, 'title': title, 'year': year, 'rating': rating})
+                movies.setdefault(actor_id, {})[movie_id] = (year, rating)
+        for actor_id, summary in summaries.items():
+            for role in roles:
+                summary[role].sort(key=lambda credit: (credit['year'], credit['id']), reverse=True)
+            credits = movies.get(actor_id)
+            if credits:
+                years = [year for year, _ in credits.values()]
+                ratings = [rating for _, rating in credits.values() if rating is not None]
+                summary['stats'] = {
+                    'movies': len(credits),
+                    'first_year': min(years),
+                    'last_year': max(years),
+                    'average_rating': round(sum(ratings) / len(ratings), 2) if ratings else None,
+                }
+        Actor.objects.using(alias).bulk_update(
+            [Actor(pk=pk, filmography=summary) for pk, summary in summaries.items()], ['filmography']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0009_query_plan_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actor',
+            name='filmography',
+            field=models.JSONField(default=movies.models.empty_filmography, editable=False, verbose_name='Фильмография'),
+        ),
+        migrations.RunPython(fill_filmography, migrations.RunPython.noop),
+    ]
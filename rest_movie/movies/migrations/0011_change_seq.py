@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+def number_existing(apps, schema_editor):
+    """Записи до миграции получают номер, равный id: токены зеркал остаются верными"""
+    Change = apps.get_model('movies', 'Change')
+    Change.objects.using(schema_editor.connection.alias).update(seq=models.F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0010_actor_filmography'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True, unique=True, verbose_name='Номер в ленте'),
+        ),
+        migrations.RunPython(number_existing, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['model', 'object_id', 'seq'], name='change_object_seq_idx'),
+        ),
+    ]
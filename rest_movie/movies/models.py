@@ -1,10 +1,63 @@
+from collections import defaultdict
 from datetime import date
 
 from django.db import models
+from django.db.models.functions import Coalesce, NullIf
 from django.urls import reverse
+from django.utils import timezone
 from ckeditor.fields import RichTextField
 
 
+def average_rating():
+    """Средняя оценка фильма из сохранённых агрегатов, фильмы без оценок идут как 0"""
+    return Coalesce(models.F("rating_sum") / NullIf(models.F("rating_count"), 0), 0)
+
+
+def empty_filmography():
+    """Фильмография актёра без фильмов, см. movies/filmography.py"""
+    return {
+        "acting": [],
+        "directing": [],
+        "stats": {"movies": 0, "first_year": None, "last_year": None, "average_rating": None},
+    }
+
+
+class VersionedModel(models.Model):
+    """Версия и время изменения записи для ETag и Last-Modified"""
+    version = models.PositiveIntegerField("Версия", default=0, editable=False)
+    updated = models.DateTimeField("Изменён", auto_now=True)
+
+    def save(self, *args, **kwargs):
+        # Существующей записи версия поднимается в бд: между загрузкой объекта и
+        # save её могли поднять touch, save_variants или оценки, и version + 1 из
+        # памяти повторил бы ETag, уже выданный для другого содержимого
+        adding = self._state.adding
+        if adding:
+            self.version += 1
+        else:
+            self.version = models.F("version") + 1
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "version", "updated"}
+        super().save(*args, **kwargs)
+        if not adding:
+            self.refresh_from_db(fields=["version"])
+
+    @classmethod
+    def touch(cls, *args, **kwargs):
+        """Поднять версию записей, у которых изменились связанные данные"""
+        # id нужны журналу изменений; по ним же и обновляем, фильтр мог идти через join
+        ids = set(cls.objects.filter(*args, **kwargs).values_list("pk", flat=True))
+        if not ids:
+            return 0
+        updated = cls.objects.filter(pk__in=ids).update(version=models.F("version") + 1, updated=timezone.now())
+        Change.record(cls, ids, Change.UPDATED)
+        return updated
+
+    class Meta:
+        abstract = True
+
+
 class Category(models.Model):
     """Категория"""
     name = models.CharField("Категория", max_length=150)
@@ -22,12 +75,16 @@ class Category(models.Model):
         verbose_name_plural = "Категория"
 
 
-class Actor(models.Model):
+class Actor(VersionedModel):
     """Актёры и режиссёры"""
     name = models.CharField("Имя", max_length=100)
     age = models.PositiveSmallIntegerField("Возраст", default=0)
     description = models.TextField("Описание")
     image = models.ImageField("Изображение", upload_to="actors/")
+    # {"вариант": имя файла} уменьшенных копий image, см. movies/images.py
+    image_variants = models.JSONField("Копии изображения", default=dict, editable=False)
+    # сводка по опубликованным фильмам, пересчитывается movies/filmography.py
+    filmography = models.JSONField("Фильмография", default=empty_filmography, editable=False)
 
     def __str__(self):
         return self.name
@@ -52,9 +109,13 @@ class Genre(models.Model):
     class Meta:
         verbose_name = "Жанр"
         verbose_name_plural = "Жанры"
+        indexes = [
+            # фильтр каталога ?genres= идёт по именам жанров
+            models.Index(fields=["name"], name="genre_name_idx"),
+        ]
 
 
-class Movie(models.Model):
+class Movie(VersionedModel):
     """Фильмы"""
     title = models.CharField("Название", max_length=100)
     tagline = models.CharField("Слоган", max_length=100, default='')
@@ -62,6 +123,7 @@ class Movie(models.Model):
     description = models.TextField("Описание")
 
     poster = models.ImageField("Постер", upload_to="movies/")
+    poster_variants = models.JSONField("Копии постера", default=dict, editable=False)
     year = models.PositiveSmallIntegerField("Дата выхода", default=2019)
     country = models.CharField("Страна", max_length=30)
     # Атрибут related_name указывает имя обратного отношения от модели Movie к вашей модели.
@@ -83,6 +145,13 @@ class Movie(models.Model):
     )
     url = models.SlugField(max_length=130, unique=True)
     draft = models.BooleanField("Черновик", default=False)
+    # Денормализованные агрегаты рейтинга. Поддерживаются в CreateRatingSerializer.create
+    # и пересчитываются командой rebuild_ratings, чтобы список фильмов не делал join
+    # и group by по всей таблице рейтингов.
+    rating_count = models.PositiveIntegerField("Количество оценок", default=0, editable=False)
+    rating_sum = models.PositiveIntegerField("Сумма оценок", default=0, editable=False)
+    # {"значение звезды": количество оценок}
+    rating_histogram = models.JSONField("Распределение оценок", default=dict, editable=False)
 
     def __str__(self):
         return self.title
@@ -99,9 +168,67 @@ class Movie(models.Model):
     def get_review(self):
         return self.reviews_set.filter(parent__isnull = True)
 
+    def get_review_tree(self):
+        """Дерево отзывов фильма, собранное одним запросом"""
+        # Забираем все отзывы фильма разом и раскладываем их по родителям в памяти,
+        # вместо отдельного запроса children на каждый отзыв.
+        if self._review_tree is None:
+            self._review_tree = self.build_review_tree(list(self.get_review_queryset()))
+        return self._review_tree
+
+    async def aget_review_tree(self):
+        """То же через асинхронный ORM, для async_views"""
+        if self._review_tree is None:
+            self._review_tree = self.build_review_tree([review async for review in self.get_review_queryset()])
+        return self._review_tree
+
+    # дерево, уже собранное get_review_tree или aget_review_tree
+    _review_tree = None
+
+    def get_review_queryset(self):
+        return self.reviews.only("id", "parent_id", "movie_id", "name", "text").order_by("id")
+
+    @staticmethod
+    def build_review_tree(reviews):
+        children = defaultdict(list)
+        for review in reviews:
+            children[review.parent_id].append(review)
+        for review in reviews:
+            review.tree_children = children.get(review.pk, [])
+        return children.get(None, [])
+
+    def apply_rating(self, old_value, new_value):
+        """Учесть новую оценку, смену или удаление оценки в агрегатах рейтинга
+
+        old_value None - оценки не было, new_value None - оценку удалили.
+        """
+        histogram = dict(self.rating_histogram)
+        if old_value is not None:
+            self.rating_count -= 1
+            self.rating_sum -= old_value
+            key = str(old_value)
+            histogram[key] = histogram.get(key, 0) - 1
+            if histogram[key] <= 0:
+                del histogram[key]
+        if new_value is not None:
+            self.rating_count += 1
+            self.rating_sum += new_value
+            key = str(new_value)
+            histogram[key] = histogram.get(key, 0) + 1
+        self.rating_histogram = histogram
+
     class Meta:
         verbose_name = "Фильм"
         verbose_name_plural = "Фильмы"
+        indexes = [
+            # Ключи постраничного вывода опубликованных фильмов (MoviePagination).
+            # Частичные: условие совпадает с фильтром списка draft=False, который
+            # SQLite пишет как NOT draft и не ищет по индексу, начинающемуся с draft
+            models.Index(fields=["year", "id"], condition=models.Q(draft=False), name="movie_published_year_idx"),
+            models.Index(
+                average_rating(), models.F("id"), condition=models.Q(draft=False), name="movie_published_rating_idx"
+            ),
+        ]
 
 # movie.movieshots_set.all - Мы обращаемся к нашему объекту movie, затем к
 # movieshots_set.all - ы забираем все связанные данные с этой моделью.
@@ -110,6 +237,7 @@ class MovieShots(models.Model):
     title = models.CharField("Заголовок", max_length=100)
     description = models.TextField("Описание")
     image = models.ImageField("Изображение", upload_to="movie_shots/")
+    image_variants = models.JSONField("Копии изображения", default=dict, editable=False)
     movie = models.ForeignKey(Movie, verbose_name="Фильм", on_delete=models.CASCADE)
 
     def __str__(self):
@@ -151,6 +279,10 @@ class Rating(models.Model):
     class Meta:
         verbose_name = "Рейтинг"
         verbose_name_plural = "Рейтинги"
+        constraints = [
+            # с одного ip у фильма только одна оценка, на этом ключе работает upsert оценок
+            models.UniqueConstraint(fields=["ip", "movie"], name="rating_unique_ip_movie"),
+        ]
 
 
 class Review(models.Model):
@@ -171,3 +303,47 @@ class Review(models.Model):
     class Meta:
         verbose_name = "Отзыв"
         verbose_name_plural = "Отзывы"
+        indexes = [
+            # корневые отзывы фильма (Movie.get_review, FilterReviewListSerializer)
+            models.Index(fields=["movie", "id"], condition=models.Q(parent=None), name="review_movie_root_idx"),
+        ]
+
+
+class Change(models.Model):
+    """Журнал изменений каталога для зеркал (movies/changes.py)
+
+    Запись только отмечает, что объект изменился, содержимое отдаётся из его
+    текущего состояния. id выдаётся при вставке, и транзакция с меньшим id
+    может закоммититься позже. Номер в ленте seq выдаётся уже закоммиченным
+    записям (changes.sequence_changes), он растёт в порядке появления записей.
+    """
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+    ACTIONS = ((CREATED, "Создан"), (UPDATED, "Изменён"), (DELETED, "Удалён"))
+    # модели, изменения которых попадают в журнал
+    TRACKED = ("movie", "actor", "review", "rating")
+
+    model = models.CharField("Модель", max_length=20)
+    object_id = models.BigIntegerField("id записи")
+    action = models.CharField("Действие", max_length=10, choices=ACTIONS)
+    created = models.DateTimeField("Время", auto_now_add=True)
+    seq = models.BigIntegerField("Номер в ленте", null=True, blank=True, unique=True)
+
+    def __str__(self):
+        return f"{self.pk} {self.model} {self.object_id} {self.action}"
+
+    @classmethod
+    def record(cls, model, ids, action):
+        """Записать изменение объектов model с id из ids, если модель отслеживается"""
+        name = model._meta.model_name
+        if name in cls.TRACKED and ids:
+            cls.objects.bulk_create([cls(model=name, object_id=pk, action=action) for pk in ids], batch_size=1000)
+
+    class Meta:
+        verbose_name = "Изменение"
+        verbose_name_plural = "Журнал изменений"
+        indexes = [
+            # более новая запись того же объекта, см. changes.compact_changes
+            models.Index(fields=["model", "object_id", "seq"], name="change_object_seq_idx"),
+        ]
@@ -0,0 +1,201 @@
+"""Профили отдельных запросов по требованию
+
+ProfilingMiddleware снимает cProfile с обработки запроса (представление,
+сериализация, рендер ответа) и записывает в каталог PROFILING["DIR"] дерево
+вызовов (<id>.prof, формат pstats - открывается и snakeviz) и описание запроса
+(<id>.json): время фаз, каждый запрос к бд с его временем. Хранятся последние
+MAX_PROFILES профилей, старые удаляются. Смотреть - командой profiles.
+
+Профиль снимается:
+- по заголовку X-Profile от пользователя staff или со значением PROFILING["TOKEN"],
+  в ответ добавляется X-Profile-Id;
+- для доли SAMPLE_RATE запросов к PATH_PREFIXES, без заголовка в ответе.
+
+Асинхронные представления не профилируются: cProfile видит только свой поток,
+а ORM в них работает в другом. Времена в профиле завышены накладными
+расходами cProfile, сравнивать их стоит с другими профилями, а не с метриками.
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import RequestTimings, current_timings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    # доля запросов к PATH_PREFIXES, которые профилируются без заголовка
+    "SAMPLE_RATE": 0.0,
+    "PATH_PREFIXES": ("/api/",),
+    # None - каталог profiles рядом с manage.py
+    "DIR": None,
+    "MAX_PROFILES": 200,
+    # сколько запросов к бд одного профиля сохраняется по отдельности
+    "MAX_SQL": 1000,
+    # значение X-Profile, которое разрешает профиль без входа staff; "" - только staff
+    "TOKEN": "",
+}
+
+HEADER = "HTTP_X_PROFILE"
+
+# фаза -> (конец пути файла, функция), время фазы - её cumulative в профиле
+PHASES = {
+    "view": ("rest_framework/views.py", "dispatch"),
+    "render": ("rest_framework/response.py", "rendered_content"),
+}
+
+
+def get_profiling_config():
+    return {**DEFAULTS, **getattr(settings, "PROFILING", {})}
+
+
+def get_profile_dir(config=None):
+    config = config or get_profiling_config()
+    return Path(config["DIR"] or Path(settings.BASE_DIR) / "profiles")
+
+
+def get_phase_times(stats):
+    """{фаза: секунды} по функциям PHASES в статистике pstats"""
+    phases = dict.fromkeys(PHASES, 0.0)
+    for (filename, _, function), (_, _, _, cumulative, _) in stats.stats.items():
+        filename = filename.replace("\\", "/")
+        for phase, (suffix, name) in PHASES.items():
+            if function == name and filename.endswith(suffix):
+                phases[phase] = max(phases[phase], cumulative)
+    return phases
+
+
+def save_profile(directory, profile_id, profiler, meta, max_profiles):
+    """Записать профиль и описание; описание последним, по нему профиль и виден"""
+    directory.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(directory / f"{profile_id}.prof")
+    temporary = directory / f"{profile_id}.json.tmp"
+    temporary.write_text(json.dumps(meta, ensure_ascii=False))
+    os.replace(temporary, directory / f"{profile_id}.json")
+    # кольцо: id начинается со времени, старые профили - первые по имени
+    for path in sorted(directory.glob("*.json"))[:-max_profiles]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def list_profiles(directory):
+    """Описания профилей от старых к новым"""
+    profiles = []
+    for path in sorted(Path(directory).glob("*.json")):
+        try:
+            profiles.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # профиль удалили из кольца, пока его читали
+            continue
+    return profiles
+
+
+def load_profile(directory, profile_id):
+    """(описание, pstats.Stats) профиля; FileNotFoundError, если его нет"""
+    directory = Path(directory)
+    meta = json.loads((directory / f"{profile_id}.json").read_text())
+    return meta, pstats.Stats(str(directory / f"{profile_id}.prof"))
+
+
+class ProfilingMiddleware:
+    """Профиль запроса по заголовку X-Profile или выборке, см. модуль
+
+    Стоит после AuthenticationMiddleware: заголовок принимается только от staff.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = get_profiling_config()
+        self.directory = get_profile_dir(self.config)
+        self.prefixes = tuple(self.config["PATH_PREFIXES"])
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.get_response(request)
+        if not self.config["ENABLED"] or not request.path.startswith(self.prefixes):
+            return self.get_response(request)
+        if self.is_requested(request):
+            return self.profile(request, "header")
+        rate = self.config["SAMPLE_RATE"]
+        if rate and random.random() < rate:
+            return self.profile(request, "sample")
+        return self.get_response(request)
+
+    def is_requested(self, request):
+        value = request.META.get(HEADER)
+        if not value:
+            return False
+        token = self.config["TOKEN"]
+        if token and hmac.compare_digest(value.encode(), token.encode()):
+            return True
+        user = getattr(request, "user", None)
+        return user is not None and user.is_staff
+
+    def profile(self, request, trigger):
+        timings = current_timings.get()
+        token = None
+        if timings is None:
+            # MetricsMiddleware выключен или путь вне его префиксов
+            timings = RequestTimings()
+            token = current_timings.set(timings)
+        queries, db, serialize = timings.queries, timings.db, timings.serialize
+        timings.sql = []
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+            total = time.perf_counter() - started
+            sql, timings.sql = timings.sql, None
+            if token is not None:
+                current_timings.reset(token)
+
+        now = datetime.now(timezone.utc)
+        profile_id = f"{now:%Y%m%dT%H%M%S%f}-{os.getpid()}"
+        phases = {phase: elapsed * 1000 for phase, elapsed in get_phase_times(pstats.Stats(profiler)).items()}
+        phases.update(
+            serialize=(timings.serialize - serialize) * 1000, db=(timings.db - db) * 1000, total=total * 1000
+        )
+        user = getattr(request, "user", None)
+        max_sql = self.config["MAX_SQL"]
+        meta = {
+            "id": profile_id,
+            "created": now.isoformat(),
+            "trigger": trigger,
+            "method": request.method,
+            "path": request.get_full_path(),
+            "route": "/" + request.resolver_match.route if request.resolver_match else None,
+            "status": response.status_code,
+            "user": user.get_username() if user is not None and user.is_authenticated else None,
+            "phases_ms": {phase: round(elapsed, 3) for phase, elapsed in phases.items()},
+            "queries": timings.queries - queries,
+            # текст запроса без параметров: в них бывают данные пользователей
+            "sql": [{"sql": statement, "ms": round(elapsed * 1000, 3)} for statement, elapsed in sql[:max_sql]],
+            "sql_truncated": len(sql) > max_sql,
+        }
+        try:
+            save_profile(self.directory, profile_id, profiler, meta, self.config["MAX_PROFILES"])
+        except OSError:
+            logger.exception("Не удалось записать профиль запроса %s", profile_id)
+            return response
+        if trigger == "header":
+            response["X-Profile-Id"] = profile_id
+        return response
@@ -0,0 +1,312 @@
+"""Чтение с реплик бд с чтением своих записей
+
+ReplicaRouter отправляет чтения GET/HEAD запросов к PATH_PREFIXES на одну из
+реплик DATABASE_REPLICAS["REPLICAS"] (псевдонимы из settings.DATABASES), а
+записи, остальные методы, админку и всё, что идёт вне запроса (команды,
+фоновые потоки), - на основную бд default. Реплика выбирается один раз на
+запрос, чтобы все его чтения видели один снимок.
+
+Чтение своих записей: после успешного POST/PUT/PATCH/DELETE ip клиента
+(get_client_ip) на STICKY_SECONDS читает с основной бд. Отметка лежит в кэше
+Django, общем для процессов (utils.check_shared_cache); окно должно быть не
+меньше MAX_LAG. Списки из общего кэша такой клиент не читает
+(reads_own_writes), а пересобирает с основной бд и обновляет ими кэш.
+Прочитанное с реплики в общий кэш не кладётся (read_from_replica): реплика
+может отставать от версии кэша, и устаревший список прожил бы в кэше до
+следующей записи.
+
+Здоровье реплик: раз в CHECK_INTERVAL секунд перед выбором реплика
+проверяется запросом (для PostgreSQL - ещё и отставание репликации). Реплика,
+которая не отвечает, отстаёт больше MAX_LAG или уронила запрос ошибкой
+соединения, на RETRY_AFTER секунд исключается из выбора. Без здоровых реплик
+чтения идут на основную бд.
+
+Представление с replica_reads = False читает с основной бд всегда.
+"""
+import contextvars
+import logging
+import random
+import sys
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import got_request_exception
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, InterfaceError, OperationalError, connections
+from django.dispatch import receiver
+
+from .service import get_client_ip
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # псевдонимы реплик в settings.DATABASES; пусто - всё идёт в default
+    "REPLICAS": (),
+    "PATH_PREFIXES": ("/api/",),
+    # сколько секунд после записи клиент читает с основной бд
+    "STICKY_SECONDS": 5.0,
+    # как часто проверять реплику, секунды
+    "CHECK_INTERVAL": 5.0,
+    # допустимое отставание реплики, секунды; None - не проверять
+    "MAX_LAG": 5.0,
+    # на сколько секунд исключать нездоровую реплику
+    "RETRY_AFTER": 30.0,
+}
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# PostgreSQL: без новых записей на основной отставание считается нулевым,
+# а не временем с последней проигранной транзакции
+PG_LAG_SQL = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+def get_replica_config():
+    return {**DEFAULTS, **getattr(settings, "DATABASE_REPLICAS", {})}
+
+
+def get_replica_lag(connection):
+    """Отставание реплики в секундах; DatabaseError, если она не отвечает"""
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(PG_LAG_SQL)
+        else:
+            cursor.execute("SELECT 0")
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaHealth:
+    __slots__ = ("checked", "down_until")
+
+    def __init__(self):
+        self.checked = None
+        self.down_until = 0.0
+
+
+class ReplicaPool:
+    """Здоровье реплик процесса и выбор реплики для запроса"""
+
+    def __init__(self, aliases, check_interval, max_lag, retry_after, clock=time.monotonic):
+        self.aliases = tuple(aliases)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.retry_after = retry_after
+        self.clock = clock
+        self.health = {alias: ReplicaHealth() for alias in self.aliases}
+        self.lock = threading.Lock()
+
+    def choose(self):
+        """Случайная здоровая реплика или None"""
+        now = self.clock()
+        healthy = [alias for alias in self.aliases if self.is_healthy(alias, now)]
+        return random.choice(healthy) if healthy else None
+
+    def is_healthy(self, alias, now):
+        health = self.health[alias]
+        if health.down_until > now:
+            return False
+        with self.lock:
+            # проверку делает один поток, остальные считают реплику здоровой до её итога
+            due = health.checked is None or now - health.checked >= self.check_interval
+            if due:
+                health.checked = now
+        if not due:
+            return True
+        try:
+            lag = get_replica_lag(connections[alias])
+        except DatabaseError:
+            self.mark_down(alias, "не отвечает")
+            return False
+        if self.max_lag is not None and lag > self.max_lag:
+            self.mark_down(alias, f"отстаёт на {lag:.1f} с")
+            return False
+        return True
+
+    def mark_down(self, alias, reason):
+        logger.warning("Реплика %s исключена на %s с: %s", alias, self.retry_after, reason)
+        self.health[alias].down_until = self.clock() + self.retry_after
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_replica_pool():
+    """Реплики процесса, None - если они не настроены"""
+    global _pool
+    config = get_replica_config()
+    if not config["REPLICAS"]:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ReplicaPool(config["REPLICAS"], config["CHECK_INTERVAL"], config["MAX_LAG"], config["RETRY_AFTER"])
+        return _pool
+
+
+class RoutingState:
+    """Куда идут чтения текущего запроса"""
+    __slots__ = ("pool", "primary", "sticky", "replica")
+
+    def __init__(self, pool, primary, sticky=False):
+        self.pool = pool
+        # True - все запросы к основной бд
+        self.primary = primary
+        # клиент недавно писал и читает свои записи
+        self.sticky = sticky
+        # выбранная реплика; False - ещё не выбирали
+        self.replica = False
+
+    def get_read_alias(self):
+        if self.primary:
+            return DEFAULT_DB_ALIAS
+        if self.replica is False:
+            self.replica = self.pool.choose()
+        return self.replica or DEFAULT_DB_ALIAS
+
+
+# маршрут текущего запроса; None - запрос вне PATH_PREFIXES, реплик нет или идёт не запрос
+current_routing = contextvars.ContextVar("current_routing", default=None)
+
+
+def get_sticky_key(ip):
+    return f"replicas:sticky:{ip}"
+
+
+def reads_own_writes():
+    """Клиент текущего запроса недавно писал в бд
+
+    Общий кэш ответов мог собрать другой запрос до его записи, такому клиенту
+    его читать нельзя: он может не увидеть своей записи.
+    """
+    state = current_routing.get()
+    return state is not None and state.sticky
+
+
+def read_from_replica():
+    """Текущий запрос читал с реплики, его результат нельзя класть в общий кэш"""
+    state = current_routing.get()
+    return state is not None and bool(state.replica)
+
+
+class ReplicaRouter:
+    """Чтения запроса - на реплику из current_routing, записи - на основную бд"""
+
+    def db_for_read(self, model, **hints):
+        state = current_routing.get()
+        return state.get_read_alias() if state is not None else None
+
+    def db_for_write(self, model, **hints):
+        state = current_routing.get()
+        if state is None:
+            return None
+        # после записи запрос читает то, что записал
+        state.primary = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replica_config()["REPLICAS"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+@receiver(got_request_exception)
+def replica_request_failed(sender, request=None, **kwargs):
+    """Ошибка соединения в запросе, читавшем с реплики, исключает реплику"""
+    state = current_routing.get()
+    error = sys.exc_info()[1]
+    if state is None or not state.replica or not isinstance(error, (OperationalError, InterfaceError)):
+        return
+    state.pool.mark_down(state.replica, repr(error))
+
+
+def stream_with_routing(content, state):
+    """Тело потокового ответа создаётся после middleware: читаем его с той же реплики"""
+    iterator = iter(content)
+    while True:
+        token = current_routing.set(state)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            current_routing.reset(token)
+        yield chunk
+
+
+class ReplicaMiddleware:
+    """Маршрут чтений запроса и отметка чтения своих записей, см. модуль"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        state = self.get_state(request)
+        if state is None:
+            return self.get_response(request)
+        token = current_routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        # отметка чтения своих записей - через асинхронный кэш, без блокировки цикла событий
+        state = self.get_state(request, sticky=await self.ais_sticky(request))
+        if state is None:
+            return await self.get_response(request)
+        token = current_routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        if self.wrote(request, response):
+            await cache.aset(get_sticky_key(get_client_ip(request)), 1, get_replica_config()["STICKY_SECONDS"])
+            return response
+        return self.finish(request, response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = current_routing.get()
+        if state is not None and not getattr(getattr(view_func, "cls", None), "replica_reads", True):
+            state.primary = True
+
+    def routes(self, request):
+        return get_replica_pool() is not None and request.path.startswith(tuple(get_replica_config()["PATH_PREFIXES"]))
+
+    async def ais_sticky(self, request):
+        if not self.routes(request) or request.method not in SAFE_METHODS:
+            return False
+        return bool(await cache.aget(get_sticky_key(get_client_ip(request))))
+
+    def get_state(self, request, sticky=None):
+        """Маршрут запроса; sticky - уже прочитанная отметка чтения своих записей"""
+        if not self.routes(request):
+            return None
+        pool = get_replica_pool()
+        if request.method not in SAFE_METHODS:
+            return RoutingState(pool, primary=True)
+        if sticky is None:
+            sticky = bool(cache.get(get_sticky_key(get_client_ip(request))))
+        return RoutingState(pool, primary=sticky, sticky=sticky)
+
+    def wrote(self, request, response):
+        return request.method not in SAFE_METHODS and response.status_code < 400
+
+    def finish(self, request, response, state):
+        if self.wrote(request, response):
+            cache.set(get_sticky_key(get_client_ip(request)), 1, get_replica_config()["STICKY_SECONDS"])
+        elif response.streaming and not response.is_async:
+            response.streaming_content = stream_with_routing(response.streaming_content, state)
+        return response
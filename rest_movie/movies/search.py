@@ -0,0 +1,105 @@
+"""Полнотекстовый поиск по каталогу фильмов
+
+Индекс лежит в отдельной таблице movies_movie_search (см. миграцию 0006):
+в PostgreSQL это tsvector с GIN-индексом, в SQLite (тесты и замеры) -
+виртуальная таблица FTS5. В индекс входят название, слоган, описание и имена
+актёров фильма, обновляется он сигналами (movies/signals.py), после массовой
+загрузки - командой rebuild_search_index.
+"""
+import re
+
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
+
+from .models import Actor, Movie
+
+SEARCH_TABLE = "movies_movie_search"
+# словарь PostgreSQL для стемминга: описания в каталоге на русском
+SEARCH_CONFIG = "russian"
+# веса полей для bm25 в FTS5: название, слоган, описание, актёры
+FTS5_WEIGHTS = (10.0, 4.0, 1.0, 4.0)
+
+
+def update_search_index(movie_ids=None, using="default"):
+    """Пересобрать записи индекса фильмов movie_ids (None - всех) одним запросом на удаление и вставку"""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    movie_table = qn(Movie._meta.db_table)
+    actors_table = qn(Movie.actors.through._meta.db_table)
+    actor_table = qn(Actor._meta.db_table)
+    movie_ids = None if movie_ids is None else list(movie_ids)
+    if movie_ids == []:
+        return
+
+    if connection.vendor == "postgresql":
+        key = "movie_id"
+        actor_names = "string_agg(a.name, ' ')"
+        columns = "movie_id, document"
+        document = (
+            "setweight(to_tsvector(%(config)s, m.title), 'A') || "
+            "setweight(to_tsvector(%(config)s, m.tagline), 'B') || "
+            "setweight(to_tsvector(%(config)s, {actors}), 'B') || "
+            "setweight(to_tsvector(%(config)s, m.description), 'C')"
+        )
+    else:
+        key = "rowid"
+        actor_names = "group_concat(a.name, ' ')"
+        columns = "rowid, title, tagline, description, actors"
+        document = "m.title, m.tagline, m.description, {actors}"
+    # имена актёров склеиваются коррелированным подзапросом по промежуточной таблице
+    actors = (
+        f"coalesce((SELECT {actor_names} FROM {actors_table} ma JOIN {actor_table} a ON a.id = ma.actor_id "
+        f"WHERE ma.movie_id = m.id), '')"
+    )
+    document = document.format(actors=actors).replace("%(config)s", f"'{SEARCH_CONFIG}'")
+
+    where, params = "", []
+    if movie_ids is not None:
+        where = f"IN ({', '.join(['%s'] * len(movie_ids))})"
+        params = movie_ids
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}" + (f" WHERE {key} {where}" if where else ""), params)
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({columns}) SELECT m.id, {document} FROM {movie_table} m"
+            + (f" WHERE m.id {where}" if where else ""),
+            params,
+        )
+
+
+def get_fts5_query(query):
+    """Запрос пользователя в синтаксисе MATCH: каждое слово в кавычках и по префиксу"""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", query.lower()))
+
+
+def search_movies(queryset, query, ranked=True):
+    """Фильмы queryset, подходящие под query, с релевантностью в search_rank (больше - лучше)
+
+    ranked=False только фильтрует: подзапрос ранга ссылается на внешнюю таблицу
+    и не годится для запросов, которые Django сам оборачивает в подзапрос.
+    """
+    vendor = connections[queryset.db].vendor
+    if vendor == "postgresql":
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        matched = RawSQL(f"SELECT movie_id FROM {SEARCH_TABLE} WHERE document @@ {tsquery}", (query,))
+        # ::float8, чтобы ранг без потерь проходил через курсор KeysetPagination
+        rank = RawSQL(
+            f"SELECT ts_rank_cd(document, {tsquery})::float8 FROM {SEARCH_TABLE} "
+            f"WHERE movie_id = {queryset.model._meta.db_table}.id",
+            (query,), output_field=models.FloatField(),
+        )
+    else:
+        query = get_fts5_query(query)
+        if not query:
+            # в запросе нет ни одного слова; search_rank нужен сортировке по релевантности
+            queryset = queryset.none()
+            return queryset.annotate(search_rank=models.Value(0.0)) if ranked else queryset
+        weights = ", ".join(map(str, FTS5_WEIGHTS))
+        matched = RawSQL(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", (query,))
+        # bm25 тем меньше, чем документ релевантнее
+        rank = RawSQL(
+            f"SELECT -bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH %s AND rowid = {queryset.model._meta.db_table}.id",
+            (query,), output_field=models.FloatField(),
+        )
+    queryset = queryset.filter(pk__in=matched)
+    return queryset.annotate(search_rank=rank) if ranked else queryset
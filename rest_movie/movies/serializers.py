@@ -1,6 +1,14 @@
+from datetime import date
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import filepath_to_uri
 from rest_framework import serializers
 
-from .models import Movie, Review, Rating, Actor
+from .models import Movie, Review, Rating, RatingStar, Actor
+from .buffer import buffer_ratings, get_rating_buffer
+from .images import get_image_field
+from .metrics import serialization_timer
+from .service import save_ratings
 
 
 class FilterReviewListSerializer(serializers.ListSerializer):
@@ -9,8 +17,10 @@ class FilterReviewListSerializer(serializers.ListSerializer):
     # Задача метода to_representation — представить извлечённые из записи данные в определённом виде.
     # data - это наш queryset
     def to_representation(self, data):
-        # фильтруем и находим только те записи у которых нет родителя
-        data = data.filter(parent=None)
+        # фильтруем и находим только те записи у которых нет родителя.
+        # Список - это уже собранные корни дерева (Movie.get_review_tree)
+        if not isinstance(data, list):
+            data = data.filter(parent=None)
         return super().to_representation(data)
 
 
@@ -24,25 +34,121 @@ class RecursiveSerializer(serializers.Serializer):
         return serializer.data
 
 
-class ActorListSerializer(serializers.ModelSerializer):
+class ImageVariantsField(serializers.Field):
+    """Адреса уменьшенных копий изображения (movies/images.py): {вариант: url}"""
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self.storage = parent.Meta.model._meta.get_field(get_image_field(self.source)).storage
+
+    def to_representation(self, names):
+        # как FileField.to_representation: абсолютный url, если есть запрос
+        request = self.context.get("request")
+        urls = {variant: self.storage.url(name) for variant, name in names.items()}
+        if request is not None:
+            urls = {variant: request.build_absolute_uri(url) for variant, url in urls.items()}
+        return urls
+
+
+class TimedSerializerMixin:
+    """Время вывода идёт в serialize заголовка Server-Timing (movies.metrics)"""
+
+    def to_representation(self, instance):
+        with serialization_timer():
+            return super().to_representation(instance)
+
+
+class ActorListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Вывод списка актёров и режиссёров"""
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Actor
-        fields = ("id", "name", "image")
+        fields = ("id", "name", "image", "image_variants")
+
+
+class ValuesListSerializer:
+    """Быстрый вывод списка только для чтения из строк .values()
+
+    Выдаёт тот же JSON, что и ModelSerializer, но без полей DRF на каждую запись:
+    преобразования колонок и префикс url медиафайлов вычисляются один раз.
+    """
+    model = None
+    # (ключ в ответе, колонка в .values(), преобразование). None в колонке
+    # выводится как null, как это делает Serializer.to_representation
+    fields = ()
+
+    def __init__(self, context=None):
+        self.context = context or {}
+        self.columns = [column for _, column, _ in self.fields]
+        self.accessors = [
+            (key, column, self.get_converter(column, convert))
+            for key, column, convert in self.fields
+        ]
+
+    def get_converter(self, column, convert):
+        if convert == "media":
+            return self.get_media_url(column)
+        if convert == "media_variants":
+            # {вариант: имя файла} копий изображения, как ImageVariantsField
+            url = self.get_media_url(get_image_field(column))
+            return lambda names: {variant: url(name) for variant, name in names.items()}
+        return convert
+
+    def get_media_url(self, column):
+        """Аналог FileField.to_representation: абсолютный url по имени файла"""
+        storage = self.model._meta.get_field(column).storage
+        request = self.context.get("request")
+        # __class__, а не type(): default_storage - ленивая обёртка над хранилищем
+        if storage.__class__ is FileSystemStorage:
+            prefix = storage.base_url
+            if request is not None:
+                prefix = request.build_absolute_uri(prefix)
+            return lambda name: prefix + filepath_to_uri(name).lstrip("/") if name else None
+        if request is not None:
+            return lambda name: request.build_absolute_uri(storage.url(name)) if name else None
+        return lambda name: storage.url(name) if name else None
+
+    def to_representation(self, rows):
+        accessors = self.accessors
+        with serialization_timer():
+            return [
+                {
+                    key: None if row[column] is None else convert(row[column]) if convert else row[column]
+                    for key, column, convert in accessors
+                }
+                for row in rows
+            ]
 
 
-class ActorDetailSerializer(serializers.ModelSerializer):
+class ActorValuesSerializer(ValuesListSerializer):
+    """Быстрый вывод списка актёров, JSON как у ActorListSerializer"""
+    model = Actor
+    fields = (
+        ("id", "id", None),
+        ("name", "name", str),
+        ("image", "image", "media"),
+        ("image_variants", "image_variants", "media_variants"),
+    )
+
+
+class ActorDetailSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Вывод полного списка актёра или режиссёра"""
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Actor
-        fields = "__all__"
+        # version и updated отдаются заголовками ETag и Last-Modified
+        exclude = ("version", "updated")
 
 
 # Сериализаторы нужны для того что бы преобразовывать типы данных питон в
 # json и обратно
-class MovieListSerializer(serializers.ModelSerializer):
+class MovieListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Список фильмов"""
     rating_user = serializers.BooleanField()
     middle_star = serializers.IntegerField()
@@ -53,7 +159,40 @@ class MovieListSerializer(serializers.ModelSerializer):
         fields = ("id", "title", "tagline", "category", "rating_user", "middle_star")
 
 
-class ReviewCreateSerializer(serializers.ModelSerializer):
+class MovieValuesSerializer(ValuesListSerializer):
+    """Быстрый вывод списка фильмов, JSON как у MovieListSerializer"""
+    model = Movie
+    fields = (
+        ("id", "id", None),
+        ("title", "title", str),
+        ("tagline", "tagline", str),
+        ("category", "category_id", None),
+        ("rating_user", "rating_user", bool),
+        ("middle_star", "middle_star", int),
+    )
+
+
+class MovieExportSerializer(ValuesListSerializer):
+    """Поля фильма для выгрузки каталога (movies/export.py), связи добавляет выгрузка"""
+    model = Movie
+    fields = (
+        ("id", "id", None),
+        ("url", "url", str),
+        ("title", "title", str),
+        ("tagline", "tagline", str),
+        ("description", "description", str),
+        ("year", "year", None),
+        ("country", "country", str),
+        ("world_premiere", "world_premiere", date.isoformat),
+        ("budget", "budget", None),
+        ("fess_in_usa", "fess_in_usa", None),
+        ("fess_in_world", "fess_in_world", None),
+        ("poster", "poster", "media"),
+        ("poster_variants", "poster_variants", "media_variants"),
+    )
+
+
+class ReviewCreateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Добавление отзыва"""
 
     class Meta:
@@ -63,7 +202,8 @@ class ReviewCreateSerializer(serializers.ModelSerializer):
 
 class ReviewSerializer(serializers.ModelSerializer):
     """Вывод отзыва"""
-    children = RecursiveSerializer(many=True)
+    # tree_children проставляет Movie.get_review_tree, поэтому потомки не запрашиваются из бд
+    children = RecursiveSerializer(many=True, source="tree_children")
 
     class Meta:
         list_serializer_class = FilterReviewListSerializer
@@ -72,7 +212,7 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 
 # Сериализатор для вывода полного фильма
-class MovieDetailSerializer(serializers.ModelSerializer):
+class MovieDetailSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Подробный фильм"""
     # slug_field="name" - name это поля в модели category и мы указываем
     # что бы для нашей category выводился не id, а поле name. И дальше мы
@@ -83,14 +223,15 @@ class MovieDetailSerializer(serializers.ModelSerializer):
     directors = ActorListSerializer(read_only=True, many=True)
     actors = ActorListSerializer(read_only=True, many=True)
     genres = serializers.SlugRelatedField(slug_field="name", read_only=True, many=True)
-    reviews = ReviewSerializer(many=True)
+    reviews = ReviewSerializer(many=True, source="get_review_tree")
+    poster_variants = ImageVariantsField()
 
     class Meta:
         model = Movie
-        exclude = ("draft",)
+        exclude = ("draft", "version", "updated")
 
 
-class CreateRatingSerializer(serializers.ModelSerializer):
+class CreateRatingSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Добавление рейтинга пользователя"""
 
     class Meta:
@@ -98,18 +239,53 @@ class CreateRatingSerializer(serializers.ModelSerializer):
         fields = ("star", "movie")
 
     def create(self, validated_data):
-        # в поля ip, movie мы забираем из validated_data с помощью метода get
-        # наши поля ip,movie. validated_data - Это данные которые мы передаём в
-        # наш сериализатор от клиентской стороны и обновлять мы будем поле star
-        # Если такой ip и movie у нас уже существует то заново создавать
-        # мы не будем, а defaults будет просто перезаписывать значение(оценку)
-        # мы добавили _ что бы в него записывался true или false, что бы переменная
-        # rating не была кортежом. Разделив тем самых их на 2 переменные. Наш объект
-        # будет передаваться в перем. rating, а в _ будет передавться true или
-        # false (то есть обновилась или создалась запись)
-        rating, _ = Rating.objects.update_or_create(
-            ip=validated_data.get('ip', None),
-            movie=validated_data.get('movie', None),
-            defaults={'star': validated_data.get("star")}
-        )
-        return rating
+        # ip и movie забираем из validated_data. Если оценка с таким ip для фильма
+        # уже существует, заново её не создаём, а только перезаписываем звезду.
+        movie = validated_data["movie"]
+        ratings = save_or_buffer_ratings(validated_data.get("ip", None), {movie.pk: validated_data["star"]})
+        if not ratings:
+            # фильм удалили между проверкой и upsert_ratings
+            message = serializers.PrimaryKeyRelatedField.default_error_messages["does_not_exist"]
+            raise serializers.ValidationError({"movie": [message.format(pk_value=movie.pk)]})
+        return ratings[0]
+
+
+class RatingItemSerializer(serializers.Serializer):
+    """Одна оценка из пакета: id фильма и id звезды"""
+    movie = serializers.IntegerField()
+    star = serializers.IntegerField()
+
+
+class CreateRatingBulkSerializer(TimedSerializerMixin, serializers.Serializer):
+    """Добавление нескольких оценок пользователя одним запросом"""
+    ratings = RatingItemSerializer(many=True, allow_empty=False, max_length=500)
+
+    def validate_ratings(self, ratings):
+        # Фильмы и звёзды всего пакета проверяем двумя запросами, а не по одному на оценку
+        movies = set(Movie.objects.filter(pk__in={item["movie"] for item in ratings}).values_list("pk", flat=True))
+        stars = RatingStar.objects.in_bulk({item["star"] for item in ratings})
+        # то же сообщение, что и у PrimaryKeyRelatedField в CreateRatingSerializer
+        message = serializers.PrimaryKeyRelatedField.default_error_messages["does_not_exist"]
+        errors = []
+        for item in ratings:
+            error = {}
+            if item["movie"] not in movies:
+                error["movie"] = [message.format(pk_value=item["movie"])]
+            if item["star"] not in stars:
+                error["star"] = [message.format(pk_value=item["star"])]
+            errors.append(error)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        # если фильм встречается в пакете несколько раз, побеждает последняя оценка
+        return {item["movie"]: stars[item["star"]] for item in ratings}
+
+    def create(self, validated_data):
+        return save_or_buffer_ratings(validated_data["ip"], validated_data["ratings"])
+
+
+def save_or_buffer_ratings(ip, stars):
+    """При включённом RATING_WRITE_BEHIND оценки уходят в буфер, иначе сразу в бд"""
+    buffer = get_rating_buffer()
+    if buffer is not None:
+        return buffer_ratings(buffer, ip, stars)
+    return save_ratings(ip, stars)
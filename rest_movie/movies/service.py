@@ -1,5 +1,27 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import partial
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections, models, transaction
+from django.db.models.functions import NullIf
+from django.http import Http404
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.db.models import Q
 from django_filters import rest_framework as filters
-from movies.models import Movie
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from movies.catalog_index import get_catalog_index, get_catalog_index_config
+from movies.filmography import get_credit_rating, refresh_movie_filmography
+from movies.models import Category, Change, Movie, Rating, average_rating
+from movies.search import search_movies
+from movies.utils import bump_movie_rating_version
 
 
 def get_client_ip(request):
@@ -11,6 +33,196 @@ def get_client_ip(request):
     return ip
 
 
+def save_ratings(ip, stars):
+    """Записать оценки ip одним upsert и обновить агрегаты рейтинга фильмов
+
+    stars - словарь {id фильма: RatingStar}. Повторная оценка фильма с того же
+    ip перезаписывает звезду (уникальность ip + movie). Возвращает оценки.
+    """
+    return upsert_ratings({(ip, movie_id): star for movie_id, star in stars.items()})
+
+
+def upsert_ratings(stars):
+    """То же, что save_ratings, для оценок с разных ip: {(ip, id фильма): RatingStar}"""
+    with transaction.atomic():
+        # Блокируем строки фильмов в порядке id: оценки одного фильма проходят
+        # последовательно, и агрегаты на Movie не расходятся с таблицей Rating
+        movies = {
+            movie.pk: movie
+            for movie in Movie.objects.select_for_update()
+            .filter(pk__in={movie_id for _, movie_id in stars})
+            .only("id", "rating_count", "rating_sum", "rating_histogram", "version")
+            .order_by("pk")
+        }
+        ips = {ip for ip, _ in stars}
+        old = {
+            (ip, movie_id): (star_id, value)
+            for ip, movie_id, star_id, value in Rating.objects.filter(ip__in=ips, movie_id__in=movies)
+            .values_list("ip", "movie_id", "star_id", "star__value")
+            if (ip, movie_id) in stars
+        }
+        ratings = [
+            Rating(ip=ip, movie_id=movie_id, star=star)
+            for (ip, movie_id), star in stars.items() if movie_id in movies
+        ]
+        changed = [rating for rating in ratings if old.get((rating.ip, rating.movie_id), (None,))[0] != rating.star_id]
+        if not changed:
+            return ratings
+        Rating.objects.bulk_create(
+            changed, update_conflicts=True, unique_fields=["ip", "movie"], update_fields=["star"]
+        )
+        shown = {pk: get_credit_rating(movie.rating_sum, movie.rating_count) for pk, movie in movies.items()}
+        now = timezone.now()
+        for rating in changed:
+            movie = movies[rating.movie_id]
+            movie.apply_rating(old.get((rating.ip, rating.movie_id), (None, None))[1], rating.star.value)
+            movie.version += 1
+            movie.updated = now
+        changed_movies = {rating.movie_id: movies[rating.movie_id] for rating in changed}
+        Movie.objects.bulk_update(
+            list(changed_movies.values()), ["rating_count", "rating_sum", "rating_histogram", "version", "updated"],
+        )
+        # bulk_create не возвращает id обновлённых строк, берём их для журнала изменений
+        keys = {(rating.ip, rating.movie_id) for rating in changed}
+        rating_ids = {
+            (ip, movie_id): pk
+            for pk, ip, movie_id in Rating.objects.filter(ip__in={ip for ip, _ in keys}, movie_id__in=changed_movies)
+            .values_list("pk", "ip", "movie_id")
+            if (ip, movie_id) in keys
+        }
+        Change.record(Rating, [rating_ids[key] for key in keys if key not in old], Change.CREATED)
+        Change.record(Rating, [rating_ids[key] for key in keys if key in old], Change.UPDATED)
+        Change.record(Movie, changed_movies, Change.UPDATED)
+        # Средняя оценка фильма входит в фильмографию его актёров с округлением,
+        # пересчитываем её только у фильмов, где округлённая оценка сменилась:
+        # иначе каждая оценка переписывала бы сводки и версии всех актёров фильма.
+        # Пересчёт после коммита, чтобы не блокировать актёров при заблокированных фильмах
+        refresh_movie_filmography([
+            pk for pk, movie in changed_movies.items()
+            if get_credit_rating(movie.rating_sum, movie.rating_count) != shown[pk]
+        ])
+    # средняя оценка подставляется в список поверх кэша, а порядок страниц по
+    # рейтингу из кэша сбрасываем сами: bulk_update не шлёт post_save
+    bump_movie_rating_version()
+    return ratings
+
+
+def apply_rating_change(movie_id, old_value, new_value):
+    """Поправить агрегаты рейтинга фильма на одну оценку в обход upsert_ratings
+
+    Правка оценки в админке и удаление оценки (админка, каскад от RatingStar).
+    Фильм сохраняется через save: сигналы поднимают версию, сбрасывают кэш
+    списка и пересчитывают фильмографию, как после upsert_ratings.
+    """
+    with transaction.atomic():
+        movie = (
+            Movie.objects.select_for_update().filter(pk=movie_id)
+            .only("id", "poster", "rating_count", "rating_sum", "rating_histogram", "version").first()
+        )
+        if movie is None:
+            return
+        movie.apply_rating(old_value, new_value)
+        movie.save(update_fields=["rating_count", "rating_sum", "rating_histogram"])
+    bump_movie_rating_version()
+
+
+def get_page_ratings(movie_ids, ip):
+    """(id, middle_star, rating_user) фильмов страницы списка одним запросом
+
+    Оценки меняются чаще всего остального, поэтому в общем кэше списка они не
+    хранятся: свежие агрегаты и оценка ip подставляются поверх записи кэша.
+    middle_star - то же целочисленное деление, что в MovieListView.get_queryset.
+    """
+    return Movie.objects.filter(pk__in=movie_ids).annotate(
+        middle_star=models.F("rating_sum") / NullIf(models.F("rating_count"), 0),
+        rating_user=models.Exists(Rating.objects.filter(movie=models.OuterRef("pk"), ip=ip)),
+    ).values_list("id", "middle_star", "rating_user")
+
+
+def overlay_page_ratings(results, ratings):
+    """Строки страницы из кэша со значениями get_page_ratings"""
+    ratings = {movie_id: (middle_star, rated) for movie_id, middle_star, rated in ratings}
+    return [
+        {**row, "middle_star": ratings[row["id"]][0], "rating_user": ratings[row["id"]][1]}
+        if row["id"] in ratings else row
+        for row in results
+    ]
+
+
+def get_estimated_count(model, using="default"):
+    """Число строк таблицы по статистике бд или None, если статистики нет
+
+    PostgreSQL ведёт её сам (pg_class.reltuples), в SQLite она появляется
+    после ANALYZE (sqlite_stat1).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", [table])
+        elif connection.vendor == "sqlite":
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            # первое число stat - строк в таблице
+            cursor.execute("SELECT max(CAST(stat AS INTEGER)) FROM sqlite_stat1 WHERE tbl = %s", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    # reltuples -1: таблицу ещё не анализировали
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Пагинатор списков админки для больших таблиц
+
+    Без фильтров и поиска число записей берётся из статистики бд, если таблица
+    больше ADMIN_ESTIMATED_COUNT_THRESHOLD строк: точный COUNT(*) по такой
+    таблице читает её целиком. Последние страницы при этом могут оказаться пустыми.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = get_estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class ConditionalGetMixin:
+    """Ответ 304 на If-None-Match / If-Modified-Since без загрузки объекта
+
+    Сверяет только version и updated записи (см. VersionedModel), объект
+    загружается и сериализуется лишь когда клиенту нужен новый ответ.
+    """
+
+    @staticmethod
+    def get_validators(model, pk, version, updated):
+        """ETag и Last-Modified (в секундах) записи по её версии"""
+        return quote_etag(f"{model._meta.model_name}-{pk}-{version}"), int(updated.timestamp())
+
+    def get_object_version(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.get_queryset().filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        row = queryset.values_list("pk", "version", "updated").first()
+        if row is None:
+            raise Http404
+        return row
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(self.get_queryset().model, *self.get_object_version())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
+
+
 class CharFilterInFilter(filters.BaseInFilter, filters.CharFilter):
     pass
 
@@ -18,10 +230,303 @@ class CharFilterInFilter(filters.BaseInFilter, filters.CharFilter):
 # указывает поля и доп логику с помощью которой мы будем фильтровать
 class MovieFilter(filters.FilterSet):
     # field_name - поле по которому мы должны искать. lookup_expr - указываем
-    # как нужно фильтровать
-    genres = CharFilterInFilter(field_name='genres__name', lookup_expr='in')
+    # как нужно фильтровать. distinct убирает дубли фильма при нескольких жанрах
+    genres = CharFilterInFilter(field_name='genres__name', lookup_expr='in', distinct=True)
     year = filters.RangeFilter()
+    # полнотекстовый поиск по названию, слогану, описанию и актёрам (movies.search)
+    search = filters.CharFilter(method='filter_search')
 
     class Meta:
         model = Movie
-        fields = ['genres', 'year']
+        fields = ['genres', 'year', 'search']
+
+    def filter_search(self, queryset, name, value):
+        return search_movies(queryset, value)
+
+    def filter_queryset(self, queryset):
+        """Жанры и год по возможности берутся из индекса каталога (movies.catalog_index)
+
+        Индекс знает только опубликованные фильмы, как и списки, где стоит этот фильтр.
+        """
+        data = self.form.cleaned_data
+        index = get_catalog_index()
+        if index is None or not (data.get("genres") or data.get("year")):
+            return super().filter_queryset(queryset)
+        year = data.get("year") or slice(None, None)
+        ids = index.resolve(data.get("genres"), year.start, year.stop, limit=self.get_max_ids(queryset))
+        if ids is None:
+            return super().filter_queryset(queryset)
+        queryset = queryset.filter(pk__in=ids)
+        for name, value in data.items():
+            if name not in ("genres", "year"):
+                queryset = self.filters[name].filter(queryset, value)
+        return queryset
+
+    @staticmethod
+    def get_max_ids(queryset):
+        # SQLite ограничивает число параметров запроса, запас оставлен под остальные фильтры
+        max_params = connections[queryset.db].features.max_query_params
+        limit = get_catalog_index_config()["MAX_IDS"]
+        return limit if max_params is None else min(limit, max_params - 100)
+
+
+# ширина корзины лет в фасетах: десятилетия
+FACET_YEAR_BUCKET = 10
+
+
+def get_movie_facets(filterset):
+    """Число фильмов по жанрам, десятилетиям, странам и категориям в выдаче фильтра
+
+    С прогретым индексом каталога считается в памяти, иначе COUNT(*) и четырьмя
+    группировками по отобранным фильмам. Плюс один запрос названий категорий.
+    """
+    data = filterset.form.cleaned_data
+    index = get_catalog_index()
+    counts = None
+    if index is not None and not data.get("search") and index.is_fresh():
+        year = data.get("year") or slice(None, None)
+        bits = index.match(data.get("genres"), year.start, year.stop)
+        counts = index.facets(bits, FACET_YEAR_BUCKET)
+    if counts is None:
+        counts = get_movie_facets_sql(filterset.qs)
+
+    categories = Category.objects.in_bulk([pk for pk in counts["categories"] if pk is not None])
+
+    def ordered(facet):
+        # самые частые значения первыми
+        return sorted(counts[facet].items(), key=lambda item: (-item[1], str(item[0])))
+
+    return {
+        "count": counts["count"],
+        "genres": [{"name": name, "count": total} for name, total in ordered("genres")],
+        "years": [
+            {"from": bucket, "to": bucket + FACET_YEAR_BUCKET - 1, "count": counts["years"][bucket]}
+            for bucket in sorted(counts["years"])
+        ],
+        "countries": [{"name": name, "count": total} for name, total in ordered("countries")],
+        "categories": [
+            {"id": pk, "name": categories[pk].name if pk is not None else None, "count": total}
+            for pk, total in ordered("categories") if pk is None or pk in categories
+        ],
+    }
+
+
+def get_movie_facets_sql(queryset):
+    # фильтр жанров с distinct размножает строки, поэтому группируем по подзапросу id
+    movies = Movie.objects.filter(pk__in=queryset.values("pk"))
+    bucket = models.ExpressionWrapper(
+        models.F("year") / FACET_YEAR_BUCKET * FACET_YEAR_BUCKET, output_field=models.IntegerField()
+    )
+    genres = (
+        Movie.genres.through.objects.filter(movie__in=movies)
+        .values_list("genre__name").annotate(total=models.Count("movie_id")).order_by()
+    )
+    return {
+        "count": movies.count(),
+        "genres": dict(genres),
+        "years": dict(movies.values_list(bucket).annotate(total=models.Count("id")).order_by()),
+        "countries": dict(movies.values_list("country").annotate(total=models.Count("id")).order_by()),
+        "categories": dict(movies.values_list("category_id").annotate(total=models.Count("id")).order_by()),
+    }
+
+
+class RowComparison(models.Expression):
+    """(a, b, ...) > (x, y, ...) одним сравнением строк, как его пишут SQLite и PostgreSQL
+
+    В отличие от a > x OR (a = x AND b > y) бд читает такое условие как начало
+    диапазона составного индекса. Значения приводятся к типам выражений слева
+    при построении запроса, неверное значение даёт ValueError сразу в filter().
+    SQLite не ищет по индексу на выражении через сравнение строк, поэтому
+    первому полю добавлено своё нестрогое условие a >= x.
+    """
+    output_field = models.BooleanField()
+    conditional = True
+
+    def __init__(self, expressions, lookup, values):
+        super().__init__()
+        self.expressions = list(expressions)
+        self.operator = {"gt": ">", "lt": "<"}[lookup]
+        self.values = list(values)
+
+    def get_source_expressions(self):
+        return self.expressions
+
+    def set_source_expressions(self, expressions):
+        self.expressions = list(expressions)
+
+    def resolve_expression(self, *args, **kwargs):
+        resolved = super().resolve_expression(*args, **kwargs)
+        prepared = []
+        for expression, value in zip(resolved.expressions, resolved.values):
+            if value is None:
+                raise ValueError("Позиция курсора не может содержать null")
+            prepared.append(expression.output_field.get_prep_value(value))
+        resolved.values = prepared
+        return resolved
+
+    def as_sql(self, compiler, connection):
+        sqls, params = [], []
+        for expression in self.expressions:
+            sql, expression_params = compiler.compile(expression)
+            sqls.append(sql)
+            params.extend(expression_params)
+        placeholders = ", ".join(["%s"] * len(self.values))
+        sql = f"({', '.join(sqls)}) {self.operator} ({placeholders})"
+        params = [*params, *self.values]
+        if len(self.expressions) > 1:
+            first_sql, first_params = compiler.compile(self.expressions[0])
+            sql = f"{first_sql} {self.operator}= %s AND {sql}"
+            params = [*first_params, self.values[0], *params]
+        return f"({sql})", params
+
+
+class KeysetPagination(CursorPagination):
+    """Постраничный вывод по ключу (keyset) с непрозрачным курсором
+
+    В отличие от CursorPagination позиция хранит значения всех полей сортировки,
+    последнее из которых уникально, поэтому страница выбирается одним
+    WHERE (ключ) > (позиция) без OFFSET на любой глубине.
+    """
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering_query_param = "ordering"
+    # имя сортировки из ?ordering= -> поля ключа
+    orderings = {
+        "id": ("id",),
+        "-id": ("-id",),
+    }
+    default_ordering = "id"
+    # выражения для полей ключа, которых нет среди колонок модели
+    annotations = {}
+
+    def get_orderings(self, request):
+        """Сортировки, доступные для запроса, и сортировка по умолчанию"""
+        return self.orderings, self.default_ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.take_page(list(self.get_page_queryset(queryset, request)))
+
+    def get_page_queryset(self, queryset, request):
+        """Запрос строк страницы без выполнения: его читает и list(), и async for"""
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        orderings, default_ordering = self.get_orderings(request)
+        self.ordering_name = request.query_params.get(self.ordering_query_param, default_ordering)
+        if self.ordering_name not in orderings:
+            raise ValidationError({self.ordering_query_param: f"Доступные сортировки: {', '.join(orderings)}"})
+        self.ordering = orderings[self.ordering_name]
+
+        position, self.reverse = self.decode_cursor(request)
+        self.has_position = position is not None
+        # Поля ключа выбираются под своими именами keyset_N, поэтому позиция
+        # читается одинаково из моделей и из словарей .values()
+        self.keys = [f"keyset_{i}" for i in range(len(self.ordering))]
+        queryset = queryset.annotate(**{
+            key: self.annotations.get(field.lstrip("-"), models.F(field.lstrip("-")))
+            for key, field in zip(self.keys, self.ordering)
+        })
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.get_keyset_filter(position, self.reverse))
+            except (TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        ordering = [
+            f"-{key}" if field.startswith("-") != self.reverse else key
+            for key, field in zip(self.keys, self.ordering)
+        ]
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        return queryset.order_by(*ordering)[:self.page_size + 1]
+
+    def take_page(self, results):
+        """Страница из строк get_page_queryset"""
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.has_position, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.has_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_keyset_filter(self, position, reverse):
+        """(a, b) > (x, y) с учётом направления полей
+
+        Поля одного направления сравниваются строкой (RowComparison), разных -
+        в виде a > x OR (a = x AND b < y).
+        """
+        directions = {field.startswith("-") != reverse for field in self.ordering}
+        if len(directions) == 1:
+            lookup = "lt" if directions.pop() else "gt"
+            return RowComparison([models.F(key) for key in self.keys], lookup, position)
+        condition = Q()
+        equal = {}
+        for key, field, value in zip(self.keys, self.ordering, position):
+            descending = field.startswith("-") != reverse
+            condition |= Q(**equal, **{f"{key}__{'lt' if descending else 'gt'}": value})
+            equal[key] = value
+        return condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            position, reverse = cursor["p"], bool(cursor["r"])
+            valid = cursor["o"] == self.ordering_name and len(position) == len(self.ordering)
+        except (TypeError, ValueError, KeyError):
+            valid = False
+        if not valid:
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, instance, reverse):
+        # строки бывают и моделями, и словарями из .values()
+        get = instance.get if isinstance(instance, dict) else partial(getattr, instance)
+        position = [get(key) for key in self.keys]
+        cursor = json.dumps({"o": self.ordering_name, "p": position, "r": int(reverse)}, separators=(",", ":"))
+        encoded = urlsafe_b64encode(cursor.encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+
+class MoviePagination(KeysetPagination):
+    """Постраничный вывод фильмов по id, году или рейтингу"""
+    orderings = {
+        "id": ("id",),
+        "-id": ("-id",),
+        "year": ("year", "id"),
+        "-year": ("-year", "-id"),
+        "rating": ("rating", "id"),
+        "-rating": ("-rating", "-id"),
+    }
+    annotations = {
+        # то же выражение, что в индексе movie_published_rating_idx
+        "rating": average_rating(),
+    }
+
+    def get_orderings(self, request):
+        # search_rank добавляет MovieFilter.filter_search, поэтому сортировка
+        # по релевантности есть только у поиска и для него выбрана по умолчанию
+        if request.query_params.get("search", "").strip():
+            return {"relevance": ("-search_rank", "-id"), **self.orderings}, "relevance"
+        return super().get_orderings(request)
+
+
+class ActorPagination(KeysetPagination):
+    """Постраничный вывод актёров"""
@@ -0,0 +1,271 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Q, QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .catalog_index import get_catalog_index
+from .filmography import get_movie_actor_ids, refresh_filmography, refresh_movie_filmography
+from .images import IMAGE_FIELDS, schedule_variants
+from .models import Actor, Category, Change, Genre, Movie, MovieShots, Rating, RatingStar, Review
+from .search import update_search_index
+from .service import apply_rating_change
+from .utils import CATALOG_VERSION_KEY, bump_catalog_version, bump_movie_list_version, increment_version
+
+# поля фильма, входящие в полнотекстовый индекс (имена актёров - отдельно)
+SEARCH_FIELDS = {"title", "tagline", "description"}
+# поля фильма, входящие в индекс фильтров каталога (жанры - отдельно)
+CATALOG_FIELDS = {"draft", "year", "country", "category"}
+# поля фильма, входящие в фильмографию его актёров и режиссёров
+FILMOGRAPHY_FIELDS = {"title", "year", "draft", "rating_sum", "rating_count"}
+
+
+def catalog_committed(movie_ids):
+    version = increment_version(CATALOG_VERSION_KEY)
+    index = get_catalog_index()
+    if index is not None and version is not None:
+        index.refresh(movie_ids, version)
+
+
+def catalog_changed(movie_ids):
+    """Версия каталога и индекс процесса меняются только после коммита:
+    откат транзакции не оставит в индексе фильмов, которых нет в бд
+    """
+    transaction.on_commit(partial(catalog_committed, set(movie_ids)))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def movie_changed(sender, **kwargs):
+    """Сохранение или удаление фильма делает кэш списка устаревшим"""
+    bump_movie_list_version()
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def movie_catalog_changed(sender, instance, update_fields=None, **kwargs):
+    """Год, страна, категория и публикация фильма входят в индекс фильтров"""
+    if update_fields is None or CATALOG_FIELDS & set(update_fields):
+        catalog_changed([instance.pk])
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_genres_catalog_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action.startswith("pre_"):
+        if reverse and action == "pre_clear":
+            instance._catalog_movie_ids = list(sender.objects.filter(genre=instance).values_list("movie_id", flat=True))
+        return
+    if not reverse:
+        movie_ids = [instance.pk]
+    elif action == "post_clear":
+        movie_ids = instance.__dict__.pop("_catalog_movie_ids", [])
+    else:
+        movie_ids = pk_set
+    catalog_changed(movie_ids)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def movie_search_changed(sender, instance, update_fields=None, **kwargs):
+    """Запись полнотекстового индекса фильма; после удаления она просто исчезает"""
+    if update_fields is None or SEARCH_FIELDS & set(update_fields):
+        update_search_index([instance.pk])
+
+
+@receiver(m2m_changed, sender=Movie.actors.through)
+def movie_actors_search_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Имена актёров входят в индекс фильма"""
+    if not reverse:
+        if action.startswith("post_"):
+            update_search_index([instance.pk])
+            bump_movie_list_version()
+        return
+    if action == "pre_clear":
+        instance._search_movie_ids = list(sender.objects.filter(actor=instance).values_list("movie_id", flat=True))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        update_search_index(pk_set if action != "post_clear" else instance.__dict__.pop("_search_movie_ids", []))
+        bump_movie_list_version()
+
+
+@receiver(post_save, sender=Actor)
+def actor_search_changed(sender, instance, created, **kwargs):
+    """Имя актёра входит в индекс его фильмов"""
+    if not created:
+        update_search_index(Movie.actors.through.objects.filter(actor=instance).values_list("movie_id", flat=True))
+        bump_movie_list_version()
+
+
+@receiver(pre_delete, sender=Actor)
+def actor_search_deleting(sender, instance, **kwargs):
+    # связи удаляемого актёра пропадают вместе с ним, фильмы запоминаем заранее
+    instance._search_movie_ids = list(
+        Movie.actors.through.objects.filter(actor=instance).values_list("movie_id", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Actor)
+def actor_search_deleted(sender, instance, **kwargs):
+    update_search_index(instance.__dict__.pop("_search_movie_ids", []))
+    bump_movie_list_version()
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_genres_changed(sender, action, **kwargs):
+    """От жанров зависит выдача фильтра genres"""
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_movie_list_version()
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+@receiver(post_save, sender=MovieShots)
+@receiver(post_delete, sender=MovieShots)
+def movie_related_changed(sender, instance, **kwargs):
+    """Отзывы и кадры входят в ответ фильма, поднимаем его версию"""
+    Movie.touch(pk=instance.movie_id)
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, origin=None, **kwargs):
+    """Удалённая оценка вычитается из агрегатов рейтинга фильма
+
+    Оценки через API пишет upsert_ratings, правку в админке учитывает
+    RatingAdmin.save_model. Оценки удаляемого фильма пропускаем: фильм
+    удаляется вместе с ними.
+    """
+    deleting = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if deleting is Movie:
+        return
+    value = RatingStar.objects.filter(pk=instance.star_id).values_list("value", flat=True).first()
+    if value is not None:
+        apply_rating_change(instance.movie_id, value, None)
+
+
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_links_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Изменение актёров, режиссёров или жанров фильма"""
+    if not reverse:
+        if action.startswith("post_"):
+            Movie.touch(pk=instance.pk)
+    elif action in ("post_add", "post_remove"):
+        Movie.touch(pk__in=pk_set)
+    elif action == "pre_clear":
+        # после очистки связей уже не узнать, какие фильмы были затронуты
+        Movie.touch(pk__in=sender.objects.filter(
+            **{instance._meta.model_name: instance}
+        ).values("movie_id"))
+
+
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def movie_credits_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Связи фильма с актёрами и режиссёрами входят в фильмографию"""
+    if reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            refresh_filmography([instance.pk])
+    elif action == "pre_clear":
+        instance._filmography_actor_ids = list(sender.objects.filter(movie=instance).values_list("actor_id", flat=True))
+    elif action in ("post_add", "post_remove"):
+        refresh_filmography(pk_set)
+    elif action == "post_clear":
+        refresh_filmography(instance.__dict__.pop("_filmography_actor_ids", []))
+
+
+@receiver(post_save, sender=Movie)
+def movie_filmography_changed(sender, instance, created, update_fields=None, **kwargs):
+    # у нового фильма ещё нет связей
+    if not created and (update_fields is None or FILMOGRAPHY_FIELDS & set(update_fields)):
+        refresh_movie_filmography([instance.pk])
+
+
+@receiver(pre_delete, sender=Movie)
+def movie_filmography_deleting(sender, instance, **kwargs):
+    # связи удаляются вместе с фильмом без сигналов m2m
+    instance._filmography_actor_ids = get_movie_actor_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Movie)
+def movie_filmography_deleted(sender, instance, **kwargs):
+    refresh_filmography(instance.__dict__.pop("_filmography_actor_ids", []))
+
+
+@receiver(post_save, sender=Actor)
+@receiver(pre_delete, sender=Actor)
+def actor_changed(sender, instance, created=False, **kwargs):
+    """Имя и фото актёра выводятся в ответе его фильмов"""
+    if not created:
+        Movie.touch(Q(actors=instance) | Q(directors=instance))
+
+
+@receiver(post_save, sender=Genre)
+@receiver(pre_delete, sender=Genre)
+def genre_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        Movie.touch(genres=instance)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalog_keys_changed(sender, created=False, **kwargs):
+    """Переименование жанра или удаление жанра и категории меняют индекс фильтров
+    целиком (связи удаляются без сигналов m2m), он перестроится по версии каталога.
+    Название категории выводится в фасетах, их кэш тоже по версии каталога.
+    """
+    if not created:
+        bump_catalog_version()
+        bump_movie_list_version()
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def category_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        Movie.touch(category=instance)
+
+
+@receiver(pre_save, sender=Actor)
+@receiver(pre_save, sender=Movie)
+@receiver(pre_save, sender=MovieShots)
+def image_uploading(sender, instance, **kwargs):
+    # до pre_save поля новый файл ещё не записан в хранилище (_committed=False)
+    file = getattr(instance, IMAGE_FIELDS[sender])
+    instance._image_uploaded = bool(file) and not file._committed
+
+
+@receiver(post_save, sender=Actor)
+@receiver(post_save, sender=Movie)
+@receiver(post_save, sender=MovieShots)
+def image_uploaded(sender, instance, **kwargs):
+    """Уменьшенные копии загруженного изображения готовятся после коммита"""
+    if instance.__dict__.pop("_image_uploaded", False):
+        transaction.on_commit(lambda: schedule_variants(instance, IMAGE_FIELDS[sender]))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_save, sender=Actor)
+@receiver(post_save, sender=Review)
+@receiver(post_save, sender=Rating)
+def change_saved(sender, instance, created, **kwargs):
+    """Записи отслеживаемых моделей попадают в журнал изменений.
+    Изменения в обход save (update, bulk) пишут туда сами, см. Change.record
+    """
+    Change.record(sender, [instance.pk], Change.CREATED if created else Change.UPDATED)
+
+
+@receiver(post_delete, sender=Movie)
+@receiver(post_delete, sender=Actor)
+@receiver(post_delete, sender=Review)
+@receiver(post_delete, sender=Rating)
+def change_deleted(sender, instance, **kwargs):
+    Change.record(sender, [instance.pk], Change.DELETED)
+
+
+@receiver(pre_delete, sender=Review)
+def review_children_orphaned(sender, instance, **kwargs):
+    """Ответам удаляемого отзыва parent обнуляется через update, без post_save"""
+    Change.record(Review, list(instance.children.values_list("pk", flat=True)), Change.UPDATED)
@@ -1,3 +1,1979 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, OperationalError, connection, connections, models, transaction
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.permissions import IsAdminUser
+from rest_framework.test import APIClient
+from rest_framework.throttling import BaseThrottle
+
+from . import buffer, catalog_index, images, metrics, replicas, service, throttling
+from .admin import ActorAdmin
+from .models import Actor, Category, Change, Genre, Movie, MovieShots, Rating, RatingStar, Review
+from .async_urls import urlpatterns as async_urlpatterns
+from .export import export_catalog
+from .images import save_variants
+from .service import EstimatedCountPaginator, upsert_ratings
+from .search import update_search_index
+from .urls import urlpatterns
+from .views import ActorsDetailView, MovieListView
+from .management.commands.bench_endpoints import parse_server_timing
+from .management.commands.explain_endpoints import find_full_scans, get_plan
+from .utils import bump_catalog_version, bump_movie_list_version, check_shared_cache, get_movie_list_version
+
+
+class CatalogMixin:
+    """Наполнение каталога тестовыми данными и подсчёт запросов к бд"""
+
+    # Размеры каталога, на которых сравнивается число запросов
+    SIZES = (1, 5, 20)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name="Фильмы", description="-", url="films")
+        self.stars = [RatingStar.objects.create(value=value) for value in range(1, 6)]
+        self.movie = Movie.objects.create(
+            title="Терминатор", description="-", country="США", url="terminator", category=self.category
+        )
+        self.actor = Actor.objects.create(name="Арнольд", description="-", image="actors/Arnold.jpg")
+        self.seeded = 0
+
+    def seed_catalog(self, size):
+        """Дорастить каталог до size элементов каждого вида у self.movie"""
+        for i in range(self.seeded, size):
+            actor = Actor.objects.create(name=f"actor{i}", description="-", image=f"actors/{i}.jpg")
+            genre = Genre.objects.create(name=f"genre{i}", description="-", url=f"genre{i}")
+            movie = Movie.objects.create(
+                title=f"movie{i}", description="-", country="США", url=f"movie{i}", category=self.category
+            )
+            movie.actors.add(actor, self.actor)
+            movie.genres.add(genre)
+            self.movie.actors.add(actor)
+            self.movie.directors.add(actor)
+            self.movie.genres.add(genre)
+            review = Review.objects.create(movie=self.movie, name=f"user{i}", email="u@u.ru", text="-")
+            Review.objects.create(movie=self.movie, name=f"reply{i}", email="u@u.ru", text="-", parent=review)
+            Rating.objects.create(movie=self.movie, ip=f"10.0.0.{i}", star=self.stars[i % 5])
+            Rating.objects.create(movie=movie, ip=f"10.0.0.{i}", star=self.stars[i % 5])
+        self.seeded = max(self.seeded, size)
+        call_command("rebuild_ratings", stdout=StringIO())
+
+    def count_queries(self, method, url, data=None, **extra):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, **extra)
+        self.assertLess(response.status_code, 300, response.content)
+        return len(queries)
+
+    def assertQueriesFlat(self, method, url, data=None, **extra):
+        """Число запросов эндпоинта не должно расти вместе с каталогом
+
+        Значения extra могут быть функциями от размера каталога, например
+        чтобы каждый запрос шёл с нового ip.
+        """
+        counts = {}
+        for size in self.SIZES:
+            self.seed_catalog(size)
+            headers = {key: value(size) if callable(value) else value for key, value in extra.items()}
+            counts[size] = self.count_queries(method, url, data, **headers)
+        self.assertEqual(len(set(counts.values())), 1, f"{method.upper()} {url}: {counts}")
+
+
+class QueryBudgetTests(CatalogMixin, TestCase):
+    """Эндпоинты из movies/urls.py не делают запросов на каждую связь"""
+
+    def test_movie_list(self):
+        self.assertQueriesFlat("get", "/api/v1/movie/")
+
+    def test_movie_detail(self):
+        self.assertQueriesFlat("get", f"/api/v1/movie/{self.movie.pk}/")
+
+    def test_actor_list(self):
+        self.assertQueriesFlat("get", "/api/v1/actors/")
+
+    def test_actor_detail(self):
+        self.assertQueriesFlat("get", f"/api/v1/actors/{self.actor.pk}/")
+
+    def test_review_create(self):
+        data = {"email": "a@a.ru", "name": "a", "text": "-", "movie": self.movie.pk}
+        self.assertQueriesFlat("post", "/api/v1/review/", data)
+
+    def test_rating_create(self):
+        # пятёрка меняет среднюю оценку на любом размере каталога, и фильмографии
+        # актёров фильма переписываются каждый раз
+        data = {"star": self.stars[4].pk, "movie": self.movie.pk}
+        self.assertQueriesFlat("post", "/api/v1/rating/", data, REMOTE_ADDR=lambda size: f"192.168.0.{size}")
+
+
+class ReviewTreeTests(CatalogMixin, TestCase):
+    """Дерево отзывов на странице фильма"""
+
+    def test_nested_json(self):
+        root = Review.objects.create(movie=self.movie, name="a", email="a@a.ru", text="1")
+        child = Review.objects.create(movie=self.movie, name="b", email="b@b.ru", text="2", parent=root)
+        Review.objects.create(movie=self.movie, name="c", email="c@c.ru", text="3", parent=child)
+        Review.objects.create(movie=self.movie, name="d", email="d@d.ru", text="4")
+
+        response = self.client.get(f"/api/v1/movie/{self.movie.pk}/")
+
+        self.assertEqual(response.json()["reviews"], [
+            {"name": "a", "text": "1", "children": [
+                {"name": "b", "text": "2", "children": [
+                    {"name": "c", "text": "3", "children": []},
+                ]},
+            ]},
+            {"name": "d", "text": "4", "children": []},
+        ])
+
+    def test_query_count_does_not_grow_with_tree(self):
+        url = f"/api/v1/movie/{self.movie.pk}/"
+        small = self.count_queries("get", url)
+        # Глубокая ветка ответов поверх уже засеянных отзывов
+        parent = None
+        for i in range(60):
+            parent = Review.objects.create(movie=self.movie, name=f"n{i}", email="n@n.ru", text="-", parent=parent)
+        self.assertEqual(self.count_queries("get", url), small)
+
+
+class KeysetPaginationTests(CatalogMixin, TestCase):
+    """Постраничный вывод фильмов и актёров по курсору"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(11)
+        # Повторяющиеся года, чтобы проверить разбор одинаковых значений ключа
+        for movie in Movie.objects.all():
+            movie.year = 2000 + movie.pk % 3
+            movie.rating_sum, movie.rating_count = movie.pk % 4, 1
+            movie.save()
+
+    def walk(self, url):
+        ids, pages = [], []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json())
+            ids += [row["id"] for row in pages[-1]["results"]]
+            url = pages[-1]["next"]
+        return ids, pages
+
+    def test_orderings(self):
+        expected = {
+            "id": list(Movie.objects.order_by("id").values_list("id", flat=True)),
+            "-year": list(Movie.objects.order_by("-year", "-id").values_list("id", flat=True)),
+            "rating": list(Movie.objects.order_by("rating_sum", "id").values_list("id", flat=True)),
+        }
+        for ordering, ids in expected.items():
+            with self.subTest(ordering=ordering):
+                self.assertEqual(self.walk(f"/api/v1/movie/?ordering={ordering}&page_size=3")[0], ids)
+
+    def test_genre_and_year_filters(self):
+        Movie.objects.get(url="movie0").genres.add(Genre.objects.get(url="genre1"))
+        expected = list(
+            Movie.objects.filter(genres__name__in=["genre0", "genre1"], year__gte=2000, year__lte=2001)
+            .distinct().order_by("year", "id").values_list("id", flat=True)
+        )
+        ids, _ = self.walk("/api/v1/movie/?genres=genre0,genre1&year_min=2000&year_max=2001&ordering=year&page_size=1")
+        self.assertEqual(ids, expected)
+
+    def test_previous_link(self):
+        _, pages = self.walk("/api/v1/movie/?ordering=-year&page_size=4")
+        response = self.client.get(pages[2]["previous"])
+        self.assertEqual(response.json()["results"], pages[1]["results"])
+        self.assertIsNone(pages[0]["previous"])
+
+    def test_actor_list(self):
+        ids, pages = self.walk("/api/v1/actors/?page_size=5")
+        self.assertEqual(ids, list(Actor.objects.order_by("id").values_list("id", flat=True)))
+        self.assertEqual(len(pages), 3)
+
+    def test_page_is_index_range(self):
+        _, pages = self.walk("/api/v1/movie/?ordering=-rating&page_size=3")
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(pages[0]["next"])
+        sql = next(query["sql"] for query in queries if "LIMIT" in query["sql"])
+        self.assertIn(") < (", sql)
+        self.assertEqual(get_plan(sql), ["SEARCH movies_movie USING INDEX movie_published_rating_idx (<expr><?)"])
+
+    def test_invalid_cursor_and_ordering(self):
+        self.assertEqual(self.client.get("/api/v1/movie/?cursor=abc").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/movie/?ordering=title").status_code, 400)
+
+
+class MovieListCacheTests(CatalogMixin, TestCase):
+    """Общий кэш списка фильмов и оценки текущего ip поверх него"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(3)
+
+    def rated_ids(self, ip):
+        response = self.client.get("/api/v1/movie/", REMOTE_ADDR=ip)
+        return {row["id"] for row in response.json()["results"] if row["rating_user"]}
+
+    def test_cache_hit_only_looks_up_client_ratings(self):
+        self.count_queries("get", "/api/v1/movie/")
+        self.assertEqual(self.count_queries("get", "/api/v1/movie/"), 1)
+
+    def test_rating_user_per_ip(self):
+        Rating.objects.create(movie=self.movie, ip="1.1.1.1", star=self.stars[0])
+        self.assertEqual(self.rated_ids("1.1.1.1"), {self.movie.pk})
+        self.assertEqual(self.rated_ids("2.2.2.2"), set())
+        self.assertEqual(
+            self.rated_ids("10.0.0.1"),
+            set(Rating.objects.filter(ip="10.0.0.1").values_list("movie_id", flat=True)),
+        )
+
+    def test_movie_save_invalidates(self):
+        self.client.get("/api/v1/movie/")
+        self.movie.title = "Терминатор 2"
+        self.movie.save()
+        titles = [row["title"] for row in self.client.get("/api/v1/movie/").json()["results"]]
+        self.assertIn("Терминатор 2", titles)
+
+    def test_rating_keeps_cache_with_fresh_average(self):
+        self.client.get("/api/v1/movie/")
+        self.client.get("/api/v1/movie/?ordering=-rating")
+        # у movie0 была самая низкая средняя оценка
+        movie = Movie.objects.get(url="movie0")
+        for i in range(3):
+            self.client.post("/api/v1/rating/", {"star": self.stars[4].pk, "movie": movie.pk}, REMOTE_ADDR=f"10.3.0.{i}")
+        with CaptureQueriesContext(connection) as queries:
+            results = self.client.get("/api/v1/movie/", REMOTE_ADDR="10.3.0.0").json()["results"]
+        # запись кэша та же, запрос один - подстановка оценок
+        self.assertEqual(len(queries), 1)
+        row = next(row for row in results if row["id"] == movie.pk)
+        self.assertEqual((row["middle_star"], row["rating_user"]), (4, True))
+        # порядок по рейтингу из кэша устарел и пересобран
+        ordered = self.client.get("/api/v1/movie/?ordering=-rating").json()["results"]
+        self.assertEqual(ordered[0]["id"], movie.pk)
+
+    def test_version_bumped_again_on_commit(self):
+        before = get_movie_list_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_movie_list_version()
+            self.assertEqual(get_movie_list_version(), before + 1)
+        self.assertEqual(get_movie_list_version(), before + 2)
+
+    def test_shared_cache_required(self):
+        with self.settings(SHARED_CACHE_REQUIRED=True):
+            with self.assertRaises(ImproperlyConfigured):
+                check_shared_cache()
+            caches = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}
+            with self.settings(CACHES=caches):
+                check_shared_cache()
+            # команды manage.py без общего кэша работают, check --deploy сообщает об ошибке
+            call_command("check", stdout=StringIO())
+            with self.assertRaisesMessage(CommandError, "movies.E001"):
+                call_command("check", "--deploy", stdout=StringIO(), stderr=StringIO())
+
+    def test_admin_actions_invalidate(self):
+        admin = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin)
+        for action, expected in (("unpublish", False), ("publish", True)):
+            self.client.get("/api/v1/movie/")
+            self.client.post("/admin/movies/movie/", {"action": action, "_selected_action": [self.movie.pk]})
+            ids = [row["id"] for row in self.client.get("/api/v1/movie/").json()["results"]]
+            self.assertEqual(self.movie.pk in ids, expected)
+
+
+class ConditionalGetTests(CatalogMixin, TestCase):
+    """ETag и Last-Modified у фильма и актёра"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(2)
+        self.url = f"/api/v1/movie/{self.movie.pk}/"
+
+    def etag(self, url=None):
+        return self.client.get(url or self.url)["ETag"]
+
+    def test_not_modified_without_loading_object(self):
+        etag = self.etag()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_related_changes_bump_version(self):
+        changes = (
+            lambda: self.client.post("/api/v1/review/", {"email": "a@a.ru", "name": "a", "text": "-", "movie": self.movie.pk}),
+            lambda: self.client.post("/api/v1/rating/", {"star": self.stars[4].pk, "movie": self.movie.pk}),
+            lambda: self.movie.genres.add(Genre.objects.create(name="new", description="-", url="new")),
+            lambda: self.actor.film_director.add(self.movie),
+            lambda: Actor.objects.get(name="actor0").delete(),
+            lambda: self.movie.ratings.first().delete(),
+        )
+        for change in changes:
+            etag = self.etag()
+            change()
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_actor_detail(self):
+        url = f"/api/v1/actors/{self.actor.pk}/"
+        etag = self.etag(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.actor.age = 75
+        self.actor.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_save_of_stale_instance_gets_new_etag(self):
+        movie = Movie.objects.get(pk=self.movie.pk)
+        # версию поднимает отзыв, пока загруженный объект ждёт сохранения
+        Review.objects.create(movie=self.movie, name="a", email="a@a.ru", text="-")
+        etag = self.etag()
+        movie.title = "Терминатор 2"
+        movie.save()
+        self.assertEqual(movie.version, Movie.objects.get(pk=self.movie.pk).version)
+        self.assertNotEqual(self.etag(), etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_draft_movie_not_found(self):
+        Movie.objects.filter(pk=self.movie.pk).update(draft=True)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class ValuesListSerializerTests(CatalogMixin, TestCase):
+    """Быстрые сериализаторы списков дают тот же JSON, что и ModelSerializer"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(4)
+        Actor.objects.create(name="Без фото", description="-", image="")
+        Actor.objects.create(name="Фото", description="-", image="actors/Джеймс Кэмерон (1).jpg")
+        Actor.objects.create(
+            name="Копии", description="-", image="actors/a.jpg",
+            image_variants={"thumb": "actors/variants/ab/ab-thumb.webp", "small": "actors/variants/cd/cd small.webp"},
+        )
+        Movie.objects.filter(url="movie1").update(category=None)
+
+    def assertSameContent(self, url):
+        with override_settings(FAST_LIST_SERIALIZERS=False):
+            cache.clear()
+            expected = self.client.get(url, REMOTE_ADDR="10.0.0.1").content
+        with override_settings(FAST_LIST_SERIALIZERS=True):
+            cache.clear()
+            self.assertEqual(self.client.get(url, REMOTE_ADDR="10.0.0.1").content, expected)
+
+    def test_movie_list(self):
+        self.assertSameContent("/api/v1/movie/?ordering=-rating&page_size=3")
+
+    def test_actor_list(self):
+        self.assertSameContent("/api/v1/actors/?page_size=50")
+
+    def test_benchmark_command(self):
+        call_command("bench_list_serializers", "50", repeat=1, stdout=StringIO())
+
+
+class BenchmarkCommandsTests(TestCase):
+    """Синтетический каталог и замер маршрутов"""
+
+    def seed(self, *args):
+        call_command("seed_catalog", "--movies=12", "--reviews=7", "--ratings=5", "--ips=50", *args, stdout=StringIO())
+        return (
+            list(Movie.objects.order_by("url").values_list("url", "year", "country", "draft", "rating_histogram")),
+            sorted(Movie.actors.through.objects.values_list("movie__url", "actor__name")),
+            Review.objects.exclude(parent=None).count(),
+        )
+
+    def test_seed_is_deterministic(self):
+        first = self.seed()
+        self.assertEqual(len(first[0]), 12)
+        self.assertEqual(Review.objects.count(), 12 * 7)
+        self.assertGreater(first[2], 0)
+        self.assertEqual(self.seed("--flush"), first)
+
+    def test_bench_covers_every_route(self):
+        self.seed()
+        output = StringIO()
+        call_command("bench_endpoints", "--requests=2", "--warmup=0", "--output=-", stdout=output, stderr=StringIO())
+        report = json.loads(output.getvalue())
+        self.assertEqual(
+            {result["route"] for result in report["endpoints"].values()},
+            {str(pattern.pattern) for pattern in urlpatterns},
+        )
+        for result in report["endpoints"].values():
+            self.assertLess(max(result["status"]), 300)
+
+    def test_explain_endpoints(self):
+        self.seed()
+        output = StringIO()
+        # с нулевым порогом в лог попадает каждый запрос вместе с планом
+        with self.assertLogs("movies.management.commands.explain_endpoints", "WARNING") as logs:
+            call_command("explain_endpoints", "--slow-ms=0", stdout=output)
+        self.assertNotIn("full scan", output.getvalue())
+        self.assertIn("GET movie/?ordering=-rating", output.getvalue())
+        self.assertIn("SEARCH movies_movie USING INTEGER PRIMARY KEY", "\n".join(logs.output))
+
+    def test_explain_endpoints_fails_on_full_scan(self):
+        self.seed()
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX movie_published_rating_idx")
+        with self.assertRaisesMessage(CommandError, "GET movie/?ordering=-rating: movies_movie"):
+            call_command("explain_endpoints", stdout=StringIO())
+
+    def test_review_roots_plan(self):
+        self.seed()
+        movie = Movie.objects.first()
+        with CaptureQueriesContext(connection) as queries:
+            list(Review.objects.filter(movie=movie, parent=None).order_by("id"))
+        plan = get_plan(queries[0]["sql"])
+        self.assertEqual(plan, ["SEARCH movies_review USING INDEX review_movie_root_idx (movie_id=?)"])
+        self.assertEqual(find_full_scans(queries[0]["sql"], plan), set())
+
+
+class BulkRatingTests(CatalogMixin, TestCase):
+    """Пакетное добавление оценок одним upsert"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(5)
+        self.movies = list(Movie.objects.order_by("id"))
+
+    def post(self, ratings, ip="172.16.0.1"):
+        return self.client.post("/api/v1/rating/bulk/", {"ratings": ratings}, format="json", REMOTE_ADDR=ip)
+
+    def assertAggregatesMatch(self):
+        for movie in Movie.objects.all():
+            values = list(movie.ratings.values_list("star__value", flat=True))
+            self.assertEqual((movie.rating_count, movie.rating_sum), (len(values), sum(values)))
+            self.assertEqual(sum(movie.rating_histogram.values()), len(values))
+
+    def test_create_and_update(self):
+        first = [{"movie": movie.pk, "star": self.stars[4].pk} for movie in self.movies]
+        self.assertEqual(self.post(first).status_code, 201)
+        # повтор с другой звездой перезаписывает оценки, дубль фильма в пакете - побеждает последняя
+        second = [{"movie": self.movie.pk, "star": self.stars[0].pk}, {"movie": self.movie.pk, "star": self.stars[2].pk}]
+        self.assertEqual(self.post(second).status_code, 201)
+
+        self.assertEqual(Rating.objects.filter(ip="172.16.0.1").count(), len(self.movies))
+        self.assertEqual(Rating.objects.get(ip="172.16.0.1", movie=self.movie).star, self.stars[2])
+        self.assertAggregatesMatch()
+
+    def test_query_count_does_not_grow_with_batch(self):
+        small = self.count_queries(
+            "post", "/api/v1/rating/bulk/", {"ratings": [{"movie": self.movie.pk, "star": self.stars[1].pk}]},
+            format="json", REMOTE_ADDR="172.16.0.2",
+        )
+        ratings = [{"movie": movie.pk, "star": self.stars[1].pk} for movie in self.movies]
+        large = self.count_queries("post", "/api/v1/rating/bulk/", {"ratings": ratings}, format="json", REMOTE_ADDR="172.16.0.3")
+        self.assertEqual(large, small)
+
+    def test_invalid_ids(self):
+        response = self.post([{"movie": self.movie.pk, "star": self.stars[0].pk}, {"movie": 0, "star": 0}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()["ratings"][1]), ["movie", "star"])
+        self.assertFalse(Rating.objects.filter(ip="172.16.0.1").exists())
+
+    def test_apply_rating(self):
+        movie = Movie(rating_count=0, rating_sum=0, rating_histogram={})
+        for old, new in ((None, 4), (None, 2), (4, 5), (2, None)):
+            movie.apply_rating(old, new)
+        self.assertEqual((movie.rating_count, movie.rating_sum, movie.rating_histogram), (1, 5, {"5": 1}))
+
+    def test_admin_edit_and_delete(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+        rating = Rating.objects.filter(movie=self.movie).first()
+        version = Movie.objects.get(pk=self.movie.pk).version
+        url = f"/admin/movies/rating/{rating.pk}/change/"
+        data = {"ip": rating.ip, "star": self.stars[4].pk, "movie": self.movie.pk}
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertAggregatesMatch()
+        self.assertGreater(Movie.objects.get(pk=self.movie.pk).version, version)
+        # перенос на другой фильм, добавление и удаление
+        other = self.movies[-1]
+        self.assertEqual(self.client.post(url, {**data, "movie": other.pk, "ip": "172.16.1.1"}).status_code, 302)
+        self.assertAggregatesMatch()
+        data = {"ip": "172.16.1.2", "star": self.stars[1].pk, "movie": self.movie.pk}
+        self.assertEqual(self.client.post("/admin/movies/rating/add/", data).status_code, 302)
+        self.assertAggregatesMatch()
+        self.assertEqual(self.client.post(f"/admin/movies/rating/{rating.pk}/delete/", {"post": "yes"}).status_code, 302)
+        self.assertAggregatesMatch()
+        # каскад от звезды
+        self.stars[0].delete()
+        self.assertAggregatesMatch()
+
+    def test_movie_deleted_before_save(self):
+        def delete_and_save(ip, stars):
+            Movie.objects.filter(pk__in=stars).delete()
+            return save_ratings(ip, stars)
+
+        save_ratings = service.save_ratings
+        with mock.patch("movies.serializers.save_ratings", side_effect=delete_and_save):
+            response = self.client.post(
+                "/api/v1/rating/", {"star": self.stars[0].pk, "movie": self.movie.pk}, REMOTE_ADDR="172.16.0.5"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("movie", response.json())
+
+    def test_single_rating_uses_same_upsert(self):
+        for star in (self.stars[0], self.stars[3], self.stars[3]):
+            self.client.post("/api/v1/rating/", {"star": star.pk, "movie": self.movie.pk}, REMOTE_ADDR="172.16.0.4")
+        self.assertEqual(Rating.objects.get(ip="172.16.0.4").star, self.stars[3])
+        self.assertAggregatesMatch()
+
+
+class RatingBufferTests(CatalogMixin, TestCase):
+    """Отложенная запись оценок"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(3)
+        self.movies = list(Movie.objects.order_by("id"))
+        self.addCleanup(setattr, buffer, "_buffer", None)
+
+    def make_buffer(self, **kwargs):
+        # без фонового потока: пачки пишутся в потоке теста
+        options = {"max_size": 100, "flush_size": 100, "flush_interval": 1, "block_timeout": 0, "autostart": False}
+        return buffer.RatingBuffer(**{**options, **kwargs})
+
+    def use_buffer(self, rating_buffer):
+        buffer._buffer = rating_buffer
+        return override_settings(RATING_WRITE_BEHIND={"ENABLED": True})
+
+    def test_last_write_wins(self):
+        self.movie.refresh_from_db()
+        histogram = dict(self.movie.rating_histogram)
+        rating_buffer = self.make_buffer()
+        for star in self.stars[:3]:
+            rating_buffer.add("172.18.0.1", self.movie.pk, star)
+        self.assertEqual(len(rating_buffer), 1)
+        self.assertEqual(rating_buffer.flush(), 1)
+        self.assertEqual(Rating.objects.get(ip="172.18.0.1").star, self.stars[2])
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.rating_histogram.get("3"), histogram.get("3", 0) + 1)
+
+    def test_flush_when_batch_is_full(self):
+        rating_buffer = self.make_buffer(flush_size=2)
+        rating_buffer.add("172.18.0.2", self.movies[0].pk, self.stars[0])
+        self.assertFalse(Rating.objects.filter(ip="172.18.0.2").exists())
+        rating_buffer.add("172.18.0.2", self.movies[1].pk, self.stars[0])
+        self.assertEqual(Rating.objects.filter(ip="172.18.0.2").count(), 2)
+        self.assertEqual(len(rating_buffer), 0)
+
+    def test_api_accepts_into_buffer(self):
+        rating_buffer = self.make_buffer()
+        with self.use_buffer(rating_buffer):
+            single = self.client.post("/api/v1/rating/", {"star": self.stars[4].pk, "movie": self.movie.pk}, REMOTE_ADDR="172.18.0.3")
+            bulk = self.client.post("/api/v1/rating/bulk/", {"ratings": [
+                {"movie": movie.pk, "star": self.stars[1].pk} for movie in self.movies
+            ]}, format="json", REMOTE_ADDR="172.18.0.3")
+        self.assertEqual((single.status_code, bulk.status_code), (202, 202))
+        self.assertEqual(single.json(), {"star": self.stars[4].pk, "movie": self.movie.pk})
+        self.assertFalse(Rating.objects.filter(ip="172.18.0.3").exists())
+        self.assertEqual(rating_buffer.close(), len(self.movies))
+        self.assertEqual(set(Rating.objects.filter(ip="172.18.0.3").values_list("star", flat=True)), {self.stars[1].pk})
+
+    def test_backpressure_when_full(self):
+        rating_buffer = self.make_buffer(max_size=1)
+        with self.use_buffer(rating_buffer):
+            first = self.client.post("/api/v1/rating/", {"star": self.stars[0].pk, "movie": self.movies[0].pk}, REMOTE_ADDR="172.18.0.4")
+            # замена ждущей оценки проходит и в заполненный буфер
+            again = self.client.post("/api/v1/rating/", {"star": self.stars[1].pk, "movie": self.movies[0].pk}, REMOTE_ADDR="172.18.0.4")
+            full = self.client.post("/api/v1/rating/", {"star": self.stars[0].pk, "movie": self.movies[1].pk}, REMOTE_ADDR="172.18.0.4")
+        self.assertEqual((first.status_code, again.status_code, full.status_code), (202, 202, 503))
+        self.assertEqual(full["Retry-After"], "1")
+        self.assertEqual(len(rating_buffer), 1)
+
+    def test_close_spools_and_drain_writes(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        rating_buffer = self.make_buffer(spool_dir=spool_dir.name)
+        for movie in self.movies:
+            rating_buffer.add("172.18.0.5", movie.pk, self.stars[3])
+        with mock.patch("movies.buffer.upsert_ratings", side_effect=DatabaseError), self.assertLogs("movies.buffer"):
+            self.assertEqual(rating_buffer.close(), len(self.movies))
+        self.assertEqual(len(list(Path(spool_dir.name).glob("*.jsonl"))), 1)
+        self.assertFalse(Rating.objects.filter(ip="172.18.0.5").exists())
+
+        call_command("drain_ratings", spool_dir=spool_dir.name, stdout=StringIO())
+        self.assertEqual(Rating.objects.filter(ip="172.18.0.5", star=self.stars[3]).count(), len(self.movies))
+        self.assertEqual(list(Path(spool_dir.name).iterdir()), [])
+
+
+class SearchTests(CatalogMixin, TestCase):
+    """Полнотекстовый поиск ?search= по индексу movies.search"""
+
+    def setUp(self):
+        super().setUp()
+        self.movie.actors.add(self.actor)
+        self.sequel = Movie.objects.create(
+            title="Терминатор 2", tagline="Судный день", description="Снова Арнольд", country="США", url="terminator-2",
+        )
+        self.other = Movie.objects.create(
+            title="Чужой", tagline="В космосе никто не услышит", description="Экипаж и терминатор", country="США", url="alien",
+        )
+
+    def search(self, query, **params):
+        response = self.client.get("/api/v1/movie/", {"search": query, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def titles(self, query):
+        return [row["title"] for row in self.search(query)["results"]]
+
+    def test_ranked_by_relevance(self):
+        # совпадение в названии весит больше, чем в описании
+        titles = self.titles("терминатор")
+        self.assertEqual(set(titles), {"Терминатор", "Терминатор 2", "Чужой"})
+        self.assertEqual(titles[-1], "Чужой")
+        self.assertEqual(self.titles("судный"), ["Терминатор 2"])
+        self.assertEqual(self.titles("космос никто"), ["Чужой"])
+
+    def test_actor_names(self):
+        self.assertEqual(self.titles("арнольд"), ["Терминатор", "Терминатор 2"])
+        self.actor.name = "Шварценеггер"
+        self.actor.save()
+        self.assertEqual(self.titles("шварценеггер"), ["Терминатор"])
+        self.other.actors.add(self.actor)
+        self.assertEqual(set(self.titles("шварценеггер")), {"Терминатор", "Чужой"})
+        self.actor.film_actor.clear()
+        self.assertEqual(self.titles("шварценеггер"), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.other.title = "Хищник"
+        self.other.save()
+        self.assertEqual(self.titles("хищник"), ["Хищник"])
+        self.assertEqual(self.titles("чужой"), [])
+        self.sequel.delete()
+        self.assertEqual(self.titles("судный"), [])
+        self.actor.delete()
+        self.assertEqual(self.titles("арнольд"), [])
+
+    def test_combines_with_filters_and_ordering(self):
+        self.assertEqual(self.titles("терминатор хищник"), [])
+        response = self.search("терминатор", ordering="id")
+        self.assertEqual([row["id"] for row in response["results"]], [self.movie.pk, self.sequel.pk, self.other.pk])
+        self.assertEqual(self.search("терминатор", year_min=2020)["results"], [])
+        self.assertEqual(self.search("!!!")["results"], [])
+        self.assertEqual(self.client.get("/api/v1/movie/", {"ordering": "relevance"}).status_code, 400)
+
+    def test_relevance_cursor(self):
+        pages, url = [], "/api/v1/movie/?" + urlencode({"search": "терминатор", "page_size": 1})
+        while url:
+            response = self.client.get(url).json()
+            pages += [row["title"] for row in response["results"]]
+            url = response["next"]
+        self.assertEqual(pages, self.titles("терминатор"))
+
+    def test_rebuild_command(self):
+        Movie.objects.bulk_create([Movie(title="Матрица", description="-", country="США", url="matrix")])
+        self.assertEqual(self.titles("матрица"), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.titles("матрица"), ["Матрица"])
+
+    def test_admin_search(self):
+        admin = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin)
+        response = self.client.get("/admin/movies/movie/", {"q": "судный"})
+        self.assertEqual(list(response.context["cl"].result_list), [self.sequel])
+        response = self.client.get("/admin/movies/movie/", {"q": "Фильмы"})
+        self.assertEqual(list(response.context["cl"].result_list), [self.movie])
+
+
+class CatalogIndexTests(CatalogMixin, TestCase):
+    """Фильтры списка фильмов через индекс каталога в памяти"""
+
+    FILTERS = (
+        {"genres": "genre0"},
+        {"genres": "genre1,genre3,missing"},
+        {"year_min": 2001},
+        {"year_min": 2000, "year_max": 2001},
+        {"genres": "genre0,genre2", "year_max": 2000},
+        {"genres": "genre4", "year_min": 2001, "search": "movie4"},
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(8)
+        for movie in Movie.objects.all():
+            movie.year = 2000 + movie.pk % 3
+            movie.genres.add(*Genre.objects.filter(pk__lte=movie.pk % 4 + 1))
+            movie.save()
+        Movie.objects.filter(title="movie7").update(draft=True)
+        bump_catalog_version()
+        catalog_index._index = None
+        self.addCleanup(setattr, catalog_index, "_index", None)
+        self.index = catalog_index.get_catalog_index()
+
+    def ids(self, params):
+        # не cache.clear(): вместе с кэшем списка пропала бы и версия каталога
+        bump_movie_list_version()
+        response = self.client.get("/api/v1/movie/", {**params, "page_size": 100})
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row["id"] for row in response.json()["results"]]
+
+    def assertSameAsSql(self):
+        for params in self.FILTERS:
+            with override_settings(CATALOG_INDEX={"ENABLED": False}):
+                expected = self.ids(params)
+            self.assertEqual(self.ids(params), expected, params)
+
+    def test_matches_sql(self):
+        self.assertSameAsSql()
+        self.assertIsNotNone(self.index.version)
+
+    def test_no_genre_join(self):
+        self.ids({"genres": "genre0"})
+        with CaptureQueriesContext(connection) as queries:
+            self.ids({"genres": "genre0,genre1", "year_min": 2001})
+        self.assertFalse([q["sql"] for q in queries if "movies_movie_genres" in q["sql"]])
+
+    def test_incremental_refresh(self):
+        self.ids({"genres": "genre0"})
+        version = self.index.version
+        movie = Movie.objects.get(title="movie3")
+        with self.captureOnCommitCallbacks(execute=True):
+            movie.year = 1999
+            movie.save()
+            movie.genres.remove(Genre.objects.get(name="genre0"))
+            Genre.objects.get(name="genre5").movie_set.add(movie)
+            Movie.objects.get(title="movie1").delete()
+            drafted = Movie.objects.get(title="movie2")
+            drafted.draft = True
+            drafted.save()
+            # до коммита индекс не меняется
+            self.assertEqual(self.index.version, version)
+        # изменения применены к индексу после коммита без перестройки
+        self.assertEqual(self.index.version, version + 5)
+        with mock.patch.object(self.index, "build") as build:
+            self.assertSameAsSql()
+        build.assert_not_called()
+
+    def test_freed_slots_reused(self):
+        self.ids({"genres": "genre0"})
+        size = len(self.index.ids)
+        with self.captureOnCommitCallbacks(execute=True):
+            Movie.objects.get(title="movie1").delete()
+            drafted = Movie.objects.get(title="movie2")
+            drafted.draft = True
+            drafted.save()
+        for title in ("fresh1", "fresh2"):
+            with self.captureOnCommitCallbacks(execute=True):
+                movie = Movie.objects.create(title=title, description="-", country="-", url=title, year=2001)
+                movie.genres.add(Genre.objects.get(name="genre0"))
+        # новые фильмы заняли освободившиеся слоты, множества не выросли
+        self.assertEqual(len(self.index.ids), size)
+        self.assertEqual(self.index.free, [])
+        with mock.patch.object(self.index, "build") as build:
+            self.assertSameAsSql()
+        build.assert_not_called()
+
+    def test_rebuild_after_foreign_change(self):
+        self.ids({"genres": "genre0"})
+        # так меняют каталог другие процессы и массовые операции
+        with self.captureOnCommitCallbacks(execute=True):
+            Movie.objects.filter(title="movie3").update(year=1990)
+            bump_catalog_version()
+        self.assertEqual(self.ids({"year_max": 1995}), [Movie.objects.get(title="movie3").pk])
+
+    def test_rolled_back_change_not_in_index(self):
+        self.ids({"genres": "genre0"})
+        version = self.index.version
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                movie = Movie.objects.create(title="phantom", description="-", country="-", url="phantom", year=1990)
+                movie.genres.add(Genre.objects.get(name="genre0"))
+                raise DatabaseError("откат")
+        self.assertEqual(self.index.version, version)
+        self.assertEqual(self.ids({"year_max": 1995}), [])
+
+    def test_cold_index_falls_back_to_sql(self):
+        index = catalog_index.CatalogIndex(background_build=True)
+        with mock.patch("movies.catalog_index.threading.Thread") as thread:
+            self.assertIsNone(index.resolve(genres=["genre0"]))
+            self.assertIsNone(index.resolve(genres=["genre0"]))
+        thread.return_value.start.assert_called_once()
+        index.build_in_background()
+        self.assertEqual(
+            sorted(index.resolve(genres=["genre0"])),
+            sorted(Movie.objects.filter(draft=False, genres__name="genre0").values_list("id", flat=True)),
+        )
+
+    def test_too_many_ids_fall_back_to_sql(self):
+        with override_settings(CATALOG_INDEX={"MAX_IDS": 1}):
+            self.assertSameAsSql()
+        self.assertIsNone(self.index.resolve(year_min=2000, limit=1))
+
+
+class FacetsTests(CatalogMixin, TestCase):
+    """Фасеты выдачи фильтра movie/facets/"""
+
+    url = "/api/v1/movie/facets/"
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(6)
+        for movie in Movie.objects.all():
+            movie.year = 1995 + movie.pk * 3
+            movie.country = ("Франция", "США", "")[movie.pk % 3]
+            movie.save()
+        catalog_index._index = None
+        self.addCleanup(setattr, catalog_index, "_index", None)
+
+    def facets(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def expected(self, movies):
+        movies = list(movies.filter(draft=False).distinct())
+        genres = Movie.genres.through.objects.filter(movie__in=movies)
+        return {
+            "count": len(movies),
+            "genres": sorted(genres.values_list("genre__name", flat=True)),
+            "years": sorted(movie.year // 10 * 10 for movie in movies),
+            "countries": sorted(movie.country for movie in movies),
+        }
+
+    def flatten(self, facets):
+        return {
+            "count": facets["count"],
+            "genres": sorted(row["name"] for row in facets["genres"] for _ in range(row["count"])),
+            "years": sorted(row["from"] for row in facets["years"] for _ in range(row["count"])),
+            "countries": sorted(row["name"] for row in facets["countries"] for _ in range(row["count"])),
+        }
+
+    def test_counts_from_index_and_sql_match(self):
+        cases = (
+            ({}, Movie.objects.all()),
+            ({"genres": "genre0,genre1"}, Movie.objects.filter(genres__name__in=["genre0", "genre1"])),
+            ({"year_min": 2000, "year_max": 2010}, Movie.objects.filter(year__range=(2000, 2010))),
+            ({"search": "movie2"}, Movie.objects.filter(title="movie2")),
+        )
+        for params, movies in cases:
+            cache.clear()
+            from_index = self.facets(**params)
+            cache.clear()
+            with override_settings(CATALOG_INDEX={"ENABLED": False}):
+                from_sql = self.facets(**params)
+            self.assertEqual(from_index, from_sql, params)
+            self.assertEqual(self.flatten(from_sql), self.expected(movies), params)
+        categories = self.facets()["categories"]
+        self.assertEqual(categories, [{"id": self.category.pk, "name": "Фильмы", "count": Movie.objects.count()}])
+
+    def count_facet_queries(self, tag):
+        counts = {}
+        for size in self.SIZES:
+            self.seed_catalog(size)
+            # лишний параметр входит в ключ кэша фасетов, но не в фильтр
+            counts[size] = self.count_queries("get", self.url, {"genres": "genre0,genre1", "year_min": 2000, "_": f"{tag}{size}"})
+        return counts
+
+    def test_query_budget(self):
+        with override_settings(CATALOG_INDEX={"ENABLED": False}):
+            # число фильмов, четыре группировки и названия категорий
+            self.assertEqual(set(self.count_facet_queries("sql").values()), {6})
+        self.facets()
+        # с прогретым индексом в бд только названия категорий
+        self.assertEqual(set(self.count_facet_queries("index").values()), {1})
+
+    def test_cached_and_invalidated(self):
+        first = self.facets(genres="genre0")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.facets(genres="genre0"), first)
+        self.assertEqual(len(queries), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Movie.objects.get(title="movie3").genres.add(Genre.objects.get(name="genre0"))
+        self.assertEqual(self.facets(genres="genre0")["count"], first["count"] + 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = "Кино"
+            self.category.save()
+        self.assertEqual(self.facets()["categories"][0]["name"], "Кино")
+
+    def test_invalid_filter(self):
+        self.assertEqual(self.client.get(self.url, {"year_min": "x"}).status_code, 400)
+
+
+class AsyncViewsTests(CatalogMixin, TestCase):
+    """Асинхронные эндпоинты чтения отдают то же, что синхронные"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(5)
+        self.async_client = AsyncClient()
+
+    async def compare(self, path, headers=None):
+        cache.clear()
+        expected = await sync_to_async(self.client.get)(f"/api/v1/{path}", headers=headers)
+        cache.clear()
+        response = await self.async_client.get(f"/api/async/v1/{path}", headers=headers)
+        self.assertEqual(response.status_code, expected.status_code, path)
+        # ссылки next/previous ведут на свои эндпоинты
+        self.assertEqual(response.content.replace(b"/api/async/v1/", b"/api/v1/"), expected.content, path)
+        for header in ("ETag", "Last-Modified"):
+            self.assertEqual(response.get(header), expected.get(header), path)
+        return response
+
+    async def test_same_responses(self):
+        movie = await Movie.objects.aget(title="movie1")
+        for path in (
+            "movie/",
+            "movie/?page_size=2&ordering=-rating",
+            "movie/?genres=genre0,genre1&year_min=2000",
+            "movie/?search=movie2",
+            "movie/?ordering=nope",
+            "movie/?cursor=broken",
+            f"movie/{self.movie.pk}/",
+            f"movie/{movie.pk}/",
+            "movie/0/",
+            "actors/?page_size=3",
+            f"actors/{self.actor.pk}/",
+            "actors/0/",
+        ):
+            await self.compare(path)
+
+    async def test_cursor_and_rating_overlay(self):
+        await Rating.objects.acreate(ip="10.9.9.9", movie=self.movie, star=self.stars[0])
+        headers = {"X-Forwarded-For": "10.9.9.9"}
+        response = await self.compare("movie/?page_size=2", headers)
+        self.assertTrue(response.json()["results"][0]["rating_user"])
+        next_url = response.json()["next"]
+        await self.compare("movie/?" + next_url.split("?", 1)[1], headers)
+
+    async def test_permissions_and_throttles(self):
+        class Deny(BaseThrottle):
+            def allow_request(self, request, view):
+                return False
+
+            def wait(self):
+                return 7
+
+        with mock.patch.object(MovieListView, "permission_classes", (IsAdminUser,)):
+            await self.compare("movie/")
+            self.assertEqual((await self.async_client.get("/api/async/v1/movie/")).status_code, 403)
+        with mock.patch.object(ActorsDetailView, "throttle_classes", (Deny,)):
+            response = await self.compare(f"actors/{self.actor.pk}/")
+            self.assertEqual((response.status_code, response["Retry-After"]), (429, "7"))
+
+    async def test_not_modified(self):
+        first = await self.async_client.get(f"/api/async/v1/movie/{self.movie.pk}/")
+        response = await self.async_client.get(f"/api/async/v1/movie/{self.movie.pk}/", headers={"If-None-Match": first["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+
+class AsgiBenchmarkTests(TransactionTestCase):
+    """Замер WSGI и ASGI: клиенты в потоках видят только закоммиченные данные"""
+
+    def tearDown(self):
+        # индекс поиска не входит в таблицы, которые очищает TransactionTestCase
+        update_search_index()
+
+    def test_bench_covers_every_async_route(self):
+        call_command("seed_catalog", "--movies=6", "--reviews=2", "--ratings=2", "--ips=10", stdout=StringIO())
+        output = StringIO()
+        call_command("bench_asgi", "--requests=4", "--clients", "1", "2", "--output=-", stdout=output, stderr=StringIO())
+        results = json.loads(output.getvalue())["results"]
+        self.assertEqual(
+            {(result["route"], result["mode"], result["clients"]) for result in results},
+            {
+                (str(pattern.pattern), mode, clients)
+                for pattern in async_urlpatterns for mode in ("wsgi", "asgi-sync", "asgi-async") for clients in (1, 2)
+            },
+        )
+
+
+def make_image(width, height, color="red", image_format="PNG"):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(output, image_format)
+    return output.getvalue()
+
+
+@override_settings(IMAGE_VARIANTS={
+    "BACKGROUND": False, "FORMAT": "WEBP", "QUALITY": 70, "SIZES": {"thumb": (40, 50), "small": (100, 120)},
+})
+class ImageVariantsTests(CatalogMixin, TestCase):
+    """Уменьшенные копии изображений и их адреса в ответах"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media = Path(media.name)
+        super().setUp()
+
+    def upload(self, actor, data, name="photo.png"):
+        actor.image = SimpleUploadedFile(name, data, content_type="image/png")
+        with self.captureOnCommitCallbacks(execute=True):
+            actor.save()
+        actor.refresh_from_db()
+        return actor.image_variants
+
+    def test_variants_on_upload(self):
+        version = self.actor.version
+        variants = self.upload(self.actor, make_image(400, 300))
+        self.assertEqual(set(variants), {"thumb", "small"})
+        self.assertEqual(self.actor.version, version + 2)
+        for variant, size in (("thumb", (40, 30)), ("small", (100, 75))):
+            self.assertRegex(variants[variant], rf"^actors/variants/[0-9a-f]{{2}}/[0-9a-f]{{32}}-{variant}\.webp$")
+            with Image.open(self.media / variants[variant]) as image:
+                self.assertEqual((image.format, image.size), ("WEBP", size))
+
+        # то же содержимое под другим именем - те же копии, другое - новые
+        other = Actor.objects.create(name="Другой", description="-", image="")
+        self.assertEqual(self.upload(other, make_image(400, 300), "copy.png"), variants)
+        self.assertNotEqual(self.upload(other, make_image(400, 300, "blue")), variants)
+        # на прежние копии other ссылается self.actor, они остаются
+        self.assertTrue(all((self.media / name).exists() for name in variants.values()))
+
+    def test_previous_variants_deleted(self):
+        old = self.upload(self.actor, make_image(400, 300))
+        new = self.upload(self.actor, make_image(400, 300, "blue"))
+        self.assertTrue(all((self.media / name).exists() for name in new.values()))
+        self.assertFalse(any((self.media / name).exists() for name in old.values()))
+
+    @override_settings(IMAGE_VARIANTS={"BACKGROUND": True, "MAX_PENDING": 1, "WORKERS": 1})
+    def test_background_queue_is_bounded(self):
+        started, release = threading.Event(), threading.Event()
+
+        def build(model, pk, field):
+            started.set()
+            release.wait(5)
+
+        with mock.patch.multiple(images, _executor=None, _pending=None, build_in_background=build):
+            images.schedule_variants(self.actor, "image")
+            self.assertTrue(started.wait(5))
+            with self.assertLogs("movies.images", "WARNING"):
+                images.schedule_variants(self.actor, "image")
+            release.set()
+            executor, pending = images.get_image_executor()
+            executor.shutdown(wait=True)
+        # место в очереди освободилось
+        self.assertTrue(pending.acquire(blocking=False))
+
+    def test_stale_source_is_not_overwritten(self):
+        self.upload(self.actor, make_image(50, 50))
+        self.assertFalse(save_variants(Actor, self.actor.pk, "image", "actors/old.png", {"thumb": "x"}, {}))
+        self.actor.refresh_from_db()
+        self.assertNotEqual(self.actor.image_variants, {"thumb": "x"})
+
+    def test_urls_in_responses(self):
+        self.movie.actors.add(self.actor)
+        variants = self.upload(self.actor, make_image(200, 200))
+        self.movie.poster = SimpleUploadedFile("poster.jpg", make_image(300, 450, image_format="JPEG"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.movie.save()
+        expected = {variant: f"http://testserver/media/{name}" for variant, name in variants.items()}
+
+        for fast in (True, False):
+            with override_settings(FAST_LIST_SERIALIZERS=fast):
+                actor = self.client.get("/api/v1/actors/").json()["results"][0]
+                self.assertEqual(actor["image_variants"], expected)
+        self.assertEqual(self.client.get(f"/api/v1/actors/{self.actor.pk}/").json()["image_variants"], expected)
+        movie = self.client.get(f"/api/v1/movie/{self.movie.pk}/").json()
+        self.assertEqual(movie["actors"][0]["image_variants"], expected)
+        self.assertEqual(set(movie["poster_variants"]), {"thumb", "small"})
+
+        # миниатюра в админке - копия, пока её нет - оригинал
+        self.assertIn(f'src=/media/{variants["thumb"]} ', ActorAdmin.get_image(None, self.actor))
+        self.assertIn("src=/media/actors/Arnold.jpg ", ActorAdmin.get_image(None, Actor(image="actors/Arnold.jpg")))
+
+    def test_backfill_command(self):
+        (self.media / "movie_shots").mkdir()
+        (self.media / "movie_shots" / "shot.png").write_bytes(make_image(300, 200))
+        shot = MovieShots.objects.create(title="Кадр", description="-", image="movie_shots/shot.png", movie=self.movie)
+        version = Movie.objects.get(pk=self.movie.pk).version
+        output = StringIO()
+        # self.actor ссылается на несуществующий файл
+        with self.assertLogs("movies.images", "WARNING"):
+            call_command("build_image_variants", "--workers=2", stdout=output)
+        self.assertIn("Готово копий: 1, уже были: 0, нет оригинала: 1", output.getvalue())
+        shot.refresh_from_db()
+        self.assertEqual(set(shot.image_variants), {"thumb", "small"})
+        self.assertTrue((self.media / shot.image_variants["small"]).exists())
+        self.assertEqual(Movie.objects.get(pk=self.movie.pk).version, version)
+
+        output = StringIO()
+        call_command("build_image_variants", "--models", "movieshots", stdout=output)
+        self.assertIn("Готово копий: 0, уже были: 1", output.getvalue())
+
+    def test_backfill_skips_broken_files(self):
+        (self.media / "movie_shots").mkdir()
+        (self.media / "movie_shots" / "broken.png").write_bytes(b"not an image")
+        (self.media / "movie_shots" / "shot.png").write_bytes(make_image(300, 200))
+        for name in ("broken", "shot"):
+            MovieShots.objects.create(title=name, description="-", image=f"movie_shots/{name}.png", movie=self.movie)
+        output = StringIO()
+        with self.assertLogs("movies.management.commands.build_image_variants", "ERROR"):
+            call_command("build_image_variants", "--models", "movieshots", "--workers=1", stdout=output)
+        self.assertIn("Готово копий: 1, уже были: 0, нет оригинала: 0, ошибок: 1", output.getvalue())
+        self.assertEqual(set(MovieShots.objects.get(title="shot").image_variants), {"thumb", "small"})
+
+
+class AdminChangelistTests(CatalogMixin, TestCase):
+    """Страницы админки не делают запросов на каждую строку"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+
+    def seed_catalog(self, size):
+        for i in range(self.seeded, size):
+            MovieShots.objects.create(title=f"shot{i}", description="-", image=f"movie_shots/{i}.jpg", movie=self.movie)
+        super().seed_catalog(size)
+
+    def test_changelists(self):
+        counts = {}
+        for size in self.SIZES:
+            self.seed_catalog(size)
+            for model in ("movie", "review", "rating", "movieshots", "actor"):
+                counts.setdefault(model, set()).add(self.count_queries("get", f"/admin/movies/{model}/"))
+        for model, values in counts.items():
+            self.assertEqual(len(values), 1, f"{model}: {values}")
+
+    def test_movie_form_does_not_list_actors(self):
+        self.seed_catalog(5)
+        Actor.objects.create(name="Не снимался", description="-", image="")
+        url = f"/admin/movies/movie/{self.movie.pk}/change/"
+        content = self.client.get(url).content.decode()
+        self.assertIn("actor3", content)
+        self.assertNotIn("Не снимался", content)
+        self.assertQueriesFlat("get", url)
+
+    def test_estimated_count(self):
+        self.seed_catalog(5)
+        queryset = Rating.objects.order_by("-pk")
+        paginator = EstimatedCountPaginator(queryset, 100)
+        with self.settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=5):
+            # без статистики - точный COUNT(*)
+            self.assertEqual(paginator.count, 10)
+            Rating.objects.bulk_create(Rating(movie=self.movie, ip=f"10.1.0.{i}", star=self.stars[0]) for i in range(5))
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+            Rating.objects.filter(ip__startswith="10.1.").delete()
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 15)
+            # с фильтром или на маленькой таблице число точное
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(movie=self.movie), 100).count, 5)
+        self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 10)
+        response = self.client.get("/admin/movies/rating/")
+        self.assertNotContains(response, "всего")
+
+
+class ImportCatalogTests(TestCase):
+    """Потоковая загрузка каталога: пачки, повторная загрузка, продолжение после сбоя"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = Path(directory.name)
+
+    def write(self, name, rows):
+        path = self.dir / name
+        if path.suffix == ".csv":
+            header = list(rows[0])
+            lines = [",".join(header)] + [",".join(f'"{row[key]}"' for key in header) for row in rows]
+            path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        else:
+            path.write_text("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows), encoding="utf-8")
+        return str(path)
+
+    def run_import(self, *paths, **options):
+        output = StringIO()
+        call_command("import_catalog", *paths, stdout=output, stderr=StringIO(), **options)
+        return output.getvalue()
+
+    def catalog_files(self, movies=5):
+        return [
+            self.write("movie_actors.csv", [{"movie": f"m{i}", "actor": f"Актёр {i % 3}"} for i in range(movies)]
+                       + [{"movie": "нет такого", "actor": "Актёр 0"}]),
+            self.write("movies.jsonl", [
+                {"url": f"m{i}", "title": f"Фильм {i}", "year": 2000 + i, "country": "США",
+                 "category": "films", "world_premiere": "2001-02-03", "draft": False}
+                for i in range(movies)
+            ]),
+            self.write("actors.csv", [{"name": f"Актёр {i}", "age": str(30 + i), "description": "многострочное\nописание"}
+                                      for i in range(3)]),
+            self.write("categories.csv", [{"url": "films", "name": "Фильмы", "description": "-"}]),
+        ]
+
+    def test_import_and_reimport(self):
+        output = self.run_import(*self.catalog_files(), batch_size=2)
+        self.assertIn("movie_actors.csv: строк 6, создано 5, обновлено 0, пропущено 1", output)
+        movie = Movie.objects.get(url="m4")
+        self.assertEqual((movie.title, movie.year, movie.category.url, str(movie.world_premiere)), ("Фильм 4", 2004, "films", "2001-02-03"))
+        self.assertEqual(list(movie.actors.values_list("name", flat=True)), ["Актёр 1"])
+        self.assertEqual(Actor.objects.get(name="Актёр 2").description, "многострочное\nописание")
+        # индекс поиска перестроен после загрузки
+        self.assertEqual(len(self.client.get("/api/v1/movie/", {"search": "фильм"}).json()["results"]), 5)
+
+        # прогресс сохранён: повторный вызов ничего не загружает
+        self.assertEqual(self.run_import(*self.catalog_files()).count("уже загружен"), 4)
+        # с начала - обновление тех же записей без дублей
+        self.write("movies.jsonl", [{"url": "m0", "title": "Новое название"}])
+        output = self.run_import(str(self.dir / "movies.jsonl"), str(self.dir / "movie_actors.csv"), restart=True)
+        self.assertIn("movies.jsonl: строк 1, создано 0, обновлено 1", output)
+        self.assertIn("movie_actors.csv: строк 6, создано 0", output)
+        movie = Movie.objects.get(url="m0")
+        self.assertEqual((movie.title, movie.year, movie.version), ("Новое название", 2000, 3))
+        self.assertEqual((Movie.objects.count(), Actor.objects.count(), Movie.actors.through.objects.count()), (5, 3, 5))
+
+    def test_resume_after_failure(self):
+        paths = self.catalog_files(movies=7)
+        original = Movie.objects.bulk_create
+        calls = []
+
+        def failing_bulk_create(objects, *args, **kwargs):
+            calls.append(len(objects))
+            if len(calls) == 3:
+                raise DatabaseError("обрыв связи")
+            return original(objects, *args, **kwargs)
+
+        with mock.patch.object(Movie.objects, "bulk_create", failing_bulk_create):
+            with self.assertRaises(DatabaseError):
+                self.run_import(*paths, batch_size=2)
+        self.assertEqual(Movie.objects.count(), 4)
+        output = self.run_import(*paths, batch_size=2)
+        self.assertIn("movies.jsonl: строк 3, создано 3, обновлено 0", output)
+        self.assertEqual(Movie.objects.count(), 7)
+        self.assertEqual(Movie.actors.through.objects.count(), 7)
+
+    def test_bad_rows(self):
+        path = self.write("genres.csv", [{"url": "g", "name": "Жанр", "color": "red"}])
+        with self.assertRaisesMessage(CommandError, "неизвестные колонки color"):
+            self.run_import(path)
+        path = self.write("movies.csv", [{"url": "m", "title": "-", "year": "не год"}])
+        with self.assertRaisesMessage(CommandError, "movies.csv: пачка после строки 0"):
+            self.run_import(path)
+        with self.assertRaisesMessage(CommandError, "имя должно начинаться"):
+            self.run_import(self.write("films.csv", [{"url": "m"}]))
+
+
+class ExportTests(CatalogMixin, TestCase):
+    """Выгрузка каталога в NDJSON потоком и пачками"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(5)
+        Movie.objects.filter(url="movie4").update(draft=True)
+
+    def read(self, response):
+        with CaptureQueriesContext(connection) as queries:
+            content = b"".join(response.streaming_content)
+        return [json.loads(line) for line in content.decode().splitlines()], len(queries)
+
+    def test_endpoint(self):
+        response = self.client.get("/api/v1/movie/export/")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        movies, queries = self.read(response)
+        self.assertEqual([movie["url"] for movie in movies], ["terminator", "movie0", "movie1", "movie2", "movie3"])
+        # фильмы и по запросу на жанры, актёров и режиссёров на пачку
+        self.assertEqual(queries, 4)
+
+        movie = movies[0]
+        detail = self.client.get(f"/api/v1/movie/{self.movie.pk}/").json()
+        for key in ("title", "year", "country", "world_premiere", "budget"):
+            self.assertEqual(movie[key], detail[key])
+        self.assertEqual(movie["category"], {"id": self.category.pk, "name": "Фильмы", "url": "films"})
+        self.assertEqual(movie["genres"], detail["genres"])
+        self.assertEqual([actor["name"] for actor in movie["actors"]], [actor["name"] for actor in detail["actors"]])
+        self.assertEqual(len(movie["directors"]), 5)
+        self.assertEqual(movie["rating"], {"count": 5, "sum": 15, "middle_star": 3, "histogram": {str(i): 1 for i in range(1, 6)}})
+
+    def test_chunks_and_command(self):
+        with CaptureQueriesContext(connection) as queries:
+            chunks = export_catalog(chunk_size=2)
+            first = next(chunks)
+            # первая пачка готова до чтения остальных фильмов
+            self.assertEqual(first.count(b"\n"), 2)
+            self.assertEqual(len(queries), 4)
+            content = first + b"".join(chunks)
+        self.assertEqual(len(queries), 1 + 3 * 3)
+
+        output = StringIO()
+        call_command("export_catalog", "--chunk-size=2", stdout=output, stderr=StringIO())
+        self.assertEqual(output.getvalue().encode(), content)
+        self.assertEqual(content, b"".join(self.client.get("/api/v1/movie/export/").streaming_content))
+
+
+class ChangeFeedTests(CatalogMixin, TestCase):
+    """Лента изменений: записи журнала на каждое изменение и выдача пачками"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(3)
+        self.token = self.client.get("/api/v1/changes/").json()["next"]
+
+    def read_feed(self, since, limit=None):
+        """Все изменения после since, пачками по limit"""
+        changes = []
+        while True:
+            params = {"since": since, **({"limit": limit} if limit else {})}
+            data = self.client.get("/api/v1/changes/", params).json()
+            changes += data["changes"]
+            since = data["next"]
+            if not data["has_more"]:
+                return changes, since
+
+    def test_changes(self):
+        admin = User.objects.create_superuser("admin", "admin@example.com", "password")
+        movie = Movie.objects.create(title="Чужой", description="-", country="США", url="alien")
+        movie.actors.add(self.actor)
+        Actor.objects.filter(pk=self.actor.pk).update(age=70)
+        self.actor.refresh_from_db()
+        self.actor.save()
+        review = Review.objects.create(movie=movie, name="Зритель", email="z@z.ru", text="-")
+        Review.objects.filter(name="user0").delete()
+        self.client.post("/api/v1/rating/", {"star": self.stars[4].pk, "movie": movie.pk}, REMOTE_ADDR="10.5.5.5")
+        self.client.force_login(admin)
+        # фильмографии актёров пересчитываются после коммита
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/admin/movies/movie/", {"action": "unpublish", "_selected_action": [self.movie.pk]})
+
+        changes, token = self.read_feed(self.token)
+        actions = {(change["model"], change["id"]): change["action"] for change in changes}
+        rating = Rating.objects.get(ip="10.5.5.5")
+        deleted_reviews = {key for key, action in actions.items() if key[0] == "review" and action == "deleted"}
+        self.assertEqual(actions[("movie", movie.pk)], "created")
+        # снятый с публикации фильм для зеркала удалён
+        self.assertEqual(actions[("movie", self.movie.pk)], "deleted")
+        self.assertEqual(actions[("actor", self.actor.pk)], "updated")
+        self.assertEqual(actions[("review", review.pk)], "created")
+        self.assertEqual(actions[("rating", rating.pk)], "created")
+        self.assertEqual(len(deleted_reviews), 1)
+        # у ответа на удалённый отзыв обнулился parent
+        reply = Review.objects.get(name="reply0")
+        self.assertEqual(actions[("review", reply.pk)], "updated")
+        # повторные изменения одного объекта схлопываются в одно
+        self.assertEqual(len(changes), len(actions))
+
+        payloads = {(change["model"], change["id"]): change["data"] for change in changes}
+        self.assertEqual(payloads[("movie", movie.pk)]["actors"], [{"id": self.actor.pk, "name": "Арнольд"}])
+        self.assertEqual(payloads[("movie", movie.pk)]["rating"]["count"], 1)
+        self.assertEqual(payloads[("actor", self.actor.pk)]["age"], 70)
+        self.assertEqual(payloads[("rating", rating.pk)], {"id": rating.pk, "movie": movie.pk, "star": 5})
+        self.assertNotIn("email", payloads[("review", review.pk)])
+        self.assertIsNone(payloads[("review", reply.pk)]["parent"])
+        self.assertIsNone(payloads[("movie", self.movie.pk)])
+
+        # мелкими пачками приходит то же самое, каждое изменение не раньше своего номера
+        paged, paged_token = self.read_feed(self.token, limit=2)
+        self.assertEqual(paged_token, token)
+        self.assertEqual({(change["model"], change["id"]) for change in paged}, set(actions))
+        self.assertEqual(self.read_feed(token), ([], token))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/admin/movies/movie/", {"action": "publish", "_selected_action": [self.movie.pk]})
+        changes, _ = self.read_feed(token)
+        # фильм вернулся и в фильмографии своих актёров и режиссёров
+        credited = {*self.movie.actors.values_list("pk", flat=True), *self.movie.directors.values_list("pk", flat=True)}
+        self.assertEqual(
+            [(change["model"], change["id"], change["action"]) for change in changes],
+            [("movie", self.movie.pk, "updated")] + [("actor", pk, "updated") for pk in sorted(credited)],
+        )
+
+    def test_queries_per_batch(self):
+        for i in range(3, 10):
+            self.seed_catalog(i + 1)
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get("/api/v1/changes/", {"since": self.token, "limit": 1000}).json()
+        self.assertGreater(len(data["changes"]), 40)
+        # нумерация журнала (точка сохранения, записи без номера, последний
+        # номер, update, выход), журнал, четыре запроса фильмов, актёры, отзывы, оценки
+        self.assertEqual(len(queries), 13)
+
+    def test_compact(self):
+        for age in (70, 71, 72):
+            Actor.objects.filter(pk=self.actor.pk).update(age=age)
+            Movie.touch(pk=self.movie.pk)
+        Change.record(Actor, [self.actor.pk], Change.UPDATED)
+        before, token = self.read_feed(self.token)
+        count = Change.objects.count()
+        # запись моложе RETENTION_DAYS остаётся, даже если её вытеснили
+        young = Change.objects.create(model="review", object_id=0, action=Change.UPDATED)
+        Change.objects.exclude(pk=young.pk).update(created=timezone.now() - timedelta(days=31))
+        Change.objects.create(model="review", object_id=0, action=Change.DELETED)
+        out = StringIO()
+        call_command("compact_changes", stdout=out)
+        self.assertIn(f"Удалено записей журнала: {count + 2 - Change.objects.count()}", out.getvalue())
+        # у каждого объекта осталась одна запись, кроме молодой
+        repeated = Change.objects.values_list("model", "object_id").annotate(n=models.Count("pk")).filter(n__gt=1)
+        self.assertEqual(list(repeated), [("review", 0, 2)])
+        self.assertEqual(self.read_feed(self.token)[0][:len(before)], before)
+        self.assertEqual(self.read_feed(token)[0][0]["model"], "review")
+
+    def test_late_commit_is_not_skipped(self):
+        Review.objects.create(movie=self.movie, name="Зритель", email="z@z.ru", text="-")
+        changes, token = self.read_feed(self.token)
+        # транзакция, получившая id записи журнала раньше, закоммитилась позже
+        late = Change.objects.create(pk=Change.objects.order_by("pk").first().pk - 1, model="actor",
+                                     object_id=self.actor.pk, action=Change.UPDATED)
+        changes, _ = self.read_feed(token)
+        self.assertEqual([(change["model"], change["id"]) for change in changes], [("actor", self.actor.pk)])
+        late.refresh_from_db()
+        self.assertEqual(late.seq, int(token) + 1)
+
+    def test_bad_token(self):
+        self.assertEqual(self.client.get("/api/v1/changes/", {"since": "abc"}).status_code, 400)
+
+
+class MetricsTests(CatalogMixin, TestCase):
+    """Server-Timing и гистограммы запросов"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(3)
+        metrics._metrics = None
+
+    def test_server_timing(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/v1/movie/{self.movie.pk}/")
+        header = response["Server-Timing"]
+        self.assertIn(f'desc="{len(queries)} queries"', header)
+        timing = parse_server_timing(header)
+        self.assertEqual(set(timing), {"db", "serialize", "total"})
+        self.assertGreater(timing["serialize"], 0)
+        self.assertGreater(timing["total"], timing["db"])
+        self.assertGreater(timing["total"], timing["serialize"])
+
+        # вне PATH_PREFIXES не измеряется
+        self.assertNotIn("Server-Timing", self.client.get("/admin/login/"))
+        # запросы к бд вне запроса не считаются и ничего не ломают
+        self.assertIsNone(metrics.current_timings.get())
+        Movie.objects.count()
+
+    async def test_async_views(self):
+        response = await AsyncClient().get(f"/api/async/v1/movie/{self.movie.pk}/")
+        timing = parse_server_timing(response["Server-Timing"])
+        self.assertGreater(timing["db"], 0)
+        self.assertGreater(timing["serialize"], 0)
+
+    def test_prometheus(self):
+        for _ in range(3):
+            self.client.get(f"/api/v1/movie/{self.movie.pk}/")
+        self.client.get("/api/v1/movie/0/")
+        self.client.post("/api/v1/rating/", {"star": self.stars[0].pk, "movie": self.movie.pk})
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        detail = 'route="/api/v1/movie/<int:pk>/",method="GET"'
+        self.assertIn(f'movies_request_duration_seconds_count{{{detail},status="200"}} 3', lines)
+        self.assertIn(f'movies_request_duration_seconds_count{{{detail},status="404"}} 1', lines)
+        self.assertIn(
+            'movies_request_duration_seconds_bucket{route="/api/v1/rating/",method="POST",status="201",le="+Inf"} 1',
+            lines,
+        )
+        # корзины накопительные
+        buckets = [
+            int(line.rsplit(" ", 1)[1]) for line in lines
+            if line.startswith(f'movies_request_db_queries_bucket{{{detail},status="200"')
+        ]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 3)
+
+    def test_scrape_access(self):
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="10.1.1.1").status_code, 403)
+        self.assertEqual(
+            self.client.get("/metrics/", REMOTE_ADDR="10.1.1.1", HTTP_X_FORWARDED_FOR="127.0.0.1").status_code, 403
+        )
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="10.1.1.1").status_code, 200)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("latency", "Задержка.", (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(("a\"b",), value)
+        self.assertEqual(histogram.expose(("route",))[2:], [
+            'latency_bucket{route="a\\"b",le="0.1"} 2',
+            'latency_bucket{route="a\\"b",le="1"} 3',
+            'latency_bucket{route="a\\"b",le="+Inf"} 4',
+            'latency_sum{route="a\\"b"} 3.65',
+            'latency_count{route="a\\"b"} 4',
+        ])
+
+
+class ProfilingTests(CatalogMixin, TestCase):
+    """Профили запросов по заголовку и выборке, команда profiles"""
+
+    def setUp(self):
+        super().setUp()
+        self.seed_catalog(3)
+        self.directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(PROFILING={
+            "DIR": self.directory, "MAX_PROFILES": 3, "SAMPLE_RATE": 0.0, "TOKEN": "secret",
+        }))
+        self.staff = User.objects.create_user("staff", password="password", is_staff=True)
+        self.url = f"/api/v1/movie/{self.movie.pk}/"
+
+    def profiles(self, *args):
+        out = StringIO()
+        call_command("profiles", "--dir", str(self.directory), *args, stdout=out)
+        return out.getvalue()
+
+    def test_header(self):
+        # без staff и токена заголовок ничего не делает
+        self.assertNotIn("X-Profile-Id", self.client.get(self.url, HTTP_X_PROFILE="1"))
+        self.assertNotIn("X-Profile-Id", self.client.get(self.url, HTTP_X_PROFILE="wrong"))
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+        self.client.force_login(self.staff)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_X_PROFILE="1")
+        profile_id = response["X-Profile-Id"]
+        meta = json.loads((self.directory / f"{profile_id}.json").read_text())
+        self.assertEqual((meta["route"], meta["status"], meta["user"], meta["trigger"]),
+                         ("/api/v1/movie/<int:pk>/", 200, "staff", "header"))
+        # сессия и пользователь читаются до профиля
+        sql = [query["sql"] for query in meta["sql"]]
+        self.assertEqual(meta["queries"], len(sql))
+        self.assertEqual(len(queries) - len(sql), 2)
+        # без параметров
+        self.assertIn("%s", sql[0])
+        self.assertGreater(meta["phases_ms"]["view"], meta["phases_ms"]["serialize"])
+        self.assertGreater(meta["phases_ms"]["render"], 0)
+        self.assertGreaterEqual(meta["phases_ms"]["total"], meta["phases_ms"]["view"])
+
+        self.client.logout()
+        response = self.client.get(self.url, HTTP_X_PROFILE="secret")
+        self.assertIn("X-Profile-Id", response)
+        self.assertIsNone(metrics.current_timings.get())
+
+    def test_sampling_and_ring(self):
+        with override_settings(PROFILING={"DIR": self.directory, "MAX_PROFILES": 3, "SAMPLE_RATE": 1.0}):
+            client = APIClient()
+            for _ in range(5):
+                response = client.get(self.url)
+                # id профиля выборки клиенту не показывается
+                self.assertNotIn("X-Profile-Id", response)
+            client.get("/admin/login/")
+        self.assertEqual(len(list(self.directory.glob("*.json"))), 3)
+        self.assertEqual(len(list(self.directory.glob("*.prof"))), 3)
+
+    def test_command(self):
+        self.client.force_login(self.staff)
+        first = self.client.get(self.url, HTTP_X_PROFILE="1")["X-Profile-Id"]
+        cache.clear()
+        second = self.client.get("/api/v1/movie/", HTTP_X_PROFILE="1")["X-Profile-Id"]
+
+        listing = self.profiles("list").splitlines()
+        self.assertEqual([line.split()[0] for line in listing], [first, second])
+        self.assertEqual(self.profiles("list", "--route", "/api/v1/movie/").split()[0], second)
+
+        shown = self.profiles("show", first)
+        self.assertIn("rest_framework/views.py", shown)
+        self.assertIn("movies/service.py", shown)
+        self.assertIn('SELECT "movies_review"."id"', shown)
+
+        diff = self.profiles("diff", first, second)
+        self.assertIn(f"A: {first}", diff)
+        self.assertRegex(diff, r"queries +\d+ +\d+")
+
+        with self.assertRaises(CommandError):
+            self.profiles("show", "missing")
+
+
+class ThrottlingTests(CatalogMixin, TestCase):
+    """Корзины токенов на ip и сброс нагрузки на записях"""
+
+    SCOPES = {
+        "reviews": {"RATE": "3/min", "BURST": 3},
+        "ratings": {"RATE": "60/min", "BURST": 30, "LEASE": 3},
+    }
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.enterContext(override_settings(THROTTLING={"SCOPES": self.SCOPES}))
+        throttling._limiter = None
+        self.addCleanup(setattr, throttling, "_limiter", None)
+        latency = metrics.get_db_latency()
+        self.addCleanup(setattr, latency, "value", None)
+        latency.value = None
+
+    def review(self, ip):
+        return self.client.post(
+            "/api/v1/review/", {"email": "a@a.ru", "name": "bot", "text": "-", "movie": self.movie.pk}, REMOTE_ADDR=ip
+        )
+
+    def test_review_limit(self):
+        for _ in range(3):
+            self.assertEqual(self.review("10.1.1.1").status_code, 201)
+        response = self.review("10.1.1.1")
+        self.assertEqual(response.status_code, 429)
+        # токен копится 20 секунд
+        self.assertIn(int(response["Retry-After"]), (19, 20))
+        # отказ не доходит до бд и кэша
+        with CaptureQueriesContext(connection) as queries, mock.patch.object(cache, "incr") as incr:
+            self.assertEqual(self.review("10.1.1.1").status_code, 429)
+        self.assertFalse(incr.called)
+        self.assertLessEqual(len(queries), 2)
+        self.assertEqual(Review.objects.filter(name="bot").count(), 3)
+
+        # другой ip и другой маршрут со своими корзинами
+        self.assertEqual(self.review("10.1.1.2").status_code, 201)
+        response = self.client.post(
+            "/api/v1/rating/", {"star": self.stars[0].pk, "movie": self.movie.pk}, REMOTE_ADDR="10.1.1.1"
+        )
+        self.assertEqual(response.status_code, 201)
+        # чтение не ограничивается
+        self.assertEqual(self.client.get("/api/v1/movie/", REMOTE_ADDR="10.1.1.1").status_code, 200)
+
+    def test_refill_and_leases(self):
+        clock = mock.Mock(return_value=1000.0)
+        limiter = throttling.RateLimiter(lease_ttl=1.0, max_keys=100, clock=clock)
+        bucket = throttling.TokenBucket("test", "60/min", 10, lease=4)
+        with mock.patch.object(cache, "incr", wraps=cache.incr) as incr:
+            results = [limiter.allow(bucket, "ip") for _ in range(11)]
+        self.assertEqual(results[:10], [None] * 10)
+        self.assertAlmostEqual(results[10], 1.0)
+        # 11 запросов: add на 4, incr на 4, incr на 4 с выдачей 2 и возвратом, incr с
+        # отказом и возвратом (decr в locmem - тоже incr)
+        self.assertEqual(incr.call_count, 5)
+
+        clock.return_value += 0.5
+        self.assertAlmostEqual(limiter.allow(bucket, "ip"), 0.5)
+        # за 3 секунды накопилось 3 токена, аренда берёт сколько есть
+        clock.return_value += 2.5
+        self.assertEqual([limiter.allow(bucket, "ip") is None for _ in range(4)], [True, True, True, False])
+        # корзина полна через 10 секунд простоя
+        clock.return_value += 60
+        self.assertEqual(sum(limiter.allow(bucket, "ip") is None for _ in range(15)), 10)
+
+    def test_refill_keeps_concurrent_takes(self):
+        bucket = throttling.TokenBucket("test", "60/min", 10)
+        key = bucket.get_key("10.9.9.9")
+        cache.set(key, 1_000_000)
+        add = cache.add
+
+        def racing_add(name, *args):
+            # пока корзину поднимают до текущего момента, сосед берёт 5 токенов
+            added = add(name, *args)
+            if added and name.endswith(":lift"):
+                self.assertEqual(bucket.take("10.9.9.9", 2000.0, 5), (5, 0.0))
+            return added
+
+        with mock.patch.object(cache, "add", side_effect=racing_add):
+            self.assertEqual(bucket.take("10.9.9.9", 2000.0, 1), (1, 0.0))
+        self.assertEqual(cache.get(key), 2_000_000 + 6 * bucket.interval)
+
+    def test_concurrent_processes(self):
+        # два процесса со своим быстрым путём делят корзину в кэше
+        bucket = throttling.TokenBucket("test", "1/min", 30, lease=3)
+        limiters = [throttling.RateLimiter(lease_ttl=60, max_keys=100) for _ in range(2)]
+
+        def worker(limiter):
+            return sum(limiter.allow(bucket, "10.0.0.1") is None for _ in range(20))
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            allowed = list(pool.map(worker, limiters * 8))
+        self.assertEqual(sum(allowed), 30)
+
+    def test_concurrent_ips(self):
+        factory = RequestFactory()
+        view = mock.Mock(throttle_scope="reviews")
+
+        def worker(ip):
+            request = factory.post("/api/v1/review/", REMOTE_ADDR=ip)
+            return ip, sum(throttling.TokenBucketThrottle().allow_request(request, view) for _ in range(5))
+
+        ips = [f"10.2.0.{i % 4}" for i in range(20)]
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(worker, ips))
+        allowed = {}
+        for ip, count in results:
+            allowed[ip] = allowed.get(ip, 0) + count
+        self.assertEqual(allowed, dict.fromkeys(set(ips), 3))
+
+    def test_load_shedding(self):
+        latency = metrics.get_db_latency()
+        latency.observe(0.2)
+        with mock.patch.object(throttling.random, "random", return_value=0.5):
+            response = self.review("10.3.0.1")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "5")
+        # отказ при сбросе не тратит токен
+        self.assertIsNone(cache.get("throttle:reviews:10.3.0.1"))
+        with mock.patch.object(throttling.random, "random", return_value=0.95):
+            self.assertEqual(self.review("10.3.0.1").status_code, 201)
+
+        # бд снова быстрая: после ответа среднее опускается ниже порога
+        latency.value = 0.01
+        self.assertEqual(self.review("10.3.0.1").status_code, 201)
+        # старые замеры не учитываются
+        latency.value = 0.2
+        with override_settings(THROTTLING={"SCOPES": self.SCOPES, "SHED_MAX_AGE": 0}):
+            self.assertEqual(self.review("10.3.0.2").status_code, 201)
+
+
+class ReplicaTests(CatalogMixin, TestCase):
+    """Чтения с реплик, запись и чтение своих записей на основной бд"""
+
+    databases = {"default", "replica1", "replica2"}
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(DATABASE_REPLICAS={"REPLICAS": ("replica1", "replica2")}))
+        replicas._pool = None
+        self.addCleanup(setattr, replicas, "_pool", None)
+        # у каждой реплики свой фильм, которого нет на основной бд
+        for pk, alias in enumerate(("replica1", "replica2"), start=1000):
+            category = Category.objects.using(alias).create(name="-", description="-", url="films")
+            Movie.objects.using(alias).create(
+                pk=pk, title=alias, description="-", country="-", url=alias, category=category
+            )
+
+    def titles(self, fresh=True, **extra):
+        if fresh:
+            bump_movie_list_version()
+        response = self.client.get("/api/v1/movie/", **extra)
+        self.assertEqual(response.status_code, 200)
+        return {movie["title"] for movie in response.data["results"]}
+
+    def test_reads_from_replica(self):
+        with CaptureQueriesContext(connection) as primary:
+            seen = set().union(*(self.titles() for _ in range(20)))
+        self.assertEqual(seen, {"replica1", "replica2"})
+        self.assertEqual(len(primary), 0)
+        # пути вне PATH_PREFIXES, как админка, читают с основной бд
+        with self.settings(DATABASE_REPLICAS={"REPLICAS": ("replica1",), "PATH_PREFIXES": ("/api/v2/",)}):
+            self.assertEqual(self.titles(), {"Терминатор"})
+
+    def test_read_your_writes(self):
+        self.enterContext(override_settings(DATABASE_REPLICAS={"REPLICAS": ("replica1",), "STICKY_SECONDS": 0.2}))
+        response = self.client.post(
+            "/api/v1/review/", {"email": "a@a.ru", "name": "a", "text": "-", "movie": self.movie.pk},
+            REMOTE_ADDR="10.4.0.1",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Review.objects.using("replica1").count(), 0)
+        # автор отзыва читает с основной бд мимо кэша
+        self.assertEqual(self.titles(REMOTE_ADDR="10.4.0.2"), {"replica1"})
+        self.assertEqual(self.titles(fresh=False, REMOTE_ADDR="10.4.0.1"), {"Терминатор"})
+        detail = self.client.get(f"/api/v1/movie/{self.movie.pk}/", REMOTE_ADDR="10.4.0.1")
+        self.assertEqual([review["name"] for review in detail.data["reviews"]], ["a"])
+        self.assertEqual(self.client.get(f"/api/v1/movie/{self.movie.pk}/", REMOTE_ADDR="10.4.0.2").status_code, 404)
+        time.sleep(0.3)
+        self.assertEqual(self.titles(REMOTE_ADDR="10.4.0.1"), {"replica1"})
+
+    def test_replica_reads_not_cached(self):
+        self.enterContext(override_settings(
+            DATABASE_REPLICAS={"REPLICAS": ("replica1",)}, CATALOG_INDEX={"ENABLED": False}
+        ))
+        self.assertEqual(self.titles(), {"replica1"})
+        self.assertEqual(self.client.get("/api/v1/movie/facets/").data["count"], 1)
+        # update мимо сигналов: версия кэша списков не меняется
+        Movie.objects.using("replica1").filter(pk=1000).update(draft=True)
+        # список и фасеты с реплики не попали в общий кэш и собираются заново
+        self.assertEqual(self.titles(fresh=False), set())
+        self.assertEqual(self.client.get("/api/v1/movie/facets/").data["count"], 0)
+
+    async def test_async_replica_reads_not_cached(self):
+        self.enterContext(override_settings(DATABASE_REPLICAS={"REPLICAS": ("replica1",)}))
+        await sync_to_async(bump_movie_list_version)()
+        client = AsyncClient()
+        response = await client.get("/api/async/v1/movie/")
+        self.assertEqual([movie["title"] for movie in response.json()["results"]], ["replica1"])
+        await Movie.objects.using("replica1").filter(pk=1000).aupdate(draft=True)
+        response = await client.get("/api/async/v1/movie/")
+        self.assertEqual(response.json()["results"], [])
+
+    async def test_async_cache_calls_do_not_block(self):
+        def outside_event_loop(method):
+            def call(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                except RuntimeError:
+                    return method(*args, **kwargs)
+                raise AssertionError(f"{method.__name__} в цикле событий")
+            return call
+
+        backend = caches["default"]
+        guarded = {name: outside_event_loop(getattr(backend, name)) for name in ("get", "set", "get_or_set", "add")}
+        client = AsyncClient()
+        with mock.patch.multiple(backend, **guarded):
+            for ordering in ("year", "-rating"):
+                response = await client.get("/api/async/v1/movie/", {"ordering": ordering})
+                self.assertEqual(response.status_code, 200)
+            response = await client.get("/api/async/v1/movie/", headers={"X-Forwarded-For": "10.4.0.9"})
+            self.assertEqual(response.status_code, 200)
+
+    def test_unhealthy_replica_skipped(self):
+        lag = {"replica1": 60.0, "replica2": 0.0}
+        with mock.patch.object(replicas, "get_replica_lag", side_effect=lambda db: lag[db.alias]):
+            with self.assertLogs("movies.replicas", "WARNING"):
+                seen = set().union(*(self.titles() for _ in range(10)))
+            self.assertEqual(seen, {"replica2"})
+
+            # без здоровых реплик чтения идут на основную бд
+            replicas._pool = None
+            lag["replica2"] = 60.0
+            with self.assertLogs("movies.replicas", "WARNING"):
+                self.assertEqual(self.titles(), {"Терминатор"})
+
+    def test_failed_replica_marked_down(self):
+        self.enterContext(override_settings(DATABASE_REPLICAS={"REPLICAS": ("replica1", "replica2")}))
+        self.client.raise_request_exception = False
+        pool = replicas.get_replica_pool()
+        with mock.patch.object(replicas.random, "choice", side_effect=lambda aliases: aliases[0]):
+            def fail(*args, **kwargs):
+                Movie.objects.count()
+                raise OperationalError("replica1 gone")
+
+            with mock.patch.object(MovieListView, "list", side_effect=fail):
+                with self.assertLogs("movies.replicas", "WARNING"):
+                    self.assertEqual(self.client.get("/api/v1/movie/").status_code, 500)
+            self.assertGreater(pool.health["replica1"].down_until, time.monotonic())
+            self.assertEqual(self.titles(), {"replica2"})
+
+    def test_export_streams_from_replica(self):
+        self.enterContext(override_settings(DATABASE_REPLICAS={"REPLICAS": ("replica1",)}))
+        response = self.client.get("/api/v1/movie/export/")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["title"] for line in lines], ["replica1"])
+
+    def test_change_feed_reads_primary(self):
+        with CaptureQueriesContext(connections["replica1"]) as first, \
+                CaptureQueriesContext(connections["replica2"]) as second:
+            response = self.client.get("/api/v1/changes/?since=0")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.movie.pk, {change["id"] for change in response.data["changes"]})
+        self.assertEqual(len(first) + len(second), 0)
+
+
+class FilmographyTests(CatalogMixin, TestCase):
+    """Фильмография актёра, пересчитываемая при изменении фильмов и оценок"""
+
+    def filmography(self, actor=None):
+        return Actor.objects.get(pk=(actor or self.actor).pk).filmography
+
+    def credits(self, role, actor=None):
+        return [(credit["title"], credit["rating"]) for credit in self.filmography(actor)[role]]
+
+    def committed(self):
+        # фильмография пересчитывается после коммита
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def test_detail(self):
+        old = Movie.objects.create(title="Коммандо", description="-", country="США", url="commando", year=1985)
+        with self.committed():
+            old.actors.add(self.actor)
+            self.movie.directors.add(self.actor)
+            self.movie.actors.add(self.actor)
+            self.client.post("/api/v1/rating/", {"star": self.stars[3].pk, "movie": self.movie.pk}, REMOTE_ADDR="10.2.0.1")
+        response = self.client.get(f"/api/v1/actors/{self.actor.pk}/")
+        self.assertEqual(response.data["filmography"], {
+            "acting": [
+                {"id": self.movie.pk, "title": "Терминатор", "year": 2019, "rating": 4.0},
+                {"id": old.pk, "title": "Коммандо", "year": 1985, "rating": None},
+            ],
+            "directing": [{"id": self.movie.pk, "title": "Терминатор", "year": 2019, "rating": 4.0}],
+            "stats": {"movies": 2, "first_year": 1985, "last_year": 2019, "average_rating": 4.0},
+        })
+        self.assertQueriesFlat("get", f"/api/v1/actors/{self.actor.pk}/")
+
+    def test_links(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+        self.assertEqual(self.credits("acting"), [("Терминатор", None)])
+        version = Actor.objects.get(pk=self.actor.pk).version
+        # обратная сторона связи
+        with self.committed():
+            self.actor.film_director.add(self.movie)
+        self.assertEqual(self.credits("directing"), [("Терминатор", None)])
+        self.assertEqual(Actor.objects.get(pk=self.actor.pk).version, version + 1)
+        with self.committed():
+            self.movie.actors.remove(self.actor)
+        self.assertEqual(self.credits("acting"), [])
+        with self.committed():
+            self.movie.directors.clear()
+        self.assertEqual(self.filmography(), Actor._meta.get_field("filmography").get_default())
+
+    def test_movie_changes(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+            self.movie.title = "Терминатор 2"
+            self.movie.save()
+        self.assertEqual(self.credits("acting"), [("Терминатор 2", None)])
+        self.movie.draft = True
+        with self.committed():
+            self.movie.save()
+        self.assertEqual(self.credits("acting"), [])
+        self.movie.draft = False
+        with self.committed():
+            self.movie.save()
+            self.movie.delete()
+        self.assertEqual(self.filmography()["stats"]["movies"], 0)
+
+    def test_ratings(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+            self.client.post("/api/v1/rating/", {"star": self.stars[4].pk, "movie": self.movie.pk}, REMOTE_ADDR="10.2.0.1")
+        self.assertEqual(self.credits("acting"), [("Терминатор", 5.0)])
+        ratings = [{"movie": self.movie.pk, "star": self.stars[0].pk}]
+        with self.committed():
+            self.client.post("/api/v1/rating/bulk/", {"ratings": ratings}, format="json", REMOTE_ADDR="10.2.0.2")
+        self.assertEqual(self.credits("acting"), [("Терминатор", 3.0)])
+        self.assertEqual(self.filmography()["stats"]["average_rating"], 3.0)
+
+    def test_ratings_refresh_after_commit(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+        with self.committed():
+            upsert_ratings({("10.2.0.3", self.movie.pk): self.stars[4]})
+            # транзакция оценок держит строки фильмов и не трогает актёров
+            self.assertEqual(self.credits("acting"), [("Терминатор", None)])
+        self.assertEqual(self.credits("acting"), [("Терминатор", 5.0)])
+
+    def test_ratings_refresh_only_shown_changes(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+            upsert_ratings({("10.2.0.4", self.movie.pk): self.stars[3], ("10.2.0.5", self.movie.pk): self.stars[3]})
+        version = Actor.objects.get(pk=self.actor.pk).version
+        # средняя 4.0 не меняется: сводка и версия актёра остаются прежними
+        with self.committed():
+            upsert_ratings({("10.2.0.6", self.movie.pk): self.stars[3]})
+        self.assertEqual(Actor.objects.get(pk=self.actor.pk).version, version)
+        with self.committed():
+            upsert_ratings({("10.2.0.6", self.movie.pk): self.stars[4]})
+        self.assertEqual(self.credits("acting"), [("Терминатор", 4.33)])
+        self.assertEqual(Actor.objects.get(pk=self.actor.pk).version, version + 1)
+
+    def test_admin_unpublish(self):
+        with self.committed():
+            self.movie.actors.add(self.actor)
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+        data = {"action": "unpublish", "_selected_action": [self.movie.pk]}
+        with self.committed():
+            self.client.post("/admin/movies/movie/", data)
+        self.assertEqual(self.credits("acting"), [])
+        with self.committed():
+            self.client.post("/admin/movies/movie/", {**data, "action": "publish"})
+        self.assertEqual(self.credits("acting"), [("Терминатор", None)])
+
+    def test_rebuild_after_bulk_links(self):
+        Movie.actors.through.objects.bulk_create([Movie.actors.through(movie=self.movie, actor=self.actor)])
+        self.assertEqual(self.credits("acting"), [])
+        out = StringIO()
+        call_command("rebuild_filmography", stdout=out)
+        self.assertEqual(self.credits("acting"), [("Терминатор", None)])
+        self.assertIn("фильмография 1 актёров", out.getvalue())
@@ -0,0 +1,222 @@
+"""Ограничение частоты записей с одного ip и сброс нагрузки
+
+TokenBucketThrottle - корзина токенов на пару (throttle_scope представления,
+get_client_ip): RATE токенов в период копятся до BURST, запрос тратит один.
+Общее состояние корзины лежит в кэше Django (алгоритм GCRA: в ключе хранится
+момент, когда корзина снова станет полной, в миллисекундах), поэтому предел
+общий для всех процессов; кэш должен быть общим (utils.check_shared_cache).
+Быстрый путь в памяти процесса:
+- токены берутся из кэша пачкой по LEASE и тратятся локально;
+- после отказа ip получает отказ без обращения к кэшу, пока не выйдет Retry-After,
+  так поток запросов бота не нагружает ни бд, ни кэш.
+
+Занять токены - один incr, атомарный в memcached, redis и locmem. Полную
+корзину (значение в прошлом) поднимает до текущего момента тоже incr, а не
+set, чтобы не затереть incr соседних запросов. Поднимает один запрос, взявший
+короткую блокировку add. Лишними пропускаются единицы запросов: те, чей incr
+пришёлся между incr поднимающего и его блокировкой, и токены не больше чем за
+LIFT_LOCK_SECONDS, если корзина успеет опустеть и наполниться, пока блокировка
+жива.
+
+LoadSheddingThrottle отвечает 429, когда среднее время запроса к бд
+(movies.metrics.get_db_latency) выше SHED_DB_LATENCY: доля отказов растёт от
+нуля на пороге до SHED_MAX_FRACTION на двойном пороге. Без включённых метрик
+замеров нет, и нагрузка не сбрасывается.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import get_db_latency
+from .service import get_client_ip
+
+DEFAULTS = {
+    "ENABLED": True,
+    # scope представления -> {"RATE": "N/период" как в DRF, "BURST": N, "LEASE": N}
+    # LEASE по умолчанию - десятая часть BURST, но не меньше одного токена
+    "SCOPES": {
+        "reviews": {"RATE": "5/min", "BURST": 5},
+        "ratings": {"RATE": "60/min", "BURST": 30},
+        "ratings_bulk": {"RATE": "10/min", "BURST": 5},
+    },
+    # сколько секунд процесс может тратить взятые из кэша токены
+    "LEASE_TTL": 1.0,
+    # сколько корзин (scope, ip) помнит процесс
+    "MAX_LOCAL_KEYS": 10_000,
+    # среднее время запроса к бд в секундах, выше которого записи отклоняются; None - не сбрасывать
+    "SHED_DB_LATENCY": 0.05,
+    "SHED_MAX_FRACTION": 0.9,
+    # замеры старше стольких секунд не учитываются
+    "SHED_MAX_AGE": 10.0,
+    "SHED_RETRY_AFTER": 5,
+}
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# сколько живёт блокировка подъёма полной корзины, секунды
+LIFT_LOCK_SECONDS = 1
+
+
+def get_throttling_config():
+    return {**DEFAULTS, **getattr(settings, "THROTTLING", {})}
+
+
+def parse_rate(rate):
+    """(число, секунд) из "N/период", как SimpleRateThrottle.parse_rate"""
+    num, period = rate.split("/")
+    return int(num), PERIODS[period[0]]
+
+
+class TokenBucket:
+    """Корзина scope в кэше: GCRA с временем в целых миллисекундах"""
+
+    def __init__(self, scope, rate, burst, lease=None):
+        num, period = parse_rate(rate)
+        self.scope = scope
+        self.burst = burst
+        self.lease = min(burst, lease or max(1, burst // 10))
+        # миллисекунд на токен и на полную корзину
+        self.interval = max(1, round(period * 1000 / num))
+        self.capacity = self.interval * burst
+        self.timeout = max(3600, 2 * self.capacity // 1000)
+
+    def get_key(self, ident):
+        return f"throttle:{self.scope}:{ident}"
+
+    def take(self, ident, now, tokens):
+        """(сколько токенов выдано, секунд до следующего токена при отказе)"""
+        key = self.get_key(ident)
+        now = int(now * 1000)
+        cost = tokens * self.interval
+        if cache.add(key, now + cost, self.timeout):
+            return min(tokens, self.burst), 0.0
+        try:
+            full_at = cache.incr(key, cost)
+        except ValueError:
+            # ключ истёк между add и incr; если его уже создал сосед, токены не списаны
+            cache.add(key, now + cost, self.timeout)
+            return min(tokens, self.burst), 0.0
+        previous = full_at - cost
+        if previous < now:
+            # корзина полна: отсчёт с текущего момента, incr соседей сохраняется
+            if cache.add(f"{key}:lift", 1, LIFT_LOCK_SECONDS):
+                cache.incr(key, now - previous)
+            return min(tokens, self.burst), 0.0
+        if full_at - now <= self.capacity:
+            return tokens, 0.0
+        granted = max(0, (self.capacity - (previous - now)) // self.interval)
+        cache.decr(key, cost - granted * self.interval)
+        if granted:
+            return granted, 0.0
+        return 0, (previous + self.interval - self.capacity - now) / 1000
+
+
+class LocalState:
+    __slots__ = ("leased", "lease_expires", "blocked_until")
+
+    def __init__(self):
+        self.leased = 0
+        self.lease_expires = 0.0
+        self.blocked_until = 0.0
+
+
+class RateLimiter:
+    """Быстрый путь в памяти процесса поверх корзин в кэше, см. модуль"""
+
+    def __init__(self, lease_ttl, max_keys, clock=time.time):
+        self.lease_ttl = lease_ttl
+        self.max_keys = max_keys
+        self.clock = clock
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_state(self, key):
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = LocalState()
+            if len(self.states) > self.max_keys:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(key)
+        return state
+
+    def allow(self, bucket, ident):
+        """None, если запрос пропущен, иначе секунд до следующей попытки"""
+        key = (bucket.scope, ident)
+        now = self.clock()
+        with self.lock:
+            state = self.get_state(key)
+            if state.blocked_until > now:
+                return state.blocked_until - now
+            if state.leased and state.lease_expires > now:
+                state.leased -= 1
+                return None
+        granted, wait = bucket.take(ident, now, bucket.lease)
+        with self.lock:
+            state = self.get_state(key)
+            if not granted:
+                state.blocked_until = now + wait
+                return wait
+            # остаток прежней аренды сгорает: токены уже списаны в кэше
+            state.leased = granted - 1
+            state.lease_expires = now + self.lease_ttl
+            return None
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Локальное состояние корзин, одно на процесс"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            config = get_throttling_config()
+            _limiter = RateLimiter(config["LEASE_TTL"], config["MAX_LOCAL_KEYS"])
+        return _limiter
+
+
+def get_bucket(scope, config):
+    options = config["SCOPES"][scope]
+    return TokenBucket(scope, options["RATE"], options["BURST"], options.get("LEASE"))
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Корзина токенов на ip для throttle_scope представления"""
+
+    def allow_request(self, request, view):
+        self.wait_time = None
+        config = get_throttling_config()
+        scope = getattr(view, "throttle_scope", None)
+        if not config["ENABLED"] or scope not in config["SCOPES"]:
+            return True
+        self.wait_time = get_rate_limiter().allow(get_bucket(scope, config), get_client_ip(request))
+        return self.wait_time is None
+
+    def wait(self):
+        return self.wait_time
+
+
+class LoadSheddingThrottle(BaseThrottle):
+    """429 на часть записей, пока бд отвечает медленнее SHED_DB_LATENCY"""
+
+    def allow_request(self, request, view):
+        config = get_throttling_config()
+        self.retry_after = config["SHED_RETRY_AFTER"]
+        threshold = config["SHED_DB_LATENCY"]
+        if not config["ENABLED"] or threshold is None:
+            return True
+        latency = get_db_latency().get(config["SHED_MAX_AGE"])
+        if latency <= threshold:
+            return True
+        fraction = min(config["SHED_MAX_FRACTION"], (latency - threshold) / threshold)
+        return random.random() >= fraction
+
+    def wait(self):
+        return self.retry_after
@@ -3,9 +3,13 @@ from . import views
 
 urlpatterns =[
     path("movie/", views.MovieListView.as_view()),
+    path("movie/facets/", views.MovieFacetsView.as_view()),
+    path("movie/export/", views.MovieExportView.as_view()),
     path("movie/<int:pk>/", views.MovieDetailView.as_view()),
     path("review/", views.ReviewCreateView.as_view()),
     path("rating/", views.AddStarRatingView.as_view()),
+    path("rating/bulk/", views.AddStarRatingBulkView.as_view()),
     path("actors/", views.ActorsListView.as_view()),
     path("actors/<int:pk>/", views.ActorsDetailView.as_view()),
+    path("changes/", views.ChangesView.as_view()),
 ]
\ No newline at end of file
@@ -1,10 +1,178 @@
-from django.core.cache import cache
+import time
+from functools import partial
+from hashlib import md5
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from .models import Category
 
+# Ключ с текущей версией кэша списка фильмов. Сами записи списка лежат под ключами,
+# в которые входит версия, поэтому смена версии разом делает их все устаревшими.
+# Версии, как и остальное общее состояние процессов, лежат в кэше default: он
+# должен быть общим для всех процессов (check_shared_cache)
+MOVIE_LIST_VERSION_KEY = "movies:list:version"
+# Версия оценок фильмов: от неё зависят только страницы с сортировкой по рейтингу,
+# на остальных средняя оценка подставляется свежей поверх кэша
+MOVIE_RATING_VERSION_KEY = "movies:list:ratings"
+# Версия полей, по которым строится индекс фильтров (movies.catalog_index):
+# публикация, год, страна, категория и жанры фильмов
+CATALOG_VERSION_KEY = "movies:catalog:version"
+
+
 class DataMixin:
 
     def get_user_context(self, **kwargs):
         context = kwargs
         cats = Category.objects.all()
         context['categories'] = cats
-        return context
\ No newline at end of file
+        return context
+
+
+def get_version(key):
+    # Начальная версия от времени: если ключ вытеснят из кэша, новая версия
+    # не совпадёт со старыми записями
+    return cache.get_or_set(key, time.time_ns(), timeout=None)
+
+
+async def aget_version(key):
+    """get_version для асинхронных представлений"""
+    return await cache.aget_or_set(key, time.time_ns(), timeout=None)
+
+
+def increment_version(key):
+    """Поднять версию; новая версия или None, если ключа не было"""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # ключа ещё нет или он вытеснен
+        cache.add(key, time.time_ns(), timeout=None)
+        return None
+
+
+def bump_version(key):
+    """Поднять версию сейчас и ещё раз после коммита текущей транзакции
+
+    Между первым подъёмом и коммитом другой процесс может собрать запись по
+    новой версии из ещё старых данных; второй подъём делает и её устаревшей.
+    """
+    increment_version(key)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(partial(increment_version, key))
+
+
+def get_movie_list_version():
+    """Текущая версия кэша списка фильмов"""
+    return get_version(MOVIE_LIST_VERSION_KEY)
+
+
+def bump_movie_list_version():
+    """Сбросить кэш списка фильмов после изменения фильмов"""
+    bump_version(MOVIE_LIST_VERSION_KEY)
+
+
+def get_movie_rating_version():
+    return get_version(MOVIE_RATING_VERSION_KEY)
+
+
+def bump_movie_rating_version():
+    """Сбросить кэш страниц списка с сортировкой по рейтингу после новых оценок"""
+    bump_version(MOVIE_RATING_VERSION_KEY)
+
+
+def get_catalog_version():
+    """Текущая версия данных индекса фильтров каталога"""
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """Изменение в обход сигналов: индексы фильтров процессов перестроятся
+
+    Версия поднимается после коммита: индекс, перестроенный по новой версии,
+    должен видеть изменение. Между коммитом и подъёмом перестройка по старой
+    версии увидит новые данные, это безопасно.
+    """
+    transaction.on_commit(partial(increment_version, CATALOG_VERSION_KEY))
+
+
+def get_request_hash(request):
+    params = sorted((key, value) for key, values in request.query_params.lists() for value in values)
+    # В ответе есть абсолютные ссылки next/previous, поэтому хост тоже часть ключа
+    raw = f"{request.get_host()}{request.path}?{params}"
+    return md5(raw.encode()).hexdigest()
+
+
+def is_rating_ordering(request):
+    return request.query_params.get("ordering", "").lstrip("-") == "rating"
+
+
+def get_movie_list_cache_key(request):
+    """Ключ общей записи списка фильмов для набора фильтров из запроса"""
+    version = get_movie_list_version()
+    if is_rating_ordering(request):
+        version = f"{version}:{get_movie_rating_version()}"
+    return f"movies:list:{version}:{get_request_hash(request)}"
+
+
+async def aget_movie_list_cache_key(request):
+    """get_movie_list_cache_key без блокирующих обращений к кэшу"""
+    version = await aget_version(MOVIE_LIST_VERSION_KEY)
+    if is_rating_ordering(request):
+        version = f"{version}:{await aget_version(MOVIE_RATING_VERSION_KEY)}"
+    return f"movies:list:{version}:{get_request_hash(request)}"
+
+
+def get_movie_facets_cache_key(request):
+    """Ключ записи фасетов для набора фильтров из запроса
+
+    Фасеты зависят от полей индекса каталога; результат поиска - ещё и от
+    названий, описаний и актёров, поэтому с ?search= в ключ входит версия списка.
+    """
+    version = get_catalog_version()
+    if request.query_params.get("search"):
+        version = f"{version}:{get_movie_list_version()}"
+    return f"movies:facets:{version}:{get_request_hash(request)}"
+
+
+def get_movie_list_cache_timeout():
+    return getattr(settings, "MOVIE_LIST_CACHE_TIMEOUT", 60 * 5)
+
+
+# Бэкенды кэша, у которых в каждом процессе своё содержимое
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def check_shared_cache():
+    """Падаем при запуске сервера, если общему состоянию процессов негде жить
+
+    Версии кэшей, отметки чтения своих записей (movies.replicas) и корзины
+    ограничения частоты (movies.throttling) лежат в кэше default. В кэше
+    процесса запись одного воркера не видна другим. SHARED_CACHE_REQUIRED
+    выключают только для одного процесса: разработка и тесты.
+
+    Вызывается из rest_movie/wsgi.py и asgi.py, а не при загрузке приложения:
+    команды manage.py (migrate, drain_ratings, export_catalog) работают и без
+    общего кэша. Для manage.py check --deploy есть проверка shared_cache_check.
+    """
+    if not getattr(settings, "SHARED_CACHE_REQUIRED", True):
+        return
+    backend = settings.CACHES[DEFAULT_CACHE_ALIAS]["BACKEND"]
+    if backend in LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured(
+            f"CACHES['default'] ({backend}) не общий для процессов: задайте REDIS_URL "
+            "или SHARED_CACHE_REQUIRED = False для запуска в одном процессе"
+        )
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def shared_cache_check(app_configs, **kwargs):
+    try:
+        check_shared_cache()
+    except ImproperlyConfigured as error:
+        return [checks.Error(str(error), id="movies.E001")]
+    return []
@@ -1,73 +1,219 @@
-from rest_framework import generics
+from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from django_filters import utils
 from django_filters.rest_framework import DjangoFilterBackend
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
-from .models import Movie, Actor
+from django.db.models.functions import NullIf
+from django.http import StreamingHttpResponse
+
+from .models import Movie, Actor, Genre
 from .serializers import (
     MovieListSerializer,
     MovieDetailSerializer,
     ReviewCreateSerializer,
     CreateRatingSerializer,
+    CreateRatingBulkSerializer,
     ActorListSerializer,
     ActorDetailSerializer,
+    MovieValuesSerializer,
+    ActorValuesSerializer,
+)
+from .buffer import get_rating_buffer
+from .changes import get_change_feed_config, get_changes, get_feed_token
+from .export import CONTENT_TYPE, export_catalog
+from .replicas import read_from_replica, reads_own_writes
+from .throttling import LoadSheddingThrottle, TokenBucketThrottle
+from .service import (
+    get_client_ip,
+    get_movie_facets,
+    get_page_ratings,
+    overlay_page_ratings,
+    ConditionalGetMixin,
+    MovieFilter,
+    MoviePagination,
+    ActorPagination,
 )
-from .service import get_client_ip, MovieFilter
+from .utils import get_movie_facets_cache_key, get_movie_list_cache_key, get_movie_list_cache_timeout
+
+
+class ValuesListMixin:
+    """Быстрый режим вывода списка через values_serializer_class
 
+    Строки берутся из .values() и собираются в словари без ModelSerializer.
+    Включается настройкой FAST_LIST_SERIALIZERS.
+    """
+    values_serializer_class = None
 
-class MovieListView(generics.ListAPIView):
+    def list(self, request, *args, **kwargs):
+        if not getattr(settings, "FAST_LIST_SERIALIZERS", False):
+            return super().list(request, *args, **kwargs)
+        serializer = self.values_serializer_class(context=self.get_serializer_context())
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer.columns)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page))
+        return Response(serializer.to_representation(queryset))
+
+
+class MovieListView(ValuesListMixin, generics.ListAPIView):
     """Вывод списка фильмов"""
     serializer_class = MovieListSerializer
+    values_serializer_class = MovieValuesSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = MovieFilter
+    pagination_class = MoviePagination
 
     # Будет срабатывать при get запросе
     def get_queryset(self):
-        # Подсчитываем количество установленных рейтингов пользователям нашему фильму
-        # так как пользователь может установить только 1 раз рейтинг к фильму
-        # и если такая запись будет найдена вернётся 1, если нет то 0.
-        # ratings - Это related_name модели rating. Добавляем фильтр где поле
-        # ip рейтинга будет равно ip нашего пользователя.
-        # annotate по идеи добавляет ещё одно поле для вывода значения
+        # Список одинаков для всех клиентов и кэшируется целиком, поэтому rating_user
+        # здесь всегда False - оценки текущего ip и свежий middle_star подставляет list().
+        # middle_star считаем из сохранённых на фильме агрегатов (см. Movie.rating_sum),
+        # NullIf оставляет null для фильмов без оценок.
         movies = Movie.objects.filter(draft=False).annotate(
-            rating_user=models.Count("ratings", filter=models.Q(ratings__ip=get_client_ip(self.request)))
-        ).annotate(
-            middle_star=models.Sum(models.F('ratings__star')) / models.Count(models.F('ratings'))
+            rating_user=models.Value(False, output_field=models.BooleanField()),
+            middle_star=models.F("rating_sum") / NullIf(models.F("rating_count"), 0),
         )
         return movies
 
+    def list(self, request, *args, **kwargs):
+        key = get_movie_list_cache_key(request)
+        data = None if reads_own_writes() else cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            data = {**data, "results": [dict(row) for row in data["results"]]}
+            if not read_from_replica():
+                cache.set(key, data, get_movie_list_cache_timeout())
+        # Один запрос по id страницы: свежая средняя оценка и оценил ли фильм этот ip
+        results = data["results"]
+        if results:
+            ratings = get_page_ratings([row["id"] for row in results], get_client_ip(request))
+            results = overlay_page_ratings(results, ratings)
+        return Response({**data, "results": results})
+
+
+class MovieFacetsView(generics.GenericAPIView):
+    """Число фильмов по жанрам, десятилетиям, странам и категориям для фильтров списка"""
+    queryset = Movie.objects.filter(draft=False)
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = MovieFilter
+
+    def get(self, request, *args, **kwargs):
+        key = get_movie_facets_cache_key(request)
+        data = None if reads_own_writes() else cache.get(key)
+        if data is None:
+            filterset = DjangoFilterBackend().get_filterset(request, self.get_queryset(), self)
+            if not filterset.is_valid():
+                raise utils.translate_validation(filterset.errors)
+            data = get_movie_facets(filterset)
+            if not read_from_replica():
+                cache.set(key, data, get_movie_list_cache_timeout())
+        return Response(data)
+
+
+class MovieExportView(generics.GenericAPIView):
+    """Весь опубликованный каталог потоком NDJSON, строка на фильм (movies/export.py)"""
+
+    def get(self, request, *args, **kwargs):
+        return StreamingHttpResponse(export_catalog(self.get_serializer_context()), content_type=CONTENT_TYPE)
+
 
-class MovieDetailView(generics.RetrieveAPIView):
+class ChangesView(generics.GenericAPIView):
+    """Лента изменений каталога после токена since (movies/changes.py)"""
+    # номера записям журнала выдаются на основной бд, реплика их ещё может не видеть
+    replica_reads = False
+
+    def get(self, request, *args, **kwargs):
+        since = request.query_params.get("since")
+        if since is None:
+            return Response({"changes": [], "next": get_feed_token(), "has_more": False})
+        if not since.isdigit():
+            raise ValidationError({"since": ["Неверный токен."]})
+        config = get_change_feed_config()
+        limit = request.query_params.get("limit", "")
+        limit = min(int(limit), config["MAX_LIMIT"]) if limit.isdigit() and int(limit) > 0 else config["LIMIT"]
+        return Response(get_changes(int(since), limit, self.get_serializer_context()))
+
+
+class MovieDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     """Вывод фильма"""
-    queryset = Movie.objects.filter(draft=False)
+    # select_related и prefetch_related забирают категорию и все m2m связи фиксированным
+    # числом запросов, а не запросом на каждую связь. Отзывы собирает Movie.get_review_tree
+    queryset = Movie.objects.filter(draft=False).select_related("category").prefetch_related(
+        models.Prefetch("directors", queryset=Actor.objects.only("id", "name", "image", "image_variants")),
+        models.Prefetch("actors", queryset=Actor.objects.only("id", "name", "image", "image_variants")),
+        models.Prefetch("genres", queryset=Genre.objects.only("id", "name")),
+    )
     serializer_class = MovieDetailSerializer
 
 
 
-class ReviewCreateView(generics.CreateAPIView):
+class WriteThrottleMixin:
+    """Записи: сброс нагрузки при медленной бд и корзина токенов на ip (movies.throttling)"""
+    throttle_classes = (LoadSheddingThrottle, TokenBucketThrottle)
+
+    def check_throttles(self, request):
+        # DRF опрашивает все throttle, а здесь первый отказ останавливает проверку:
+        # запрос, отклонённый сбросом нагрузки, не тратит токен корзины
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                self.throttled(request, throttle.wait())
+
+
+class ReviewCreateView(WriteThrottleMixin, generics.CreateAPIView):
     """Добавление отзыва к фильму"""
     # data=request.data - данные которые содержатся в нашем клиентском запросе
     serializer_class = ReviewCreateSerializer
+    throttle_scope = "reviews"
 
 
 
-class AddStarRatingView(generics.CreateAPIView):
+class AddStarRatingView(WriteThrottleMixin, generics.CreateAPIView):
     """Добавление рейтинга фильму"""
 
     serializer_class = CreateRatingSerializer
+    throttle_scope = "ratings"
 
     # принимает сериализацию и в метод save указываем параметры которые
     # дополнительно хотим сохранить
     def perform_create(self, serializer):
         serializer.save(ip=get_client_ip(self.request))
 
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        # оценка принята в буфер отложенной записи, но ещё не в бд
+        if get_rating_buffer() is not None:
+            response.status_code = status.HTTP_202_ACCEPTED
+        return response
 
-class ActorsListView(generics.ListAPIView):
+
+class AddStarRatingBulkView(WriteThrottleMixin, generics.GenericAPIView):
+    """Добавление нескольких оценок фильмам одним запросом"""
+
+    serializer_class = CreateRatingBulkSerializer
+    throttle_scope = "ratings_bulk"
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ratings = serializer.save(ip=get_client_ip(request))
+        data = {"ratings": [{"movie": rating.movie_id, "star": rating.star_id} for rating in ratings]}
+        buffered = get_rating_buffer() is not None
+        return Response(data, status=status.HTTP_202_ACCEPTED if buffered else status.HTTP_201_CREATED)
+
+
+class ActorsListView(ValuesListMixin, generics.ListAPIView):
     """Вывод списка актёров"""
-    queryset = Actor.objects.all()
+    queryset = Actor.objects.only("id", "name", "image", "image_variants")
     serializer_class = ActorListSerializer
+    values_serializer_class = ActorValuesSerializer
+    pagination_class = ActorPagination
 
 #RetrieveAPIView - для вывода полного описания, аналог detailview
-class ActorsDetailView(generics.RetrieveAPIView):
+class ActorsDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     """Вывод актёра или режиссёра"""
     queryset = Actor.objects.all()
     serializer_class = ActorDetailSerializer
@@ -2,6 +2,7 @@
 ASGI config for rest_movie project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Native async read endpoints are mounted under /api/async/v1/ (movies.async_views).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -14,3 +15,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rest_movie.settings')
 
 application = get_asgi_application()
+
+# общее состояние процессов (версии кэшей, отметки реплик, корзины частоты)
+# требует общего кэша; проверяем при запуске сервера, а не в командах manage.py
+from movies.utils import check_shared_cache  # noqa: E402
+
+check_shared_cache()
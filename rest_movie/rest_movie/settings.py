@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,11 +47,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # первым, чтобы total в Server-Timing включал остальные middleware
+    'movies.metrics.MetricsMiddleware',
+    # до остальных middleware: сессии и пользователь читаются с той же бд, что и запрос
+    'movies.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # после AuthenticationMiddleware: профиль по заголовку снимается только для staff
+    'movies.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -90,6 +97,152 @@ DATABASES = {
     }
 }
 
+# Тесты гоняем на SQLite, чтобы не требовался запущенный PostgreSQL. Реплики -
+# отдельные базы SQLite, их включают только тесты movies.replicas
+if 'test' in sys.argv:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+        'replica1': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'test_replica1.sqlite3',
+        },
+        'replica2': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'test_replica2.sqlite3',
+        },
+    }
+# Отдельная база SQLite для замеров: SQLITE_DB=bench.sqlite3 python manage.py seed_catalog
+elif os.environ.get('SQLITE_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ['SQLITE_DB'],
+        }
+    }
+
+# Чтения GET запросов к API с реплик (movies.replicas): REPLICAS - псевдонимы
+# реплик в DATABASES. После записи ip клиента STICKY_SECONDS читает с основной бд
+DATABASE_ROUTERS = ['movies.replicas.ReplicaRouter']
+DATABASE_REPLICAS = {
+    'REPLICAS': (),
+    'STICKY_SECONDS': 5,
+    'CHECK_INTERVAL': 5,
+    'MAX_LAG': 5,
+    'RETRY_AFTER': 30,
+}
+
+# Кэш default общий для процессов: в нём версии кэша списка и индекса каталога,
+# отметки чтения своих записей и корзины ограничения частоты. LocMemCache у каждого
+# процесса свой, с ним сервер (wsgi.py, asgi.py) запускается только при
+# SHARED_CACHE_REQUIRED = False (movies.utils.check_shared_cache): в разработке с
+# DEBUG и в тестах. RedisCache нужен пакет redis (requirements.txt)
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+SHARED_CACHE_REQUIRED = not DEBUG and 'test' not in sys.argv
+
+# Сколько секунд живёт общая запись списка фильмов. Изменения фильмов сбрасывают
+# её раньше через версию кэша (movies.utils.bump_movie_list_version), оценки -
+# только страницы с сортировкой по рейтингу (bump_movie_rating_version)
+MOVIE_LIST_CACHE_TIMEOUT = 60 * 5
+
+# Списки фильмов и актёров собираются из .values() без ModelSerializer
+# (movies.serializers.ValuesListSerializer), JSON при этом тот же
+FAST_LIST_SERIALIZERS = True
+
+# С какого числа строк список в админке без фильтров показывает оценочное число
+# записей из статистики бд вместо COUNT(*) (movies.service.EstimatedCountPaginator)
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100_000
+
+# Индекс фильтров каталога в памяти процесса (movies.catalog_index). В тестах
+# строится сразу в запросе: фоновый поток не видит данных незакрытой транзакции теста
+CATALOG_INDEX = {
+    'ENABLED': True,
+    'BACKGROUND_BUILD': 'test' not in sys.argv,
+    'MAX_IDS': 5000,
+}
+
+# Отложенная запись оценок (movies.buffer): оценки копятся в памяти процесса и
+# пишутся пачками, ответ 202. Остаток при остановке без бд сбрасывается в
+# SPOOL_DIR и дописывается командой drain_ratings
+RATING_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('RATING_WRITE_BEHIND') == '1',
+    'MAX_SIZE': 10_000,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'BLOCK_TIMEOUT': 0.5,
+    'SPOOL_DIR': BASE_DIR / 'spool' / 'ratings',
+}
+
+# Уменьшенные копии изображений (movies.images): готовятся после загрузки в пуле
+# процессов, для старых файлов - командой build_image_variants
+IMAGE_VARIANTS = {
+    'ENABLED': True,
+    'BACKGROUND': 'test' not in sys.argv,
+    'WORKERS': 2,
+    'MAX_PENDING': 100,
+    'FORMAT': 'WEBP',
+    'QUALITY': 80,
+    'SIZES': {'thumb': (120, 160), 'small': (320, 480), 'medium': (640, 960)},
+}
+
+# Лента изменений для зеркал (movies.changes). Записи журнала получают номер
+# в ленте после коммита, пачками по SEQUENCE_BATCH. Записи старше RETENTION_DAYS,
+# вытесненные более новыми записями того же объекта, удаляет compact_changes
+CHANGE_FEED = {
+    'LIMIT': 500,
+    'MAX_LIMIT': 1000,
+    'SEQUENCE_BATCH': 10000,
+    'RETENTION_DAYS': 30,
+}
+
+# Метрики запросов (movies.metrics): заголовок Server-Timing и гистограммы
+# задержек в формате Prometheus на /metrics/
+METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+    'PATH_PREFIXES': ('/api/',),
+    'SCRAPE_IPS': ('127.0.0.1',),
+}
+
+# Профили запросов по требованию (movies.profiling): заголовок X-Profile от staff
+# или доля SAMPLE_RATE запросов. Последние MAX_PROFILES профилей лежат в DIR,
+# смотреть командой profiles
+PROFILING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.0,
+    'DIR': BASE_DIR / 'profiles',
+    'MAX_PROFILES': 200,
+    'TOKEN': os.environ.get('PROFILING_TOKEN', ''),
+}
+
+# Частота записей с одного ip (movies.throttling): корзина токенов на throttle_scope
+# представления, общая для процессов через кэш. Пока среднее время запроса к бд
+# выше SHED_DB_LATENCY секунд, часть записей получает 429
+THROTTLING = {
+    'ENABLED': True,
+    'SCOPES': {
+        'reviews': {'RATE': '5/min', 'BURST': 5},
+        'ratings': {'RATE': '60/min', 'BURST': 30},
+        'ratings_bulk': {'RATE': '10/min', 'BURST': 5},
+    },
+    'SHED_DB_LATENCY': 0.05,
+    'SHED_RETRY_AFTER': 5,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -18,11 +18,17 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from movies.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls')),
     path('ckeditor/', include('ckeditor_uploader.urls')),
     path('api/v1/', include('movies.urls')),
+    # асинхронные эндпоинты чтения, имеют смысл при запуске через asgi.py
+    path('api/async/v1/', include('movies.async_urls')),
+    # метрики процесса для Prometheus
+    path('metrics/', metrics_view),
 ]
 
 if settings.DEBUG:
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rest_movie.settings')
 
 application = get_wsgi_application()
+
+# общее состояние процессов (версии кэшей, отметки реплик, корзины частоты)
+# требует общего кэша; проверяем при запуске сервера, а не в командах manage.py
+from movies.utils import check_shared_cache  # noqa: E402
+
+check_shared_cache()